@@ -1,41 +1,93 @@
 """API class"""
 
-import io
-import uvicorn
-from fastapi import FastAPI, UploadFile, File
+from app.startup import STARTUP_TIMER    # First, to time the other imports
+import time
+import hmac
+import asyncio
+import threading
+from fastapi import FastAPI, UploadFile, File, Request, Body, Header
 from fastapi.middleware.cors import CORSMiddleware
-from app.util import format_duns, validate_duns_format
-from app.clients.dnb_client import DNBClient
-from app.clients.google_client import GoogleClient
-from app.clients.openai_client import OpenAIClient
-from app.clients.openregister_client import OpenregisterClient
-from app.config import CLIENTS, CREDENTIALS
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+from app.util import format_duns, validate_duns_format, normalize_company_name
+from app.clients.lazy_client import LazyClient
+from app.config import CLIENTS, CREDENTIALS, CACHE, LIMITS, JOBS, UPLOADS, STARTUP, TIMING, PROFILER
+from app.cache import create_cache
+from app.pipeline import PDFPipeline
+from app.jobs import JobStore, JobQueue
+from app.uploads import spool_upload, UploadTooLarge
+from app.executors import EXECUTORS
+from app.metrics import METRICS
+from app.timing import SPANS, span, start_timing, server_timing, timing_data
+from app import profiler
 from app.auto_logging import AutoLogger
-from app.responses import APIResponse
+from app.responses import APIResponse, EncodedJSONResponse
+from app.mapping import encode_json
 from app.company_data import CompanyData
 
 class API:
     """API class to handle FastAPI application and routes."""
     def __init__(self) -> None:
+        STARTUP_TIMER.mark("imports")
         self.app = FastAPI()
         self.setup_logging()
+        self.pdf_cache = create_cache("PDF", max_entries=CACHE.pdf_max_entries, ttl=CACHE.pdf_ttl,
+                                      sqlite_path=CACHE.pdf_sqlite_path,
+                                      sqlite_max_entries=CACHE.pdf_sqlite_max_entries)
+        METRICS.watch_cache("pdf", self.pdf_cache)
         self.setup_routes()
         self.enable_cors()
+        self.limit_upload_size()
+        self.time_stages()
+        self.collect_metrics()
+        self.app.add_event_handler("startup", EXECUTORS.pdf.start)
+        self.app.add_event_handler("startup", self.start_jobs)
+        self.app.add_event_handler("startup", self.warm_up)
+        self.app.add_event_handler("shutdown", self.stop_jobs)
+        self.app.add_event_handler("shutdown", self.shutdown)
         self.dnb_client, self.google_client, self.openai_client, self.openregister_client = (
             None, None, None, None)
-        if CLIENTS.dnb.available:
-            self.dnb_client = DNBClient(token=CREDENTIALS.dnb_token)
+        if CLIENTS.dnb.available:    # Clients are built on first use (or by the warm-up)
+            self.dnb_client = LazyClient("D&B", self.create_dnb_client)
         if CLIENTS.google.available:
-            self.google_client = GoogleClient(token=CREDENTIALS.google_token)
+            self.google_client = LazyClient("google", self.create_google_client)
         if CLIENTS.openai.available:
-            self.openai_client = OpenAIClient(token=CREDENTIALS.openai_token)  
+            self.openai_client = LazyClient("OpenAI", self.create_openai_client)
         if CLIENTS.openregister.available:
-            self.openregister_client = OpenregisterClient(token=CREDENTIALS.openregister)
+            self.openregister_client = LazyClient("openregister", self.create_openregister_client)
+        self.pdf_pipeline = PDFPipeline(self.openai_client, self.google_client,
+                                        self.openregister_client, self.pdf_cache)
+        self.job_queue = JobQueue(JobStore(JOBS.sqlite_path), self.pdf_pipeline) if JOBS.enabled else None
+        STARTUP_TIMER.mark("setup")
+
+    def create_dnb_client(self):
+        """Import and create the D&B client"""
+        from app.clients.dnb_client import DNBClient
+        return DNBClient(token=CREDENTIALS.dnb_token)
+
+    def create_google_client(self):
+        """Import and create the google client, which authenticates right away"""
+        from app.clients.google_client import GoogleClient
+        return GoogleClient(token=CREDENTIALS.google_token)
+
+    def create_openai_client(self):
+        """Import and create the OpenAI client"""
+        from app.clients.openai_client import OpenAIClient
+        client = OpenAIClient(token=CREDENTIALS.openai_token)
+        METRICS.watch_prompts(client.prompt_stats)
+        return client
+
+    def create_openregister_client(self):
+        """Import and create the openregister client"""
+        from app.clients.openregister_client import OpenregisterClient
+        client = OpenregisterClient(token=CREDENTIALS.openregister)
+        METRICS.watch_cache("openregister", client.cache)
+        return client
 
     def run(self) -> None:
         """Run the FastAPI application."""
+        from app.server import serve
         self.logger.info("Running API")
-        uvicorn.run(self.app, host="127.0.0.1", port=80)
+        serve(self)     # In SERVER.workers worker processes
 
     def setup_routes(self) -> None:
         """Set up API routes."""
@@ -43,6 +95,10 @@ class API:
         @self.app.get("/")
         async def health():
             return {"status": "ok"}
+
+        @self.app.get("/metrics")
+        async def metrics():
+            return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
         
         self.logger.info("Setting up routes")
         @self.app.get("/dataByDUNS/{DUNS}")
@@ -56,30 +112,145 @@ class API:
             if not valid:
                 return APIResponse(status_code=415, message="Invalid DUNS format", data={}).to_dict()
 
-            response = self.dnb_client(formatted_duns)
+            response = await EXECUTORS.dnb.run(self.dnb_client, formatted_duns)
             return response.to_dict()
                                                            
         @self.app.post("/dataFromPDF/")
-        async def get_data_from_pdf(file: UploadFile = File(...)) -> dict:
+        async def get_data_from_pdf(file: UploadFile = File(...), timing: bool = TIMING.in_body) -> dict:
             if not CLIENTS.openai.available:
                 return APIResponse(status_code=503, message="Route is unavailable", data={}).to_dict()
             if not file.filename.lower().endswith('.pdf'):
                 return APIResponse(status_code=415, message="File must be a PDF", data={}).to_dict()
-            contents = await file.read()
-            file_stream = io.BytesIO(contents)
-            response = self.openai_client(file_stream, self.google_client)
-            if CLIENTS.openregister.available:
-                self.openregister_client.enrich_data(response.data)
-            return response.to_dict()
+            try:
+                upload = await spool_upload(file)
+            except UploadTooLarge:
+                return APIResponse(status_code=413, message="File is too large", data={}).to_dict()
+            with upload:
+                response = await self.pdf_pipeline.process(upload)
+            return self.encode_response(response, timing)
+
+        @self.app.post("/dataFromPDF/batch")
+        async def get_data_from_pdfs(files: list[UploadFile] = File(...), timing: bool = TIMING.in_body) -> dict:
+            if not CLIENTS.openai.available:
+                return APIResponse(status_code=503, message="Route is unavailable", data={}).to_dict()
+            if len(files) > LIMITS.batch_files:
+                return APIResponse(status_code=413, message=f"At most {LIMITS.batch_files} files per batch",
+                                   data={}).to_dict()
+
+            responses, uploads = {}, {}
+            try:
+                for i, file in enumerate(files):
+                    if not file.filename.lower().endswith('.pdf'):
+                        responses[i] = APIResponse(status_code=415, message="File must be a PDF", data={})
+                        continue
+                    try:
+                        uploads[i] = await spool_upload(file)
+                    except UploadTooLarge:
+                        responses[i] = APIResponse(status_code=413, message="File is too large", data={})
+                responses.update(zip(uploads, await self.pdf_pipeline.process_many(list(uploads.values()))))
+            finally:
+                for upload in uploads.values():
+                    upload.close()
+
+            results = [{"filename": file.filename, **responses[i].to_encodable()}    # Keep the upload order
+                       for i, file in enumerate(files)]
+            response = {"status_code": 200, "message": f"Processed {len(files)} files", "data": results}
+            if timing:
+                response["timing"] = timing_data(SPANS.get() or [])
+            return EncodedJSONResponse(encode_json(response))
+
+        @self.app.post("/jobs/dataFromPDF/")
+        async def submit_pdf_job(file: UploadFile = File(...)) -> dict:
+            if not CLIENTS.openai.available or not self.job_queue:
+                return APIResponse(status_code=503, message="Route is unavailable", data={}).to_dict()
+            if not file.filename.lower().endswith('.pdf'):
+                return APIResponse(status_code=415, message="File must be a PDF", data={}).to_dict()
+            try:
+                upload = await spool_upload(file)
+            except UploadTooLarge:
+                return APIResponse(status_code=413, message="File is too large", data={}).to_dict()
+            with upload:
+                job_id = await self.job_queue.submit(upload)
+            if not job_id:
+                return APIResponse(status_code=503, message="Job queue is full", data={}).to_dict()
+            return {"status_code": 202, "message": "Job queued", "data": {"job_id": job_id}}
+
+        @self.app.get("/jobs/{job_id}")
+        async def get_job(job_id: str, wait: float = 0) -> dict:
+            if not self.job_queue:
+                return APIResponse(status_code=503, message="Route is unavailable", data={}).to_dict()
+            job = await self.job_queue.wait(job_id, timeout=wait)
+            if job is None:
+                return APIResponse(status_code=404, message="Unknown job", data={}).to_dict()
+            return {"status_code": 200, "message": f"Job is {job['status']}", "data": job}
+
+        @self.app.post("/dataByCompanyName/batch")
+        async def get_german_companies_data(company_names: list[str] = Body(...)):
+            if not CLIENTS.openregister.available:
+                return APIResponse(status_code=503, message="Route is unavailable", data={}).to_dict()
+            if len(company_names) > LIMITS.batch_names:
+                return APIResponse(status_code=413, message=f"At most {LIMITS.batch_names} names per batch",
+                                   data={}).to_dict()
+            return StreamingResponse(self.stream_company_data(company_names), media_type="application/x-ndjson")
 
         @self.app.get("/dataByCompanyName/{company_name}")
-        async def get_german_company_data(company_name):
+        async def get_german_company_data(company_name, timing: bool = TIMING.in_body):
             if not CLIENTS.openregister.available:
                 return APIResponse(status_code=503, message="Route is unavailable", data={}).to_dict()
             data = CompanyData()
             data.company.name = company_name
-            data = self.openregister_client.enrich_data(data)
-            return APIResponse(200, "Got the data", data).to_dict()
+            with span("enrichment"):
+                data = await EXECUTORS.openregister.run(lambda: self.openregister_client.enrich_data(data))
+            return self.encode_response(APIResponse(200, "Got the data", data), timing)
+
+        @self.app.get("/admin/profile")
+        async def profile(seconds: float = 10, interval: float = PROFILER.interval, idle: bool = False,
+                          authorization: str = Header("")):
+            if not CREDENTIALS.admin_token:
+                return APIResponse(status_code=503, message="Route is unavailable", data={}).to_dict()
+            if not hmac.compare_digest(authorization.encode(), f"Bearer {CREDENTIALS.admin_token}".encode()):
+                return JSONResponse(status_code=401, content=APIResponse(
+                    status_code=401, message="Invalid admin token", data={}).to_dict())
+            if not profiler.PROFILE_LOCK.acquire(blocking=False):
+                return JSONResponse(status_code=409, content=APIResponse(
+                    status_code=409, message="A profile is already running", data={}).to_dict())
+            try:    # Samples this worker process from a thread while it keeps serving
+                counts = await asyncio.to_thread(profiler.profile, min(max(seconds, 0), PROFILER.max_seconds),
+                                                 max(interval, 0.001), idle)
+            finally:
+                profiler.PROFILE_LOCK.release()
+            return PlainTextResponse(profiler.collapsed(counts))
+
+    async def stream_company_data(self, company_names: list[str]):
+        """Enrich many company names, yielding one JSON line per name as soon as its lookup finished"""
+        groups = {}     # Names differing only in case and whitespace share one lookup
+        for index, company_name in enumerate(company_names):
+            groups.setdefault(normalize_company_name(company_name), []).append(index)
+        limit = asyncio.Semaphore(LIMITS.name_batch_concurrency)
+
+        async def lookup(normalized: str, indices: list[int]) -> tuple[list[int], APIResponse]:
+            if not normalized:
+                return indices, APIResponse(status_code=400, message="Company name is empty", data={})
+            async with limit:
+                data = CompanyData()
+                data.company.name = company_names[indices[0]]
+                try:
+                    data = await EXECUTORS.openregister.run(lambda: self.openregister_client.enrich_data(data))
+                except Exception as e:     # One failing name must not end the stream
+                    self.logger.warn(f"Lookup of company {data.company.name} failed: {e}")
+                    return indices, APIResponse(status_code=400, message=str(e), data={})
+                return indices, APIResponse(200, "Got the data", data)
+
+        tasks = [asyncio.create_task(lookup(normalized, indices)) for normalized, indices in groups.items()]
+        try:
+            for task in asyncio.as_completed(tasks):
+                indices, response = await task
+                response = response.to_encodable()
+                yield b"".join(encode_json({"index": index, "company_name": company_names[index], **response}) + b"\n"
+                               for index in indices)
+        finally:    # The client went away, don't keep looking up
+            for task in tasks:
+                task.cancel()
 
     def setup_logging(self) -> None:
         """Set up automatic logging middleware."""
@@ -95,3 +266,87 @@ class API:
             allow_methods=["*"],  # ["GET", "POST"] if you want to restrict
             allow_headers=["*"],
         )
+
+    def limit_upload_size(self) -> None:
+        """Reject requests announcing a body larger than allowed before reading it"""
+        @self.app.middleware("http")
+        async def reject_large_requests(request: Request, call_next):
+            content_length = request.headers.get("content-length", "")
+            if content_length.isdigit() and int(content_length) > UPLOADS.max_request_size:
+                return JSONResponse(status_code=413, content=APIResponse(
+                    status_code=413, message="Request is too large", data={}).to_dict())
+            return await call_next(request)
+
+    def encode_response(self, response: APIResponse, timing: bool = False) -> EncodedJSONResponse:
+        """Encode a response, with the spans of the request so far if timing is set"""
+        if not timing:
+            return EncodedJSONResponse(response.to_json())
+        return EncodedJSONResponse(encode_json({**response.to_encodable(),
+                                                "timing": timing_data(SPANS.get() or [])}))
+
+    def time_stages(self) -> None:
+        """Collect the spans of each request's stages and upstream calls for the Server-Timing header"""
+        @self.app.middleware("http")
+        async def add_server_timing(request: Request, call_next):
+            if not (TIMING.header or TIMING.in_body or "timing" in request.query_params):
+                return await call_next(request)
+            started = time.perf_counter()
+            spans = start_timing()  # Seen by the route and the executor threads it runs
+            response = await call_next(request)
+            if TIMING.header:   # Streamed responses only have the spans until their first line
+                response.headers["Server-Timing"] = server_timing(spans, time.perf_counter() - started)
+            return response
+
+    def collect_metrics(self) -> None:
+        """Count and time the requests per route, outermost so rejected requests are counted as well"""
+        @self.app.middleware("http")
+        async def observe_requests(request: Request, call_next):
+            started = time.perf_counter()
+            status = 500    # Unless a response comes back
+            METRICS.http_in_flight.inc()   # The route is only known once routed
+            try:
+                response = await call_next(request)
+                status = response.status_code
+                return response
+            finally:
+                METRICS.http_in_flight.dec()
+                route = request.scope.get("route")  # Set by the router, the template keeps the labels few
+                route = getattr(route, "path", "unmatched")
+                METRICS.http_duration.observe(time.perf_counter() - started, route, request.method)
+                METRICS.http_requests.inc(route, request.method, str(status))
+
+    async def warm_up(self) -> None:
+        """Report the startup time and build the clients in the background while requests are served"""
+        STARTUP_TIMER.mark("startup")
+        STARTUP_TIMER.report()
+        if STARTUP.warm_up:     # Started after the PDF workers were forked
+            threading.Thread(target=self.load_clients, name="warm-up", daemon=True).start()
+
+    def load_clients(self) -> None:
+        """Build all available clients that weren't used yet"""
+        started = time.perf_counter()
+        for client in (self.dnb_client, self.google_client, self.openai_client, self.openregister_client):
+            if client is not None:
+                try:
+                    client._load()
+                except Exception as e:  # Retried on first use
+                    self.logger.warn(f"Warm-up of the {client._name} client failed: {e}")
+        self.logger.info(f"Warmed up the clients in {time.perf_counter() - started:.2f}s")
+
+    async def start_jobs(self) -> None:
+        """Start the job workers if the job API is enabled"""
+        if self.job_queue:
+            await self.job_queue.start()
+
+    async def stop_jobs(self) -> None:
+        """Stop the job workers"""
+        if self.job_queue:
+            await self.job_queue.stop()
+
+    def shutdown(self) -> None:
+        """Release the provider executors and pooled connections"""
+        self.logger.info("Shutting down executors")
+        EXECUTORS.shutdown()
+        for client in (self.google_client, self.openregister_client):
+            if client and client._loaded:   # Don't build it just to close it
+                client.close()
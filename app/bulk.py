@@ -0,0 +1,251 @@
+"""Offline bulk extraction of company data from archived PDFs through the OpenAI Batch API"""
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+from abc import ABC, abstractmethod
+from openai import OpenAI
+from app.config import BULK, LIMITS, UPLOADS
+from app.executors import EXECUTORS
+from app.pipeline import PDFPipeline
+from app.responses import ClientResponse, APIResponse
+from app.company_data import CompanyData
+from app.util import extract_text_with_ocr
+from app.auto_logging import AutoLogger
+
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchBackend(ABC):
+    """Runs a JSONL file of chat completion requests, abstract base class of the batch backends"""
+    @abstractmethod
+    def submit(self, path: str) -> str:
+        """Submit a batch input file, returns the batch id"""
+        return
+
+    @abstractmethod
+    def status(self, batch_id: str) -> str:
+        """Get the status of a batch, one of TERMINAL_STATUSES once it has ended"""
+        return
+
+    @abstractmethod
+    def results(self, batch_id: str) -> dict[str, dict]:
+        """Get the output lines of an ended batch by their custom_id"""
+        return
+
+
+class OpenAIBatchBackend(BatchBackend):
+    """Runs batches with the OpenAI Batch API (or a fake server speaking it, see BULK.base_url)"""
+    def __init__(self, token: str, base_url: str = BULK.base_url) -> None:
+        self.client = OpenAI(api_key=token, base_url=base_url or None)
+
+    def submit(self, path: str) -> str:
+        with open(path, "rb") as file:
+            input_file = self.client.files.create(file=file, purpose="batch")
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions",
+                                           completion_window=BULK.completion_window)
+        return batch.id
+
+    def status(self, batch_id: str) -> str:
+        return self.client.batches.retrieve(batch_id).status
+
+    def results(self, batch_id: str) -> dict[str, dict]:
+        batch = self.client.batches.retrieve(batch_id)
+        results = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):   # Failed requests are in the error file
+            if file_id:
+                for line in self.client.files.content(file_id).text.splitlines():
+                    if line.strip():
+                        item = json.loads(line)
+                        results[item["custom_id"]] = item
+        return results
+
+
+class InlineBatchBackend(BatchBackend):
+    """Runs batches right away through the rate limited OpenAIClient, for small runs and tests"""
+    def __init__(self, openai_client) -> None:
+        self.openai_client = openai_client
+        self.batches = {}
+
+    def run_request(self, request: dict) -> dict:
+        """Run a single request line, returns its output line"""
+        body = request["body"]
+        prompt_tokens = sum(self.openai_client.count_tokens(message["content"]) for message in body["messages"])
+        try:
+            response = self.openai_client.create_completion(body, prompt_tokens)
+            return {"custom_id": request["custom_id"], "error": None,
+                    "response": {"status_code": 200, "body": response.model_dump()}}
+        except Exception as e:
+            return {"custom_id": request["custom_id"], "response": None,
+                    "error": {"code": type(e).__name__, "message": str(e)}}
+
+    def submit(self, path: str) -> str:
+        with open(path, encoding="utf-8") as file:
+            requests = [json.loads(line) for line in file if line.strip()]
+        futures = [EXECUTORS.openai.submit(self.run_request, request) for request in requests]
+        outputs = [future.result() for future in futures]
+        batch_id = f"inline-{len(self.batches)}"
+        self.batches[batch_id] = {output["custom_id"]: output for output in outputs}
+        return batch_id
+
+    def status(self, batch_id: str) -> str:
+        return "completed"
+
+    def results(self, batch_id: str) -> dict[str, dict]:
+        return self.batches[batch_id]
+
+
+def hash_file(path: str) -> str:
+    """Hash a file chunk by chunk, like uploads are hashed while spooled"""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(UPLOADS.chunk_size):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class BulkExtractor:
+    """Extracts company data from a directory of PDFs with one batch instead of one call per PDF:
+    text extraction -> JSONL batch -> submit and poll -> CompanyData -> enrichment"""
+    def __init__(self, openai_client, backend: BatchBackend, google_client=None,
+                 openregister_client=None, cache=None) -> None:
+        self.openai_client = openai_client
+        self.backend = backend
+        self.google_client = google_client
+        self.openregister_client = openregister_client
+        self.cache = cache
+        self.logger = AutoLogger("BulkExtractor")
+
+    async def prepare(self, paths: list[str], work_dir: str) -> tuple[dict, dict, list[str]]:
+        """Extract the texts and write the requests into batch input files, returns the files of each
+        request (identical PDFs share one), the responses known without a request and the input files"""
+        files, responses = {}, {}
+        limit = asyncio.Semaphore(LIMITS.pipeline_in_flight)
+
+        async def prepare_file(path: str) -> tuple[str, str | None]:
+            async with limit:
+                sha256 = await asyncio.to_thread(hash_file, path)
+                if sha256 in files:     # Duplicate, its request is already being prepared
+                    files[sha256].append(path)
+                    return sha256, None
+                files[sha256] = [path]
+                if self.cache is not None:
+                    cached = await asyncio.to_thread(self.cache.get, PDFPipeline.cache_key(sha256))
+                    if cached is not None:
+                        responses[sha256] = APIResponse(200, "Data processed successfully",
+                                                        CompanyData.from_dict(data=cached))
+                        return sha256, None
+                try:
+                    file_text = await extract_text_with_ocr(path, self.google_client)
+                except Exception as e:
+                    self.logger.warn(f"Failed to extract text from {path}: {e}")
+                    file_text = ""
+                if not file_text:
+                    responses[sha256] = ClientResponse(status_code=400,
+                                                       message="Failed to extract text from PDF").to_APIResponse()
+                    return sha256, None
+                body, _ = self.openai_client.build_request_body(file_text)
+                return sha256, json.dumps({"custom_id": sha256, "method": "POST",
+                                           "url": "/v1/chat/completions", "body": body})
+
+        prepared = await asyncio.gather(*(prepare_file(path) for path in paths))
+        lines = [line for _, line in prepared if line is not None]
+
+        os.makedirs(work_dir, exist_ok=True)
+        inputs = []
+        for start in range(0, len(lines), BULK.max_requests):   # The Batch API limits the requests per file
+            path = os.path.join(work_dir, f"batch-{int(time.time())}-{len(inputs)}.jsonl")
+            with open(path, "w", encoding="utf-8") as file:
+                file.write("\n".join(lines[start:start + BULK.max_requests]) + "\n")
+            inputs.append(path)
+        self.logger.info(f"Prepared {len(lines)} requests for {len(paths)} PDFs in {len(inputs)} batch files")
+        return files, responses, inputs
+
+    async def wait(self, batch_id: str) -> str:
+        """Poll a batch until it has ended or BULK.max_wait has passed, returns its last status"""
+        deadline = time.monotonic() + BULK.max_wait
+        while True:
+            status = await asyncio.to_thread(self.backend.status, batch_id)
+            if status in TERMINAL_STATUSES or time.monotonic() >= deadline:
+                return status
+            self.logger.debug(f"Batch {batch_id} is {status}")
+            await asyncio.sleep(BULK.poll_interval)
+
+    async def map_result(self, sha256: str, item: dict | None) -> APIResponse:
+        """Turn an output line into the API response, enriched and cached like the PDF route's"""
+        response = (item or {}).get("response") or {}
+        if response.get("status_code") != 200:
+            error = (item or {}).get("error") or response.get("body", {}).get("error") or {}
+            return ClientResponse(status_code=400,
+                                  message=error.get("message", "No result for the PDF")).to_APIResponse()
+        try:    # One malformed answer must not fail the whole batch
+            data = json.loads(response["body"]["choices"][0]["message"]["content"])
+            result = self.openai_client.build_response(True, data)
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            return ClientResponse(status_code=400, message=f"Invalid ChatGPT response: {e}").to_APIResponse()
+
+        if result.status_code != 200:
+            return result
+        if self.openregister_client:
+            await EXECUTORS.openregister.run(lambda: self.openregister_client.enrich_data(result.data))
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.set, PDFPipeline.cache_key(sha256), result.data.to_dict())
+        return result
+
+    async def run(self, paths: list[str], work_dir: str = BULK.work_dir) -> list[dict]:
+        """Extract the company data of all PDFs, returns one result per path in input order"""
+        files, responses, inputs = await self.prepare(paths, work_dir)
+        for path in inputs:
+            batch_id = await asyncio.to_thread(self.backend.submit, path)
+            self.logger.info(f"Submitted {path} as batch {batch_id}")
+            status = await self.wait(batch_id)
+            self.logger.info(f"Batch {batch_id} is {status}")
+            results = await asyncio.to_thread(self.backend.results, batch_id) if status in TERMINAL_STATUSES else {}
+            with open(path, encoding="utf-8") as file:
+                custom_ids = [json.loads(line)["custom_id"] for line in file if line.strip()]
+            mapped = await asyncio.gather(*(self.map_result(custom_id, results.get(custom_id))
+                                            for custom_id in custom_ids))
+            responses.update(zip(custom_ids, mapped))
+
+        by_path = {path: responses[sha256] for sha256, duplicates in files.items() for path in duplicates}
+        return [{"filename": os.path.basename(path), **by_path[path].to_dict()} for path in paths]
+
+
+def main() -> None:
+    """Extract the company data of a directory of PDFs and write one JSON line per PDF"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("directory", help="Directory of the PDFs")
+    parser.add_argument("-o", "--output", default="results.jsonl", help="JSONL file of the results")
+    parser.add_argument("--backend", choices=("openai", "inline"), default="openai",
+                        help="Submit to the Batch API or run the requests right away")
+    parser.add_argument("--base-url", default=BULK.base_url, help="Base URL of the Batch API")
+    parser.add_argument("--work-dir", default=BULK.work_dir, help="Directory of the batch input files")
+    args = parser.parse_args()
+
+    from app.api import API    # Builds the clients and the result cache as configured
+    from app.config import CREDENTIALS
+
+    EXECUTORS.pdf.start()
+    api = API()
+    backend = (InlineBatchBackend(api.openai_client) if args.backend == "inline"
+               else OpenAIBatchBackend(CREDENTIALS.openai_token, base_url=args.base_url))
+    extractor = BulkExtractor(api.openai_client, backend, api.google_client, api.openregister_client,
+                              api.pdf_cache)
+    paths = sorted(os.path.join(args.directory, name) for name in os.listdir(args.directory)
+                   if name.lower().endswith(".pdf"))
+    try:
+        results = asyncio.run(extractor.run(paths, args.work_dir))
+    finally:
+        api.shutdown()
+    with open(args.output, "w", encoding="utf-8") as file:
+        for result in results:
+            file.write(json.dumps(result) + "\n")
+    succeeded = sum(result["status_code"] == 200 for result in results)
+    extractor.logger.info(f"Extracted {succeeded} of {len(results)} PDFs into {args.output}")
+
+
+if __name__ == "__main__":   # python -m app.bulk <directory>
+    main()
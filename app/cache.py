@@ -0,0 +1,259 @@
+"""Caches for results of expensive client calls"""
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from app.auto_logging import AutoLogger
+
+MISSING = object()  # Marks a cache miss, since None may be a cached value
+
+
+class CacheStats:
+    """Hit/miss/eviction counters of a cache"""
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def record(self, hit: bool) -> None:
+        """Record a lookup"""
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def evicted(self, count: int = 1) -> None:
+        """Record evicted entries"""
+        with self.lock:
+            self.evictions += count
+
+    def hit_ratio(self) -> float:
+        """Share of lookups that were hits"""
+        total = self.hits + self.misses
+        return round(self.hits / total, 4) if total else 0.0
+
+    def to_dict(self) -> dict:
+        """Turn the counters into a dict"""
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hit_ratio": self.hit_ratio()}
+
+
+class MemoryCache:
+    """Thread-safe in-memory LRU cache with per-entry TTLs"""
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()    # key -> (expires, value), least recently used first
+        self.lock = threading.Lock()
+        self.stats = CacheStats()
+
+    def get(self, key: str, default=None):
+        """Get a value, returns default if it is missing or expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.time():   # Drop expired entries lazily
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+        self.stats.record(entry is not None)
+        return entry[1] if entry is not None else default
+
+    def set(self, key: str, value, ttl: float = None) -> None:
+        """Store a value, evicting the least recently used entries if the cache is full"""
+        expires = time.time() + (ttl if ttl is not None else self.ttl)
+        evicted = 0
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                evicted += 1
+        if evicted:
+            self.stats.evicted(evicted)
+
+    def delete(self, key: str) -> None:
+        """Remove a value"""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self) -> None:
+        """Remove all values"""
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class SQLiteCache:
+    """On-disk cache in a SQLite database, values have to be JSON-serializable"""
+    def __init__(self, path: str, max_entries: int = 100_000, ttl: float = 86400,
+                 table: str = "cache") -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.table = table
+        self.stats = CacheStats()
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")   # Let readers and a writer work in parallel
+            connection.execute(f"""CREATE TABLE IF NOT EXISTS {self.table} (
+                                    key TEXT PRIMARY KEY,
+                                    value TEXT NOT NULL,
+                                    expires REAL NOT NULL,
+                                    accessed REAL NOT NULL)""")
+            connection.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_accessed ON {self.table} (accessed)")
+
+    @contextmanager
+    def connect(self):
+        """Open a connection for a single transaction, so the cache can be shared between threads 
+        and processes"""
+        connection = sqlite3.connect(self.path, timeout=10)
+        try:
+            with connection:    # Commits or rolls back the transaction
+                yield connection
+        finally:
+            connection.close()
+
+    def get_entry(self, key: str) -> tuple[float, object] | None:
+        """Get the expiry time and value of an entry, returns None if it is missing or expired"""
+        now = time.time()
+        with self.connect() as connection:
+            row = connection.execute(f"SELECT expires, value FROM {self.table} WHERE key = ?",
+                                     (key,)).fetchone()
+            if row is not None and row[0] < now:
+                connection.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                row = None
+            elif row is not None:
+                connection.execute(f"UPDATE {self.table} SET accessed = ? WHERE key = ?", (now, key))
+        self.stats.record(row is not None)
+        return (row[0], json.loads(row[1])) if row is not None else None
+
+    def get(self, key: str, default=None):
+        """Get a value, returns default if it is missing or expired"""
+        entry = self.get_entry(key)
+        return entry[1] if entry is not None else default
+
+    def set(self, key: str, value, ttl: float = None) -> None:
+        """Store a value, evicting expired and least recently used entries if the cache is full"""
+        now = time.time()
+        expires = now + (ttl if ttl is not None else self.ttl)
+        with self.connect() as connection:
+            connection.execute(f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)",
+                               (key, json.dumps(value), expires, now))
+            count = connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+            if count > self.max_entries:
+                evicted = connection.execute(f"DELETE FROM {self.table} WHERE expires < ?", (now,)).rowcount
+                overflow = count - evicted - self.max_entries
+                if overflow > 0:
+                    evicted += connection.execute(f"""DELETE FROM {self.table} WHERE key IN (
+                                                      SELECT key FROM {self.table}
+                                                      ORDER BY accessed LIMIT ?)""", (overflow,)).rowcount
+                self.stats.evicted(evicted)
+
+    def delete(self, key: str) -> None:
+        """Remove a value"""
+        with self.connect() as connection:
+            connection.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def clear(self) -> None:
+        """Remove all values"""
+        with self.connect() as connection:
+            connection.execute(f"DELETE FROM {self.table}")
+
+    def __len__(self) -> int:
+        with self.connect() as connection:
+            return connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+
+class TieredCache:
+    """In-memory LRU cache in front of an optional on-disk SQLite cache"""
+    def __init__(self, name: str, memory: MemoryCache, disk: SQLiteCache = None) -> None:
+        self.name = name
+        self.memory = memory
+        self.disk = disk
+        self.stats = CacheStats()
+        self.logger = AutoLogger(f"{name}Cache")
+
+    def get(self, key: str, default=None):
+        """Get a value from the fastest tier holding it"""
+        value = self.memory.get(key, MISSING)
+        if value is MISSING and self.disk is not None:
+            entry = self.disk.get_entry(key)
+            if entry is not None:
+                value = entry[1]
+                self.memory.set(key, value, ttl=entry[0] - time.time())  # Promote it, keeping its expiry
+        self.stats.record(value is not MISSING)
+        self.logger.debug(f"{'Miss' if value is MISSING else 'Hit'} for {key}")
+        return default if value is MISSING else value
+
+    def set(self, key: str, value, ttl: float = None) -> None:
+        """Store a value in all tiers"""
+        self.memory.set(key, value, ttl)
+        if self.disk is not None:
+            self.disk.set(key, value, ttl)
+
+    def delete(self, key: str) -> None:
+        """Remove a value from all tiers"""
+        self.memory.delete(key)
+        if self.disk is not None:
+            self.disk.delete(key)
+
+    def clear(self) -> None:
+        """Remove all values from all tiers"""
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def to_dict(self) -> dict:
+        """Get the counters of the cache and its tiers"""
+        return {
+            **self.stats.to_dict(),
+            "memory": self.memory.stats.to_dict(),
+            "disk": self.disk.stats.to_dict() if self.disk is not None else None
+        }
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into a single call whose result all callers share"""
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.calls = {}     # key -> Future of the running call
+        self.coalesced = 0
+
+    def do(self, key: str, func, *args, **kwargs):
+        """Call func, or wait for the result of the call already running for key"""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return call.result()
+
+        try:
+            result = func(*args, **kwargs)
+            call.set_result(result)
+            return result
+        except BaseException as e:
+            call.set_exception(e)   # Let the waiting callers see the same error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+def create_cache(name: str, max_entries: int, ttl: float, sqlite_path: str = "",
+                 sqlite_max_entries: int = 100_000) -> TieredCache:
+    """Create a tiered cache, with a SQLite tier only if a path is given"""
+    disk = SQLiteCache(sqlite_path, max_entries=sqlite_max_entries, ttl=ttl,
+                       table=f"{name.lower()}_cache") if sqlite_path else None
+    return TieredCache(name, MemoryCache(max_entries=max_entries, ttl=ttl), disk)
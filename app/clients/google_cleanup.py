@@ -0,0 +1,126 @@
+"""Deletion of the Google Docs uploaded for OCR, off the request path"""
+
+import os
+import time
+import queue
+import threading
+from datetime import datetime, timedelta, timezone
+from app.config import GOOGLE
+from app.metrics import METRICS
+from app.auto_logging import AutoLogger
+
+UPLOAD_TAG = ("simple_onboarding", "ocr")   # appProperties key and value of every uploaded file
+
+
+class DriveCleanup:
+    """Deletes uploaded files in batched Drive requests from a background thread, which also sweeps
+    tagged files older than GOOGLE.orphan_age left behind by failed deletes or crashed workers"""
+    def __init__(self, google_client) -> None:
+        self.google_client = google_client    # For its Drive service and this thread's transport
+        self.logger = AutoLogger("DriveCleanup")
+        self.deleted = 0
+        self.reset()
+        os.register_at_fork(after_in_child=self.reset)     # Threads and held locks don't survive a fork
+
+    def reset(self) -> None:
+        """Forget the queue and the cleanup thread, which is started again on the next use"""
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.thread_pid = None
+
+    def delete(self, file_id: str) -> None:
+        """Queue a file for deletion"""
+        self.start()
+        self.queue.put(file_id)
+
+    def start(self) -> None:
+        """Start the cleanup thread of this process, if it isn't running"""
+        if self.thread_pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread_pid != os.getpid():
+                self.thread = threading.Thread(target=self.run, name="drive-cleanup", daemon=True)
+                self.thread.start()
+                self.thread_pid = os.getpid()
+
+    def stop(self, timeout: float = 5) -> None:
+        """Stop the cleanup thread after deleting the queued files"""
+        self.stopped.set()
+        if self.thread is not None and self.thread_pid == os.getpid():
+            self.thread.join(timeout)
+
+    def run(self) -> None:
+        """Delete queued files in batches and sweep orphans periodically until stopped"""
+        next_sweep = 0.0    # Sweep right away, a restart may have left files behind
+        while True:
+            if not self.stopped.is_set() and time.monotonic() >= next_sweep:
+                self.sweep()
+                next_sweep = time.monotonic() + GOOGLE.sweep_interval
+            batch = self.collect()
+            if batch:
+                self.delete_batch(batch)
+            elif self.stopped.is_set():
+                return
+
+    def collect(self) -> list[str]:
+        """Wait for a queued file, then for up to GOOGLE.cleanup_delay more, returns at most a batch"""
+        try:
+            batch = [self.queue.get(timeout=0.1 if self.stopped.is_set() else 1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + (0 if self.stopped.is_set() else GOOGLE.cleanup_delay)
+        while len(batch) < GOOGLE.cleanup_batch_size:
+            try:
+                batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def delete_batch(self, file_ids: list[str]) -> None:
+        """Delete files with a single batch request, the sweeper retries those that failed"""
+        file_ids = list(dict.fromkeys(file_ids))    # The sweeper may queue a file again, ids must be unique
+        failed = []
+
+        def deleted(request_id: str, response, exception) -> None:
+            if exception is not None and getattr(getattr(exception, "resp", None), "status", None) != 404:
+                failed.append((request_id, exception))
+
+        try:
+            drive_service = self.google_client.drive_service
+            batch = drive_service.new_batch_http_request(callback=deleted)
+            for file_id in file_ids:
+                batch.add(drive_service.files().delete(fileId=file_id), request_id=file_id)
+            with METRICS.upstream("google", "delete_batch"):
+                batch.execute(http=self.google_client.authorized_http())
+        except Exception as e:     # Left for the sweeper
+            self.logger.warn(f"Deleting {len(file_ids)} google files failed: {e}")
+            return
+        self.deleted += len(file_ids) - len(failed)
+        for file_id, exception in failed:
+            self.logger.warn(f"Deleting google file {file_id} failed: {exception}")
+        self.logger.debug(f"Deleted {len(file_ids) - len(failed)} google files")
+
+    def sweep(self) -> None:
+        """Queue the tagged files older than GOOGLE.orphan_age for deletion"""
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=GOOGLE.orphan_age)
+        query = (f"appProperties has {{ key='{UPLOAD_TAG[0]}' and value='{UPLOAD_TAG[1]}' }} "
+                 f"and createdTime < '{cutoff.strftime('%Y-%m-%dT%H:%M:%S')}'")
+        orphans, page_token = 0, None
+        try:
+            while True:
+                with METRICS.upstream("google", "list"):
+                    response = self.google_client.drive_service.files().list(
+                        q=query, fields="nextPageToken, files(id)", pageSize=1000, pageToken=page_token
+                    ).execute(http=self.google_client.authorized_http())
+                for file in response.get("files", []):
+                    self.queue.put(file["id"])
+                    orphans += 1
+                page_token = response.get("nextPageToken")
+                if not page_token:
+                    break
+        except Exception as e:     # Tried again on the next sweep
+            self.logger.warn(f"Sweeping orphaned google files failed: {e}")
+        if orphans:
+            self.logger.info(f"Found {orphans} orphaned google files to delete")
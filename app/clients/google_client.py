@@ -2,16 +2,24 @@
 
 import os
 import io
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
+import json
+import threading
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
+from google.auth.exceptions import GoogleAuthError
 from googleapiclient.discovery import build, MediaFileUpload
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseUpload
 from app.clients.base_client import BaseClient
+from app.clients.google_credentials import GoogleCredentialManager, SCOPES
+from app.clients.google_cleanup import DriveCleanup, UPLOAD_TAG
 from app.responses import ClientResponse
-from app.config import CREDENTIALS
+from app.config import CREDENTIALS, GOOGLE
+from app.metrics import METRICS
 from app.auto_logging import AutoLogger
 
+GOOGLE_ERRORS = (HttpError, GoogleAuthError, httplib2.HttpLib2Error, OSError)  # API, credential and network errors
+
 
 class GoogleClient(BaseClient):
     """GoogleClient class to handle Google Drive and Docs operations."""
@@ -19,85 +27,108 @@ class GoogleClient(BaseClient):
         super().__init__()
         self.token = token
         self.credentials = credentials
-        self.SCOPES = [                                # Google API scopes for Drive and Docs
-            'https://www.googleapis.com/auth/drive',
-            'https://www.googleapis.com/auth/documents.readonly'
-        ]
+        self.SCOPES = SCOPES
         self.logger = AutoLogger("GoogleClient")
         self.logger.info("Initializing google client")
+        self.services_lock = threading.Lock()
+        self.services_generation = 0
+        self.drive_service, self.docs_service = None, None
+        self.local = threading.local()     # Holds each thread's HTTP transport
+        self.cleanup = DriveCleanup(self)   # Deletes the uploaded docs in the background
         self.authenticate()
 
     def authenticate(self) -> None:
-        """Authenticate the Google client using OAuth2 credentials."""
-        if self.token: # Create credentials from token
-            self.credentials = Credentials.from_authorized_user_info(self.token, self.SCOPES)
-            self.logger.debug("Created google credentials from token")
-        else:
-            self.logger.warn("Found no google token")
-
-        if not self.credentials or not self.credentials.valid:
-            if self.credentials and self.credentials.expired and self.credentials.refresh_token:
-                self.logger.debug("Refreshing google credentials")
-                self.credentials.refresh(Request()) # Refresh the credentials if expired
-            else:
-                self.logger.warn("Opening browser session for manual authorization")
-                flow = InstalledAppFlow.from_client_secrets_file("credentials/google_secret.json",
-                                                                 scopes=self.SCOPES)
-
-                # Open the browser on an authentication prompt, offline and consent are required 
-                # for getting a refresh_token
-                self.credentials = flow.run_local_server(port=0, access_type="offline",
-                                                         prompt="consent")
-
-            CREDENTIALS.google_token = self.credentials.to_json()   # Update google token
-            self.logger.debug("Succesfully updated google token globally")
+        """Authenticate the Google client using OAuth2 credentials, which are kept fresh in the background"""
+        token = self.token or (self.credentials.to_json() if self.credentials else None)
+        self.credential_manager = GoogleCredentialManager(token, self.SCOPES)
+        self.credential_manager.listeners.append(self.use_credentials)
+        self.use_credentials(self.credential_manager.get())    # Only refreshes an expired token
+        self.logger.debug("Created google credentials from token")
+
+    def use_credentials(self, credentials) -> None:
+        """Switch to new credentials, called by the credential manager after each refresh"""
+        CREDENTIALS.google_token = json.loads(credentials.to_json())   # Update google token
+        self.build_services(credentials)   # (Re)build the services for the new credentials
+
+    def build_services(self, credentials) -> None:
+        """Build the Drive and Docs services from the bundled static discovery documents and swap them
+        in together with their credentials"""
+        drive_service = build('drive', 'v3', credentials=credentials,
+                              static_discovery=True, cache_discovery=False)
+        docs_service = build('docs', 'v1', credentials=credentials,
+                             static_discovery=True, cache_discovery=False)
+        with self.services_lock:
+            self.credentials = credentials
+            self.drive_service, self.docs_service = drive_service, docs_service
+            self.services_generation += 1   # Invalidate the transports of the old credentials
+        self.logger.debug("Built google drive and docs services")
+
+    def authorized_http(self) -> AuthorizedHttp:
+        """Return the calling thread's authorized HTTP transport, 
+        since httplib2 transports must not be shared between threads"""
+        self.credential_manager.get()   # Starts this process' refresh thread, waits only for expired credentials
+        if getattr(self.local, "generation", None) != self.services_generation:
+            with self.services_lock:    # Credentials and generation of the same refresh
+                self.local.http = AuthorizedHttp(self.credentials, http=httplib2.Http())
+                self.local.generation = self.services_generation
+        return self.local.http
+
+    def close(self) -> None:
+        """Delete the queued docs and stop refreshing the credentials"""
+        self.cleanup.stop()
+        self.credential_manager.stop()
+
+    def upload(self, file_metadata: dict, media) -> str:
+        """Create a Google Doc from an upload tagged for the cleanup, in chunks if the upload is resumable,
+        and return the document ID."""
+        file_metadata['appProperties'] = {UPLOAD_TAG[0]: UPLOAD_TAG[1]}   # Lets the sweeper find orphans
+        request = self.drive_service.files().create(    # Create the file in Google Drive
+            body=file_metadata,
+            media_body=media,
+            fields='id'
+        )
+        with METRICS.upstream("google", "upload"):
+            if not media.resumable():
+                return request.execute(http=self.authorized_http()).get('id')
+
+            http, file = self.authorized_http(), None
+            while file is None:     # A failed chunk is retried instead of uploading the whole file again
+                _, file = request.next_chunk(http=http, num_retries=GOOGLE.upload_retries)
+        return file.get('id') # Return the file ID of the uploaded document
 
     def upload_pdf(self, file_path: str) -> str:
         """Upload a PDF file to Google Drive, convert it to a Google Doc 
         and return the document ID."""
-        drive_service = build('drive', 'v3', credentials=self.credentials) # Build the Drive service
-
         file_metadata = {                           # Metadata for the file to be uploaded
             'name': os.path.basename(file_path),
             'mimeType': 'application/vnd.google-apps.document' # Converts PDF to Google Doc
         }
-        media = MediaFileUpload(file_path, mimetype='application/pdf') # Media file upload object
-
-        file = drive_service.files().create(    # Create the file in Google Drive
-            body=file_metadata,
-            media_body=media,
-            fields='id'
-        ).execute()
-
-        return file.get('id') # Return the file ID of the uploaded document
+        media = MediaFileUpload(file_path, mimetype='application/pdf',   # Media file upload object
+                                chunksize=GOOGLE.upload_chunk_size,
+                                resumable=os.path.getsize(file_path) > GOOGLE.upload_chunk_size)
+        return self.upload(file_metadata, media)
     
     def upload_pdf_stream(self, file_stream: io.BytesIO) -> str:
         """Upload a PDF file stream to Google Drive, convert it to a Google Doc and return the document ID."""
-        drive_service = build('drive', 'v3', credentials=self.credentials) # Build the Drive service
-
         file_metadata = {            # Metadata for the file to be uploaded
             'name': 'Uploaded PDF',
             'mimeType': 'application/vnd.google-apps.document' # Converts PDF to Google Doc
         }
-        media = MediaIoBaseUpload(file_stream, mimetype='application/pdf') # Media file upload object
-
-        file = drive_service.files().create( # Create the file in Google Drive
-            body=file_metadata,
-            media_body=media,
-            fields='id'
-        ).execute()
-
-        return file.get('id') # Return the file ID of the uploaded document
+        size = file_stream.seek(0, io.SEEK_END)
+        file_stream.seek(0)
+        media = MediaIoBaseUpload(file_stream, mimetype='application/pdf',  # Media file upload object
+                                  chunksize=GOOGLE.upload_chunk_size, resumable=size > GOOGLE.upload_chunk_size)
+        return self.upload(file_metadata, media)
 
     def delete_file(self, doc_id: str) -> None:
         """Delete a file from docs by id"""
-        drive_service = build('drive', 'v3', credentials=self.credentials) # Build the Drive service
-        drive_service.files().delete(fileId=doc_id).execute() # Delete the document by ID
+        with METRICS.upstream("google", "delete"):
+            self.drive_service.files().delete(fileId=doc_id).execute(http=self.authorized_http()) # Delete the document by ID
 
     def extract_text_from_doc(self, doc_id: str) -> str:
         """Extract text from a Google Doc by its document ID."""
-        docs_service = build('docs', 'v1', credentials=self.credentials) # Build the Docs service
-        doc = docs_service.documents().get(documentId=doc_id).execute() # Get the document by ID
+        with METRICS.upstream("google", "get_doc"):
+            doc = self.docs_service.documents().get(documentId=doc_id).execute(http=self.authorized_http()) # Get the document by ID
 
         text = ''
         for content in doc.get('body').get('content'):
@@ -114,9 +145,15 @@ class GoogleClient(BaseClient):
           converting it to a Google Doc, and extracting the text."""
         try:
             doc_id = self.upload_pdf(file_path)
-            text = self.extract_text_from_doc(doc_id)
-            self.delete_file(doc_id)
-        except:
+            try:
+                text = self.extract_text_from_doc(doc_id)
+            finally:
+                self.cleanup.delete(doc_id)     # Deleted in the background, even if extracting failed
+        except GOOGLE_ERRORS as e:
+            self.logger.warn(f"OCR of {file_path} failed: {e}")
+            return ""
+        except Exception as e:     # Unexpected, but a failed OCR must not fail the request
+            self.logger.warn(f"OCR of {file_path} failed unexpectedly: {type(e).__name__}: {e}")
             return ""
         return text
 
@@ -124,10 +161,16 @@ class GoogleClient(BaseClient):
         """Extract text from a PDF file stream."""
         try:
             doc_id = self.upload_pdf_stream(file_stream)
-            text = self.extract_text_from_doc(doc_id)
-            self.delete_file(doc_id)
-        except:
-            return ClientResponse(status_code=400, message="Something went wrong", data={})
+            try:
+                text = self.extract_text_from_doc(doc_id)
+            finally:
+                self.cleanup.delete(doc_id)     # Deleted in the background, even if extracting failed
+        except GOOGLE_ERRORS as e:
+            self.logger.warn(f"OCR failed: {e}")
+            return ClientResponse(status_code=400, message=f"OCR failed: {e}", data={})
+        except Exception as e:     # Unexpected, but a failed OCR must not fail the request
+            self.logger.warn(f"OCR failed unexpectedly: {type(e).__name__}: {e}")
+            return ClientResponse(status_code=400, message="OCR failed", data={})
         #Format text since OCR may return text looking like "Stutt g a rt" or "Stutt o art" instead of "Stuttgart"
         #Somehow extract relevant information from the text if used standalone
         return ClientResponse(status_code=200, message="Extracted text from PDF", data={"text": text})
\ No newline at end of file
@@ -0,0 +1,120 @@
+"""Google OAuth credentials kept fresh in the background"""
+
+import os
+import json
+import argparse
+import threading
+from datetime import datetime, timezone
+from google.auth.exceptions import GoogleAuthError
+from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request
+from app.config import GOOGLE
+from app.auto_logging import AutoLogger
+
+SCOPES = [                                # Google API scopes for Drive and Docs
+    'https://www.googleapis.com/auth/drive',
+    'https://www.googleapis.com/auth/documents.readonly'
+]
+
+
+class GoogleAuthorizationRequired(GoogleAuthError):
+    """Raised when there is no token to refresh, run python -m app.clients.google_credentials to get one"""
+
+
+class GoogleCredentialManager:
+    """Refreshes the google credentials in a background thread before they expire, one refresh at a time,
+    so requests always find valid credentials and never wait for a refresh"""
+    def __init__(self, token: dict | str, scopes: list[str] = SCOPES,
+                 refresh_margin: float = GOOGLE.refresh_margin, retry_interval: float = GOOGLE.refresh_retry) -> None:
+        if not token:
+            raise GoogleAuthorizationRequired("Found no google token")
+        info = json.loads(token) if isinstance(token, str) else token
+        self.scopes = scopes
+        self.credentials = Credentials.from_authorized_user_info(info, scopes)
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.listeners = []     # Called with the new credentials after each refresh
+        self.logger = AutoLogger("GoogleCredentials")
+        self.reset()
+        os.register_at_fork(after_in_child=self.reset)     # Threads and held locks don't survive a fork
+
+    def reset(self) -> None:
+        """Forget the refresh thread, which is started again on the next use"""
+        self.lock = threading.Lock()    # Serializes refreshes
+        self.thread_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.thread_pid = None
+
+    def seconds_left(self) -> float:
+        """Seconds until the current credentials expire, 0 if they have no token yet"""
+        credentials = self.credentials
+        if not credentials.token or credentials.expiry is None:
+            return 0 if not credentials.token else float("inf")
+        expiry = credentials.expiry.replace(tzinfo=timezone.utc)    # google-auth uses naive UTC times
+        return max(0.0, (expiry - datetime.now(timezone.utc)).total_seconds())
+
+    def refresh(self) -> Credentials:
+        """Refresh the credentials unless they are valid for longer than the margin (another thread may
+        have just refreshed them), returns the current credentials"""
+        with self.lock:
+            if self.seconds_left() > self.refresh_margin:
+                return self.credentials
+            if not self.credentials.refresh_token:
+                raise GoogleAuthorizationRequired("The google token has no refresh token")
+            credentials = Credentials.from_authorized_user_info(   # A copy, requests keep using the old one
+                json.loads(self.credentials.to_json()), self.scopes)
+            credentials.refresh(Request())
+            self.credentials = credentials
+            self.logger.debug(f"Refreshed google credentials, valid until {credentials.expiry}")
+            for listener in self.listeners:
+                listener(credentials)
+        return credentials
+
+    def get(self) -> Credentials:
+        """Get the current credentials, refreshing them first only if they aren't valid at all"""
+        self.start()
+        if self.seconds_left() <= 0:    # Only before the first refresh or if the refresh thread keeps failing
+            return self.refresh()
+        return self.credentials
+
+    def start(self) -> None:
+        """Start the refresh thread of this process, if it isn't running"""
+        if self.thread_pid == os.getpid():
+            return
+        with self.thread_lock:
+            if self.thread_pid != os.getpid():
+                self.thread = threading.Thread(target=self.keep_fresh, name="google-credentials", daemon=True)
+                self.thread.start()
+                self.thread_pid = os.getpid()
+
+    def stop(self) -> None:
+        """Stop the refresh thread"""
+        self.stopped.set()
+
+    def keep_fresh(self) -> None:
+        """Refresh the credentials shortly before they expire until stopped"""
+        wait = self.seconds_left() - self.refresh_margin
+        while not self.stopped.wait(max(wait, 0)):
+            try:
+                self.refresh()
+                wait = max(self.seconds_left() - self.refresh_margin, self.retry_interval)  # Short-lived tokens
+            except Exception as e:  # Requests keep using the current credentials while they last
+                self.logger.warn(f"Refreshing google credentials failed, retrying in {self.retry_interval}s: {e}")
+                wait = self.retry_interval
+
+
+def authorize(secrets_path: str, scopes: list[str] = SCOPES) -> str:
+    """Authorize the app in the browser once, returns the token JSON with a refresh token"""
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    flow = InstalledAppFlow.from_client_secrets_file(secrets_path, scopes=scopes)
+    # Offline and consent are required for getting a refresh_token
+    credentials = flow.run_local_server(port=0, access_type="offline", prompt="consent")
+    return credentials.to_json()
+
+
+if __name__ == "__main__":   # Get a token for GOOGLE_TOKEN: python -m app.clients.google_credentials
+    parser = argparse.ArgumentParser(description="Authorize the google account in the browser and print the "
+                                                 "token to set as GOOGLE_TOKEN")
+    parser.add_argument("--secrets", default="credentials/google_secret.json", help="Client secrets file")
+    print(authorize(parser.parse_args().secrets))
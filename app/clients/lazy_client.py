@@ -0,0 +1,46 @@
+"""Client proxy building the client on first use"""
+
+import time
+import threading
+from app.auto_logging import AutoLogger
+
+logger = AutoLogger("LazyClient")
+
+
+class LazyClient:
+    """Stands in for a client and builds it on first use, so importing and authenticating
+    the client doesn't delay the startup (the proxy's own attributes start with _)"""
+    def __init__(self, name: str, factory) -> None:
+        self._name = name
+        self._factory = factory     # Imports and creates the client
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """Get the client, building it if necessary, a failed build is retried on the next use"""
+        client = self._client
+        if client is None:
+            with self._lock:    # Only one thread builds the client
+                if self._client is None:
+                    started = time.perf_counter()
+                    self._client = self._factory()
+                    logger.info(f"Created the {self._name} client in {time.perf_counter() - started:.2f}s")
+                client = self._client
+        return client
+
+    @property
+    def _loaded(self) -> bool:
+        """Check if the client was built already"""
+        return self._client is not None
+
+    def __getattr__(self, name: str):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name: str, value) -> None:
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._load(), name, value)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
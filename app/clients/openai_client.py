@@ -2,21 +2,41 @@
 
 import io
 import json
-from openai import OpenAI, RateLimitError
+import time
+import random
+from email.utils import parsedate_to_datetime
+from openai import OpenAI, RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
 from app.clients.base_client import BaseClient
 from app.util import extract_text_from_pdf
 from app.responses import ClientResponse, APIResponse
 from app.company_data import CompanyData
-from app.config import OPENAI_RESPONSE_FORMAT
+from app.config import OPENAI_RESPONSE_FORMAT, PROMPT, OPENAI_LIMITS
+from app.prompting import PromptStats, TokenCounter, prepare_prompt
+from app.rate_limit import AdmissionTimeout, create_rate_limiter
+from app.metrics import METRICS
 from app.auto_logging import AutoLogger
 
+SYSTEM_PROMPT = """You are a data analyst.
+                                                    Extract all wanted information from the text, 
+                                                    translate to English if necessary, and respond 
+                                                    exclusively in JSON. Fill any unknown field 
+                                                    with ''."""
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
 
 class OpenAIClient(BaseClient):
     """OpenAI API client class"""
     def __init__(self, token: str):
         super().__init__()
-        self.client = OpenAI(api_key=token)
+        self.client = OpenAI(api_key=token, timeout=OPENAI_LIMITS.request_timeout,
+                             max_retries=0)   # Retries are scheduled by create_completion
         self.JSON_SCHEMA = OPENAI_RESPONSE_FORMAT
+        self.model = PROMPT.model
+        self.count_tokens = TokenCounter(self.model)
+        self.prompt_stats = PromptStats()
+        self.rate_limiter = create_rate_limiter(OPENAI_LIMITS.requests_per_minute, OPENAI_LIMITS.tokens_per_minute,
+                                                OPENAI_LIMITS.state_path)
+        self.system_tokens = self.count_tokens(SYSTEM_PROMPT)
         self.logger = AutoLogger("OpenAIClient")
         self.logger.info("Initializing OpenAI client")
         self.authenticate()
@@ -25,43 +45,98 @@ class OpenAIClient(BaseClient):
         """Authenticate the OpenAI client using the provided API key."""
         # No additional authentication needed for OpenAI client
 
+    def build_request_body(self, file_text: str) -> tuple[dict, int]:
+        """Prepare the prompt and the chat completion request for a document, returns the request body
+        and its prompt token count"""
+        prompt, tokens_in, tokens_sent = prepare_prompt(file_text, PROMPT.token_budget, self.count_tokens)
+        self.prompt_stats.record(tokens_in, tokens_sent)
+        self.logger.debug(f"Prepared prompt of {tokens_sent} tokens from {tokens_in} tokens of text")
+        body = {
+            # response_format* does not work on gpt-3.5, gpt-3.5-turb0, etc.
+            "model": self.model,
+            "messages": [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": prompt}],
+            "response_format": self.JSON_SCHEMA #<- *
+        }
+        return body, self.system_tokens + tokens_sent
+
     def extract_and_format(self, file_text: str) -> APIResponse:
         """Process the PDF text with OpenAI's GPT model."""
+        body, prompt_tokens = self.build_request_body(file_text)
         try:
-            response = self.client.chat.completions.create(
-                # response_format* does not work on gpt-3.5, gpt-3.5-turb0, etc.
-                model="gpt-4.1", 
-                messages=[ 
-                    {"role": "system", "content": """You are a data analyst.
-                                                    Extract all wanted information from the text, 
-                                                    translate to English if necessary, and respond 
-                                                    exclusively in JSON. Fill any unknown field 
-                                                    with ''."""
-                     },
-                    {"role": "user", "content": file_text}
-                ],
-                response_format=self.JSON_SCHEMA #<- *
-            )
+            response = self.create_completion(body, prompt_tokens)
             self.logger.debug(f"Got ChatGPT response: {response.choices[0].message.content}")
             return True, json.loads(response.choices[0].message.content)    # Return success & response pairs
+        except AdmissionTimeout:
+            self.logger.warn("OpenAI rate limit reached, no capacity within the admission timeout")
+            return False, ClientResponse(status_code=429, message="Internal rate limit exceeded").to_APIResponse()
         except RateLimitError:
             self.logger.warn("Out of OpenAI tokens")
             return False, ClientResponse(status_code=429, message="Internal rate limit exceeded").to_APIResponse()
         except Exception as e:
             return False, ClientResponse(status_code=400, message=str(e)).to_APIResponse()
-        
-    
-    def __call__(self, filestream: io.BytesIO, google_client) -> APIResponse:
-        file_text = extract_text_from_pdf(filestream, google_client)
-        if not file_text:
-            return ClientResponse(status_code=400, message="Failed to extract text from PDF").to_APIResponse() # May be raised if google client is unavailable and a scanned PDF is passed
-        
+
+    def create_completion(self, body: dict, prompt_tokens: int):
+        """Call ChatGPT within the shared rate limits, retrying rate limited and failed calls with backoff"""
+        estimate = prompt_tokens + OPENAI_LIMITS.output_tokens
+        deadline = time.monotonic() + OPENAI_LIMITS.admission_timeout
+        for attempt in range(OPENAI_LIMITS.retries + 1):
+            if not self.rate_limiter.acquire(estimate, max(deadline - time.monotonic(), 0)):
+                raise AdmissionTimeout()
+            try:
+                with METRICS.upstream("openai", "chat.completions"):
+                    response = self.client.chat.completions.create(**body)
+            except RETRYABLE_ERRORS as e:
+                if attempt == OPENAI_LIMITS.retries or getattr(e, "code", None) == "insufficient_quota":
+                    raise   # Retries exhausted or out of credits, retrying won't help
+                delay = self.retry_delay(e, attempt)
+                if deadline - time.monotonic() < delay:
+                    raise
+                if isinstance(e, RateLimitError):   # Hold back the other workers as well
+                    self.rate_limiter.pause(delay)
+                self.logger.info(f"Retrying OpenAI request in {delay:.1f}s after {type(e).__name__}")
+                time.sleep(delay)
+                continue
+            if response.usage is not None:  # Charge the actual instead of the estimated tokens
+                self.rate_limiter.adjust(response.usage.total_tokens - estimate)
+                METRICS.openai_tokens.inc("prompt", amount=response.usage.prompt_tokens)
+                METRICS.openai_tokens.inc("completion", amount=response.usage.completion_tokens)
+            return response
+
+    def retry_delay(self, error: Exception, attempt: int) -> float:
+        """Seconds to wait before the next attempt, as asked by Retry-After or exponential backoff with jitter"""
+        response = getattr(error, "response", None)
+        headers = response.headers if response is not None else {}
+        try:
+            if "retry-after-ms" in headers:
+                return float(headers["retry-after-ms"]) / 1000
+            if "retry-after" in headers:
+                retry_after = headers["retry-after"]
+                if retry_after.replace(".", "", 1).isdigit():
+                    return float(retry_after)
+                return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0)  # HTTP date
+        except (ValueError, TypeError):
+            pass
+        delay = min(OPENAI_LIMITS.backoff_max, OPENAI_LIMITS.backoff_factor * 2 ** attempt)
+        return random.uniform(delay / 2, delay)     # Jitter spreads out the retries of concurrent callers
+
+    def process_text(self, file_text: str) -> APIResponse:
+        """Extract the company data from already extracted PDF text"""
         success, response = self.extract_and_format(file_text) # Call ChatGPT
+        return self.build_response(success, response)
 
+    def build_response(self, success: bool, response) -> APIResponse:
+        """Turn the result of a ChatGPT call into the API response"""
         if not success:
             return response # Return the error-APIResponse (something went wrong on our side)
 
         if not response["success"]: # ChatGPT says it couldn't find anything
-            return response
+            return ClientResponse(status_code=400, message="Found no company data in the PDF").to_APIResponse()
+
+        return ClientResponse(status_code=200, message="Data processed successfully", data=CompanyData.from_chatgpt(data=response["data"])).to_APIResponse()
+
+    def __call__(self, filestream: io.BytesIO, google_client) -> APIResponse:
+        file_text = extract_text_from_pdf(filestream, google_client)
+        if not file_text:
+            return ClientResponse(status_code=400, message="Failed to extract text from PDF").to_APIResponse() # May be raised if google client is unavailable and a scanned PDF is passed
 
-        return ClientResponse(status_code=200, message="Data processed successfully", data=CompanyData.from_chatgpt(response["data"])).to_APIResponse()
\ No newline at end of file
+        return self.process_text(file_text)
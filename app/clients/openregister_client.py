@@ -1,48 +1,180 @@
 """Openregister/Handelsregister API Client class"""
 
+import contextvars
+import json
+import time
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, wait
 import requests
-from rapidfuzz.fuzz import ratio    # Used to determine similarity in strings
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPSConnectionPool
+from urllib3.exceptions import EmptyPoolError
+from urllib3.util.retry import Retry
 from app.clients.base_client import BaseClient
-from app.util import validate_german_company_id_format
+from app.util import validate_german_company_id_format, normalize_company_name, rank_by_name
 from app.company_data import CompanyData
+from app.cache import MISSING, SingleFlight, create_cache
+from app.register_index import RegisterIndex
+from app.config import OPENREGISTER, CACHE, REGISTER_INDEX
+from app.metrics import METRICS
 from app.auto_logging import AutoLogger
 
+
+class CappedRetry(Retry):
+    """Retry that waits at most OPENREGISTER.retry_after_max seconds, whatever Retry-After asks for"""
+    def get_retry_after(self, response) -> float | None:
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, OPENREGISTER.retry_after_max)
+
+
+class BoundedWaitPool(HTTPSConnectionPool):
+    """Blocking connection pool that waits at most OPENREGISTER.pool_timeout seconds for a free connection"""
+    def _get_conn(self, timeout: float | None = None):
+        return super()._get_conn(timeout if timeout is not None else OPENREGISTER.pool_timeout)
+
+
+class BoundedWaitAdapter(HTTPAdapter):
+    """HTTPAdapter with BoundedWaitPools, raising a ConnectionError when no connection got free in time"""
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {**self.poolmanager.pool_classes_by_scheme,
+                                                   "https": BoundedWaitPool}
+
+    def send(self, request, *args, **kwargs) -> requests.Response:
+        try:
+            return super().send(request, *args, **kwargs)
+        except EmptyPoolError as e:     # requests passes it through as is, not as a RequestException
+            raise requests.ConnectionError(e, request=request) from e
+
+
 class OpenregisterClient(BaseClient):
     """Openregister/Handelsregister APi client class"""
-    def __init__(self, token: str):
+    def __init__(self, token: str, cache=None, register_index: RegisterIndex = None):
         super().__init__()
         self.token = token
         self.logger = AutoLogger("OpenregisterClient")
         self.logger.info("Initializing openregister client")
+        self.session = self.create_session()
+        self.cache = cache if cache is not None else create_cache(   # Any object with get/set works
+            "Openregister", max_entries=CACHE.openregister_max_entries, ttl=CACHE.openregister_ttl,
+            sqlite_path=CACHE.openregister_sqlite_path,
+            sqlite_max_entries=CACHE.openregister_sqlite_max_entries)
+        self.register_index = register_index    # Answers searches locally before asking the API
+        if register_index is None and REGISTER_INDEX.path:
+            self.register_index = RegisterIndex(REGISTER_INDEX.path)
+        self.single_flight = SingleFlight()
+        self.out_of_credits_until = 0
+        self.fanout_pool = ThreadPoolExecutor(max_workers=OPENREGISTER.pool_size,
+                                              thread_name_prefix="openregister-fanout")
+        self.company_endpoints = {  # Independent per-company lookups, requested concurrently
+            "details": self.get_company_details,
+            "owners": self.get_company_owners
+        }
         self.authenticate()
 
     def authenticate(self):
         """No additional authentication required"""
         return
 
-    def make_openregister_request(self, url: str, 
-                                  method: str = "GET", 
-                                  params: dict = None, 
-                                  body: dict = None) -> dict:
-        """Call the Openregister API with given method and parameters"""
-        params = params if params is not None else {}
-        body = body if body is not None else {}
-        headers = {
+    def create_session(self) -> requests.Session:
+        """Create a pooled keep-alive session retrying 429/5xx with jittered exponential backoff"""
+        retry = CappedRetry(
+            total=OPENREGISTER.retries,
+            backoff_factor=OPENREGISTER.backoff_factor,
+            backoff_jitter=OPENREGISTER.backoff_jitter,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({"GET", "POST"}),     # Search is a POST but has no side effects
+            respect_retry_after_header=True,
+            raise_on_status=False                           # Hand the last response back instead of raising
+        )
+        adapter = BoundedWaitAdapter(pool_connections=1, pool_maxsize=OPENREGISTER.pool_size,
+                                     max_retries=retry, pool_block=True)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.headers.update({
             "Authorization": f"Bearer {self.token}",
             "Accept": "application/json"
-        }
+        })
+        self.logger.debug(f"Created openregister session with pool size {OPENREGISTER.pool_size}")
+        return session
+
+    def close(self) -> None:
+        """Close the pooled connections and the fan-out pool"""
+        self.fanout_pool.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+    def request(self, url: str, 
+                method: str = "GET", 
+                params: dict = None, 
+                body: dict = None,
+                timeout: float = None) -> tuple[int, dict]:
+        """Call the Openregister API, returns the status code (0 if the call failed) and data"""
+        params = params if params is not None else {}
+        body = body if body is not None else {}
+        timeout = timeout if timeout is not None else OPENREGISTER.timeout
+
+        if time.time() < self.out_of_credits_until:     # Don't burn requests while out of credits
+            self.logger.debug(f"Skipping request to {url}, out of openregister tokens")
+            return 402, {}
 
         res = requests.Response()
-        if method.lower() == "get":
-            self.logger.debug(f"Getting {url} using headers: {headers}, body: {body}, params: {params}")
-            res = requests.get(url, headers=headers, timeout=10)
-        elif method.lower() == "post":
-            self.logger.debug(f"Posting headers: {headers}, body: {body}, params: {params} to {url}")
-            res = requests.post(url, params=params, headers=headers, json=body, timeout=10)
+        with METRICS.upstream("openregister", self.operation(url)) as call:
+            try:
+                if method.lower() == "get":
+                    self.logger.debug(f"Getting {url} using body: {body}, params: {params}")
+                    res = self.session.get(url, params=params, timeout=timeout)
+                elif method.lower() == "post":
+                    self.logger.debug(f"Posting body: {body}, params: {params} to {url}")
+                    res = self.session.post(url, params=params, json=body, timeout=timeout)
+            except requests.RequestException as e:
+                call["outcome"] = type(e).__name__
+                self.logger.warn(f"Openregister request to {url} failed: {e}")
+                return 0, {}
+            call["outcome"] = str(res.status_code)
         self.logger.debug(f"Got response code {res.status_code}")
         if res.status_code == 402:
-            self.logger.warn("Out of openregister tokens")
-        return res.json() if res.ok else {}
+            self.logger.warn(f"Out of openregister tokens, pausing requests for {OPENREGISTER.credit_cooldown}s")
+            self.out_of_credits_until = time.time() + OPENREGISTER.credit_cooldown
+        return res.status_code, res.json() if res.ok else {}
+
+    @staticmethod
+    def operation(url: str) -> str:
+        """Name the endpoint of a URL for the metrics, like company/{id}/owners"""
+        parts = urlparse(url).path.split("/")[2:]   # After /v1
+        if len(parts) > 1 and parts[0] == "company":
+            parts[1] = "{id}"   # One label per endpoint, not per company
+        return "/".join(parts)
+
+    def make_openregister_request(self, url: str, 
+                                  method: str = "GET", 
+                                  params: dict = None, 
+                                  body: dict = None,
+                                  timeout: float = None) -> dict:
+        """Call the Openregister API with given method and parameters"""
+        return self.request(url, method, params, body, timeout)[1]
+
+    def cached_request(self, key: str, url: str, method: str = "GET", body: dict = None,
+                       index_results: bool = False) -> dict:
+        """Call the Openregister API through the cache, coalescing concurrent calls for the same key"""
+        data = self.cache.get(key, MISSING)
+        if data is not MISSING:
+            return data
+        return self.single_flight.do(key, self.fetch_and_cache, key, url, method, body, index_results)
+
+    def fetch_and_cache(self, key: str, url: str, method: str = "GET", body: dict = None,
+                        index_results: bool = False) -> dict:
+        """Call the Openregister API and cache found and not found results with their own TTL,
+        adding the found companies to the register index if index_results is set"""
+        status, data = self.request(url, method, body=body)
+        if status == 200 and data and data.get("results") != []:
+            self.cache.set(key, data, ttl=CACHE.openregister_ttl)
+            if index_results and self.register_index is not None and data.get("results"):
+                self.update_index(data["results"])  # Only fresh answers, cached reads don't write
+        elif status == 404 or (status == 200 and not data.get("results", True)):
+            self.cache.set(key, {}, ttl=CACHE.openregister_negative_ttl)    # Remember "not found"
+            data = {}
+        return data     # Errors like 402, 429 or 5xx are not cached
 
     def search_companies(self, company_name: str = None, 
                          register_number: int = None, 
@@ -50,8 +182,10 @@ class OpenregisterClient(BaseClient):
                          register_court: str = None, 
                          active: bool = True, 
                          legal_form: str = None,
-                         address: str = None) -> dict:
-        """Search all german companies"""
+                         address: str = None,
+                         limit: int = OPENREGISTER.match_limit,
+                         use_index: bool = True) -> list[dict]:
+        """Search all german companies, returns the candidates ranked by name similarity with their score"""
 
 
         body = {"query":{}} # Create the query parameters
@@ -73,41 +207,118 @@ class OpenregisterClient(BaseClient):
         if address:
             body["filters"].append({"field": "address", "value":address})
 
+        if use_index and self.register_index is not None and not any([register_type, legal_form, address]):
+            companies = self.search_index(company_name, register_number, register_court, active, limit)
+            if companies:
+                self.logger.debug(f"Found {len(companies)} matching companies in the register index")
+                return companies
+
         self.logger.debug(f"Searching for company by query {body}")
-        data = self.make_openregister_request("https://api.openregister.de/v1/search/company", "POST", body=body)
-        if not data:
+        key_body = {**body, "query": {"value": normalize_company_name(company_name)}} if company_name else body
+        data = self.cached_request(f"search:{json.dumps(key_body, sort_keys=True)}",
+                                   "https://api.openregister.de/v1/search/company", "POST", body=body,
+                                   index_results=True)     # Accumulate the API's answers in the index
+        if not data or not data.get("results"):
             self.logger.debug("Search returned no data")
-            return {}
+            return []
+        if not company_name:    # Nothing to rank by, keep the API's order
+            return data["results"][:limit]
+
+        companies = self.rank_companies(company_name, data["results"], limit)
+        self.logger.debug(f"Found {len(companies)} matching companies")
+        return companies
 
-        result = {}
-        for company in data["results"]:
-            result[ratio(company["name"], company_name)] = company # Create a dict with similarity as key and company as value
+    def rank_companies(self, company_name: str, companies: list[dict], limit: int) -> list[dict]:
+        """Rank companies by the similarity of their name, returns the matches with their score"""
+        ranked = rank_by_name(company_name, [company.get("name") or "" for company in companies],
+                              limit=limit, score_cutoff=OPENREGISTER.match_cutoff)
+        return [{**companies[index], "score": score} for index, score in ranked]
+
+    def search_index(self, company_name: str, register_number, register_court: str,
+                     active: bool, limit: int) -> list[dict]:
+        """Search the local register index, returns [] on a miss (unknown, stale or no (near) exact match),
+        the index only holds what was loaded or found before, so a merely similar name may not be the company"""
+        try:
+            if register_number and register_court:
+                companies = self.register_index.find_by_register(register_court, register_number,
+                                                                 REGISTER_INDEX.max_age)
+            elif company_name:
+                companies = self.register_index.search(company_name, REGISTER_INDEX.max_age,
+                                                       REGISTER_INDEX.candidates)
+            else:
+                return []
+        except sqlite3.Error as e:     # A broken index must not break searching
+            self.logger.warn(f"Register index search failed: {e}")
+            return []
+        if active is not None:
+            companies = [company for company in companies    # Dumps may hold "true"/"false" strings
+                         if str(company.get("active", active)).lower() == str(active).lower()]
+        if not company_name:
+            return companies[:limit]
+        companies = self.rank_companies(company_name, companies, limit)
+        if register_number and register_court:     # The register entry identifies the company by itself
+            return companies
+        return companies if companies and companies[0]["score"] >= REGISTER_INDEX.min_score else []
 
-        if max(result) > 75:
-            self.logger.debug("Found a matching company")
-            return result[max(result)]
-        self.logger.debug("Didn't find a matching company")
-        return {}
+    def update_index(self, companies: list[dict]) -> None:
+        """Insert or refresh companies in the local register index"""
+        try:
+            self.register_index.load(companies)
+        except sqlite3.Error as e:
+            self.logger.warn(f"Register index update failed: {e}")
+
+    def find_company(self, company_name: str) -> dict:
+        """Find the company best matching the name, returns it or {} if none is similar enough"""
+        candidates = self.search_companies(company_name=company_name, limit=1)
+        return candidates[0] if candidates else {}
 
     def get_company_details(self, company_id: str) -> CompanyData:
         """Get basic company details"""
         self.logger.debug(f"Getting details of company {company_id}")
-        data = self.make_openregister_request(f"https://api.openregister.de/v1/company/{company_id}", "GET")
+        data = self.cached_request(f"details:{company_id}",
+                                   f"https://api.openregister.de/v1/company/{company_id}", "GET")
         return CompanyData.from_openregister_details(data=data) if data else CompanyData()
 
     def get_company_owners(self, company_id: str) -> CompanyData:
         """Get company ownership information"""
         self.logger.debug(f"Getting owners of company {company_id}")
-        data = self.make_openregister_request(f"https://api.openregister.de/v1/company/{company_id}/owners", "GET") # Use the owners endpoint instead of shareholders since the docs say to do so
+        data = self.cached_request(f"owners:{company_id}",
+                                   f"https://api.openregister.de/v1/company/{company_id}/owners", "GET") # Use the owners endpoint instead of shareholders since the docs say to do so
         return CompanyData.from_openregister_owners(data=data["owners"]) if data else CompanyData()
 
     def validate_existence(self, company_name: str, company_id: str = "") -> bool:
         """Validate that the company is registered in the german Handelsregister"""
-        companies = self.search_companies(company_name=company_name)
-        if any([company["company_id"] == company_id if company_id else True and 
-                ratio(company["name"], company_name) > 75 if company_name else True] for company in companies): # Check if any companies name is at least 75% similar with the one provided
+        candidates = self.search_companies(company_name=company_name, limit=None)  # Only similar enough names
+        if not company_id:
+            return bool(candidates)
+        if any(company["company_id"] == company_id for company in candidates):
             return True
-        return False
+        if self.register_index is None:
+            return False
+        candidates = self.search_companies(company_name=company_name, limit=None,   # The index may not know it
+                                           use_index=False)
+        return any(company["company_id"] == company_id for company in candidates)
+
+    def fetch_company(self, company_id: str, deadline: float = None) -> dict[str, CompanyData]:
+        """Query all per-company endpoints concurrently, returning whatever finished before the deadline"""
+        deadline = deadline if deadline is not None else OPENREGISTER.enrich_deadline
+        futures = {     # Every lookup gets its own copy of the context since a context can't be entered twice
+            self.fanout_pool.submit(contextvars.copy_context().run, endpoint, company_id): name
+            for name, endpoint in self.company_endpoints.items()
+        }
+        done, not_done = wait(futures, timeout=deadline)
+
+        results = {}
+        for future in done:
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                self.logger.warn(f"Openregister {futures[future]} lookup of {company_id} failed: {e}")
+        for future in not_done:     # Return partial data instead of holding the response
+            future.cancel()
+            self.logger.warn(f"Openregister {futures[future]} lookup of {company_id} missed the "
+                             f"{deadline}s deadline")
+        return results
 
     def enrich_data(self, known_data: CompanyData) -> CompanyData:
         """Retrieve and add any data there is left about the company in the Handelsregister"""
@@ -131,38 +342,23 @@ class OpenregisterClient(BaseClient):
                 return known_data
             available_params["company_name"] = known_data.company.name
 
-            company = self.search_companies(company_name=available_params["company_name"])
+            company = self.find_company(available_params["company_name"])
             if not company:
                 self.logger.debug("Could not find a mathcing company")
                 return known_data
             company_id = company["company_id"]
 
         self.logger.debug("Found company, mapping information")
-        company_data = self.get_company_details(company_id)     # Get all data on the company
-        shareholder_data = self.get_company_owners(company_id)
+        results = self.fetch_company(company_id)    # Get all data on the company
+        company_data = results.get("details", CompanyData())
+        shareholder_data = results.get("owners", CompanyData())
 
         # Map the APIs response making sure to not overwrite with None or ""
-        if shareholder_data.owners:                 known_data.owners =                     shareholder_data.owners
-        if company_data.company.city:               known_data.company.city =               company_data.company.city
-        if company_data.company.country:            known_data.company.country =            company_data.company.country
-        if company_data.company.address:            known_data.company.address =            company_data.company.address
-        if company_data.company.postal_code:        known_data.company.postal_code =        company_data.company.postal_code
-        if company_data.company.street:             known_data.company.street =             company_data.company.street
-        if company_data.company.id:                 known_data.company.id =                 company_data.company.id
-        if company_data.company.industry_codes:     known_data.company.industry_codes =     company_data.company.industry_codes
-        if company_data.company.legal_form:         known_data.company.legal_form =         company_data.company.legal_form
-        if company_data.company.name:               known_data.company.name =               company_data.company.name
-        if company_data.company.purpose:            known_data.company.purpose =            company_data.company.purpose
-        if company_data.company.register_court:     known_data.company.register_court =     company_data.company.register_court
-        if company_data.company.register_number:    known_data.company.register_number =    company_data.company.register_number
-        if company_data.company.register_type:      known_data.company.register_type =      company_data.company.register_type
-        if company_data.company.status:             known_data.company.status =             company_data.company.status
-        if company_data.capital.total_amount:       known_data.capital.total_amount =       company_data.capital.total_amount
-        if company_data.capital.currency:           known_data.capital.currency =           company_data.capital.currency
-        if company_data.capital.total_shares:       known_data.capital.total_shares =       company_data.capital.total_shares
+        known_data.merge(shareholder_data)
+        known_data.merge(company_data)
 
         return known_data
 
     def __call__(self, company_name) -> list:
-        """Search for a company by name"""
+        """Search for a company by name, returns the ranked candidates"""
         return self.search_companies(company_name)
\ No newline at end of file
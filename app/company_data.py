@@ -1,229 +1,278 @@
 """Base class for storing company data"""
 
+import operator
+from dataclasses import dataclass, field
 from app.util import calculate_completion_percentage
+from app.mapping import compile_mapping, compile_merge, compile_to_dict, encode_json, ENCODES_DATACLASSES
 
+@dataclass(slots=True)
 class CompanyData:
     """Class for holding any company data"""
+    @dataclass(slots=True)
     class Company():
         """Subclass for holding information about the company itself"""
-        def __init__(self):
-            self.country = ""
-            self.name = ""
-            self.address = ""
-            self.city = ""
-            self.postal_code = ""
-            self.street = ""
-            self.industry_codes = []
-            self.legal_form = ""
-            self.purpose = ""
-            self.id = ""
-            self.register_court = ""
-            self.register_number = ""
-            self.register_type = ""
-            self.support_phone = ""
-            self.support_email = ""
-            self.status = None
-
+        country: str = ""
+        name: str = ""
+        address: str = ""
+        city: str = ""
+        postal_code: str = ""
+        street: str = ""
+        industry_codes: list = field(default_factory=list)
+        legal_form: str = ""
+        purpose: str = ""
+        id: str = ""
+        register_court: str = ""
+        register_number: str = ""
+        register_type: str = ""
+        support_phone: str = ""
+        support_email: str = ""
+        status: str = None
+
+    @dataclass(slots=True)
     class Representatives:
         """Subclass to hold information about the representatives"""
+        @dataclass(slots=True)
         class Representative:
             """Subclass to hold information about a single representative"""
-            def __init__(self):
-                self.city = ""
-                self.country = ""
-                self.street = ""
-                self.address = ""
-                self.name = ""
-                self.role = ""
-                self.date_of_birth = ""
-                self.phone = ""
-                self.email = ""
-
-        def __init__(self):
-            self.people = []
-
+            city: str = ""
+            country: str = ""
+            street: str = ""
+            address: str = ""
+            name: str = ""
+            role: str = ""
+            date_of_birth: str = ""
+            phone: str = ""
+            email: str = ""
+
+        people: list = field(default_factory=list)
+
+    @dataclass(slots=True)
     class Owners:
         """Subclass to hold information about the company owners (>25% equity)"""
+        @dataclass(slots=True)
         class Owner:
             """Subclass to hold information about a single owner (>25% equity)"""
-            def __init__(self):
-                self.city = ""
-                self.country = ""
-                self.street = ""
-                self.address = ""
-                self.name = ""
-                self.role = ""
-                self.date_of_birth = ""
-                self.phone = ""
-                self.email = ""
-                self.shares_percentage = 0
-                self.shares_nominal = 0
-
-        def __init__(self):
-            self.people = []
-
+            city: str = ""
+            country: str = ""
+            street: str = ""
+            address: str = ""
+            name: str = ""
+            role: str = ""
+            date_of_birth: str = ""
+            phone: str = ""
+            email: str = ""
+            shares_percentage: float = 0
+            shares_nominal: float = 0
+
+        people: list = field(default_factory=list)
+
+    @dataclass(slots=True)
     class Capital:
         """Subclass to hold information about the companies capital"""
-        def __init__(self):
-            self.total_amount = 0
-            self.total_shares = 0
-            self.currency = ""
+        total_amount: float = 0
+        total_shares: float = 0
+        currency: str = ""
 
-    def __init__(self):
-        self.company = self.Company()
-        self.representatives = self.Representatives()
-        self.owners = self.Owners()
-        self.capital = self.Capital()
+    company: Company = field(default_factory=Company)
+    representatives: Representatives = field(default_factory=Representatives)
+    owners: Owners = field(default_factory=Owners)
+    capital: Capital = field(default_factory=Capital)
+    cleaned: tuple = field(default=None, init=False, repr=False, compare=False)  # People as of the last cleanup
 
     def from_chatgpt(self=None, data=None):
-        """Map ChatGPT's response to a CompanyData object 
+        """Map ChatGPT's response to a CompanyData object
         (only works with the current OPENAI_RESPONSE_FORMAT)"""
-        new_company_data = CompanyData() if not self else self
         if not data:
             return
-        new_company_data.company.name =             data["company"]["name"]
-        new_company_data.company.address =          data["company"]["address"]
-        new_company_data.company.city =             data["company"]["city"]
-        new_company_data.company.postal_code =      data["company"]["postal_code"]
-        new_company_data.company.street =           data["company"]["street"]
-        new_company_data.company.legal_form =       data["company"]["legal_form"]
-        new_company_data.company.purpose =          data["company"]["purpose"]
-        new_company_data.company.id =               data["company"]["german_company_registration_number"]
-        new_company_data.company.register_court =   data["company"]["register_court"]
-        new_company_data.company.register_number =  data["company"]["register_number"]
-        new_company_data.company.country =          data["company"]["country"]
-        new_company_data.company.register_type =    data["company"]["register_type"]
-        new_company_data.company.support_phone =    data["company"]["support_phone"]
-        new_company_data.company.support_email =    data["company"]["support_email"]
-        new_company_data.company.status =           data["company"]["status"]
-        new_company_data.company.industry_codes =   data["company"]["industry_codes"]
-
-        for person in data.get("representatives"):
-            representative = new_company_data.Representatives.Representative()
-
-            representative.city =           person["city"]
-            representative.country =        person["country"]
-            representative.street =         person["street"]
-            representative.address =        person["address"]
-            representative.name =           person["name"]
-            representative.role =           person["role"]
-            representative.date_of_birth =  person["date_of_birth"]
-            representative.phone =          person["phone"]
-            representative.email =          person["email"]
-
-            new_company_data.representatives.people.append(representative)
-
-        for person in data.get("owners"):
-            owner = new_company_data.Owners.Owner()
-
-            owner.city =                person["city"]
-            owner.country =             person["country"]
-            owner.street =              person["street"]
-            owner.address =             person["address"]
-            owner.name =                person["name"]
-            owner.role =                person["role"]
-            owner.date_of_birth =       person["date_of_birth"]
-            owner.phone =               person["phone"]
-            owner.email =               person["email"]
-            owner.shares_percentage =   person["shares_percentage"]
-            owner.shares_nominal =      person["shares_nominal"]
-
-            new_company_data.owners.people.append(owner)
-
-        new_company_data.capital.total_amount = data["capital"]["total_amount"]
-        new_company_data.capital.total_shares = data["capital"]["total_shares"]
-        new_company_data.capital.currency =     data["capital"]["currency"]
-
+        new_company_data = CompanyData(
+            company=MAPPERS.chatgpt_company(data),
+            representatives=CompanyData.Representatives(
+                people=[MAPPERS.chatgpt_representative(person) for person in data.get("representatives")]),
+            owners=CompanyData.Owners(people=[MAPPERS.chatgpt_owner(person) for person in data.get("owners")]),
+            capital=MAPPERS.chatgpt_capital(data))
+        if self:    # Fill an existing object
+            self.company, self.representatives, self.owners, self.capital = (
+                new_company_data.company, new_company_data.representatives,
+                new_company_data.owners, new_company_data.capital)
+            return self
         return new_company_data
 
     def from_openregister_details(self=None, data=None):
         """Map the response data from openregister/details to a CompanyData object"""
-        new_company_data = CompanyData()
         if not data:
             return CompanyData()
-        new_company_data.company.name =             data["name"]["name"]
-        new_company_data.company.address =          data["address"]["formatted_value"]
-        new_company_data.company.city =             data["address"]["city"]
-        new_company_data.company.postal_code =      data["address"]["postal_code"]
-        new_company_data.company.street =           data["address"]["street"]
-        new_company_data.company.legal_form =       data["legal_form"]
-        new_company_data.company.purpose =          data.get("purpose")["purpose"] if data.get("purpose") else ""
-        new_company_data.company.id =               data["id"]
-        new_company_data.company.register_court =   data["register"]["register_court"]
-        new_company_data.company.register_number =  data["register"]["register_number"]
-        new_company_data.company.country =          data["address"]["country"]
-        new_company_data.company.register_type =    data["register"]["register_type"]
-        new_company_data.company.status =           data["status"]
-
-        for person in data.get("representation"):
-            representative = new_company_data.Representatives.Representative()
-
-            representative.role = person.get("role")
-            representative.name = person.get("name")
-            if person["type"] == "natural_person":
-                representative.date_of_birth =       person["natural_person"].get("date_of_birth")
-                representative.city =                person["natural_person"].get("city")
-                representative.country =             person["natural_person"].get("country")
-            else:
-                representative.city =    person["legal_person"].get("city")
-                representative.country = person["legal_person"].get("country")
-                representative.date_of_birth = person["legal_person"].get("date_of_birth")
-
-            new_company_data.representatives.people.append(representative)
-
-        if data.get("capital"):
-            new_company_data.capital.total_amount = data["capital"].get("amount")
-            new_company_data.capital.currency =     data["capital"].get("currency")
-
-        return new_company_data
-
+        representatives = [(MAPPERS.openregister_natural_representative if person["type"] == "natural_person"
+                            else MAPPERS.openregister_legal_representative)(person)
+                           for person in data.get("representation")]
+        return CompanyData(company=MAPPERS.openregister_company(data),
+                           representatives=CompanyData.Representatives(people=representatives),
+                           capital=MAPPERS.openregister_capital(data) if data.get("capital") else CompanyData.Capital())
 
     def from_openregister_owners(self=None, data: list=None):
         """Map the response data from openregister/owners to a CompanyData object"""
         if not data:
             return CompanyData()
-        new_company_data = CompanyData()
-        for person in data:
-            owner = new_company_data.owners.Owner()
-
-            owner.role =                person.get("relation_type")
-            owner.shares_nominal =      person.get("nominal_share")
-            owner.shares_percentage =   person.get("percentage_share")
-            if person.get("type") == "natural_person":
-                owner.city =                person["natural_person"].get("city")
-                owner.country =             person["natural_person"].get("country")
-                owner.date_of_birth =       person["natural_person"].get("date_of_birth")
-                owner.name =                person["natural_person"].get("full_name")
-            elif person.get("type") == "legal_person":
-                owner.city =    person["legal_person"].get("city")
-                owner.country = person["legal_person"].get("country")
-                owner.name =    person["legal_person"].get("name")
-
-            new_company_data.owners.people.append(owner)
+        owners = [MAPPERS.openregister_owners.get(person.get("type"), MAPPERS.openregister_owner)(person)
+                  for person in data]
+        return CompanyData(owners=CompanyData.Owners(people=owners))
 
-        return new_company_data
+    def from_dict(self=None, data: dict=None):
+        """Map a dict created by CompanyData.to_dict back to a CompanyData object"""
+        if not data:
+            return CompanyData()
+        company = CompanyData.Company(**data["company"])
+        company.industry_codes = list(company.industry_codes)   # Don't share lists with the cached dict
+        return CompanyData(
+            company=company,
+            representatives=CompanyData.Representatives(
+                people=[CompanyData.Representatives.Representative(**person) for person in data["representatives"]]),
+            owners=CompanyData.Owners(people=[CompanyData.Owners.Owner(**person) for person in data["owners"]]),
+            capital=CompanyData.Capital(**data["capital"]))
+
+    def merge(self, new_data: "CompanyData") -> "CompanyData":
+        """Copy every filled field of new_data's company and capital (and its owners, if any) into this object"""
+        if new_data.owners.people:
+            self.owners = new_data.owners
+        MAPPERS.merge_company(self.company, new_data.company)
+        MAPPERS.merge_capital(self.capital, new_data.capital)
+        return self
+
+    def is_clean(self) -> bool:
+        """Check if the people lists hold the same people as after the last cleanup, people are added, removed
+        or replaced after mapping but their fields are never emptied"""
+        if self.cleaned is None:
+            return False
+        owners, representatives = self.cleaned
+        return (len(owners) == len(self.owners.people) and all(map(operator.is_, owners, self.owners.people)) and
+                len(representatives) == len(self.representatives.people) and
+                all(map(operator.is_, representatives, self.representatives.people)))
 
     def cleanup(self):
-        """Clean up the data by removing any unfilled owners/representatives"""
-        new_owners = []
-        for owner in self.owners.people:
-            if calculate_completion_percentage(owner) > 0:
-                new_owners.append(owner)
-
-        new_representatives = []
-        for representative in self.representatives.people:
-            if calculate_completion_percentage(representative) > 0:
-                new_representatives.append(representative)
-
-        self.owners.people = new_owners
-        self.representatives.people = new_representatives
+        """Clean up the data by removing any unfilled owners/representatives, if changed since the last cleanup"""
+        if self.is_clean():
+            return
+        self.owners.people = [owner for owner in self.owners.people
+                              if calculate_completion_percentage(owner) > 0]
+        self.representatives.people = [representative for representative in self.representatives.people
+                                       if calculate_completion_percentage(representative) > 0]
+        self.cleaned = (tuple(self.owners.people), tuple(self.representatives.people))  # Held, so ids stay unique
 
     def to_dict(self) -> dict:
         """Turn the CompanyData object into a JSON-like dict for serialization"""
         self.cleanup()
-        return_dict = {}
-        return_dict["company"] = self.company.__dict__
-        return_dict["representatives"] = [person.__dict__ for person in self.representatives.people]
-        return_dict["owners"] = [person.__dict__ for person in self.owners.people]
-        return_dict["capital"] = self.capital.__dict__
-        return return_dict
+        return {
+            "company": MAPPERS.company_to_dict(self.company),
+            "representatives": [MAPPERS.representative_to_dict(person) for person in self.representatives.people],
+            "owners": [MAPPERS.owner_to_dict(person) for person in self.owners.people],
+            "capital": MAPPERS.capital_to_dict(self.capital)
+        }
+
+    def to_encodable(self) -> dict:
+        """Turn the CompanyData object into data encode_json takes, without building dicts for every
+        company and person if orjson is installed"""
+        if not ENCODES_DATACLASSES:
+            return self.to_dict()
+        self.cleanup()
+        return {"company": self.company, "representatives": self.representatives.people,
+                "owners": self.owners.people, "capital": self.capital}
+
+    def to_json(self) -> bytes:
+        """Turn the CompanyData object into JSON bytes"""
+        return encode_json(self.to_encodable())
+
+
+# Declarative field mapping per source: field -> source path (see app.mapping.source_expression)
+PERSON_FIELDS = ("city", "country", "street", "address", "name", "role", "date_of_birth", "phone", "email")
+
+CHATGPT_COMPANY = {
+    "name": "company.name",
+    "address": "company.address",
+    "city": "company.city",
+    "postal_code": "company.postal_code",
+    "street": "company.street",
+    "legal_form": "company.legal_form",
+    "purpose": "company.purpose",
+    "id": "company.german_company_registration_number",
+    "register_court": "company.register_court",
+    "register_number": "company.register_number",
+    "country": "company.country",
+    "register_type": "company.register_type",
+    "support_phone": "company.support_phone",
+    "support_email": "company.support_email",
+    "status": "company.status",
+    "industry_codes": "company.industry_codes"
+}
+CHATGPT_REPRESENTATIVE = {name: name for name in PERSON_FIELDS}
+CHATGPT_OWNER = {**CHATGPT_REPRESENTATIVE, "shares_percentage": "shares_percentage",
+                 "shares_nominal": "shares_nominal"}
+CHATGPT_CAPITAL = {"total_amount": "capital.total_amount", "total_shares": "capital.total_shares",
+                   "currency": "capital.currency"}
+
+OPENREGISTER_COMPANY = {
+    "name": "name.name",
+    "address": "address.formatted_value",
+    "city": "address.city",
+    "postal_code": "address.postal_code",
+    "street": "address.street",
+    "legal_form": "legal_form",
+    "purpose": ("purpose?.purpose?", ""),
+    "id": "id",
+    "register_court": "register.register_court",
+    "register_number": "register.register_number",
+    "country": "address.country",
+    "register_type": "register.register_type",
+    "status": "status"
+}
+OPENREGISTER_NATURAL_REPRESENTATIVE = {"role": "role?", "name": "name?",
+                                       "date_of_birth": "natural_person.date_of_birth?",
+                                       "city": "natural_person.city?", "country": "natural_person.country?"}
+OPENREGISTER_LEGAL_REPRESENTATIVE = {"role": "role?", "name": "name?",
+                                     "date_of_birth": "legal_person.date_of_birth?",
+                                     "city": "legal_person.city?", "country": "legal_person.country?"}
+OPENREGISTER_OWNER = {"role": "relation_type?", "shares_nominal": "nominal_share?",
+                      "shares_percentage": "percentage_share?"}
+OPENREGISTER_NATURAL_OWNER = {**OPENREGISTER_OWNER, "city": "natural_person.city?",
+                              "country": "natural_person.country?",
+                              "date_of_birth": "natural_person.date_of_birth?",
+                              "name": "natural_person.full_name?"}
+OPENREGISTER_LEGAL_OWNER = {**OPENREGISTER_OWNER, "city": "legal_person.city?",
+                            "country": "legal_person.country?", "name": "legal_person.name?"}
+OPENREGISTER_CAPITAL = {"total_amount": "capital.amount?", "currency": "capital.currency?"}
+
+# Fields enrichment may fill in, only copied if the new source has a value
+MERGE_COMPANY = ("city", "country", "address", "postal_code", "street", "id", "industry_codes", "legal_form",
+                 "name", "purpose", "register_court", "register_number", "register_type", "status")
+MERGE_CAPITAL = ("total_amount", "currency", "total_shares")
+
+
+class MAPPERS:
+    """Holds the functions generated from the field tables"""
+    chatgpt_company = compile_mapping(CompanyData.Company, CHATGPT_COMPANY, "chatgpt_company")
+    chatgpt_representative = compile_mapping(CompanyData.Representatives.Representative, CHATGPT_REPRESENTATIVE,
+                                             "chatgpt_representative")
+    chatgpt_owner = compile_mapping(CompanyData.Owners.Owner, CHATGPT_OWNER, "chatgpt_owner")
+    chatgpt_capital = compile_mapping(CompanyData.Capital, CHATGPT_CAPITAL, "chatgpt_capital")
+
+    openregister_company = compile_mapping(CompanyData.Company, OPENREGISTER_COMPANY, "openregister_company")
+    openregister_natural_representative = compile_mapping(CompanyData.Representatives.Representative,
+                                                          OPENREGISTER_NATURAL_REPRESENTATIVE,
+                                                          "openregister_natural_representative")
+    openregister_legal_representative = compile_mapping(CompanyData.Representatives.Representative,
+                                                        OPENREGISTER_LEGAL_REPRESENTATIVE,
+                                                        "openregister_legal_representative")
+    openregister_owner = compile_mapping(CompanyData.Owners.Owner, OPENREGISTER_OWNER, "openregister_owner")
+    openregister_owners = {     # By the owner's type, other types only get the shares
+        "natural_person": compile_mapping(CompanyData.Owners.Owner, OPENREGISTER_NATURAL_OWNER,
+                                          "openregister_natural_owner"),
+        "legal_person": compile_mapping(CompanyData.Owners.Owner, OPENREGISTER_LEGAL_OWNER,
+                                        "openregister_legal_owner")
+    }
+    openregister_capital = compile_mapping(CompanyData.Capital, OPENREGISTER_CAPITAL, "openregister_capital")
+
+    merge_company = compile_merge(MERGE_COMPANY, "merge_company")
+    merge_capital = compile_merge(MERGE_CAPITAL, "merge_capital")
+
+    company_to_dict = compile_to_dict(CompanyData.Company)
+    representative_to_dict = compile_to_dict(CompanyData.Representatives.Representative)
+    owner_to_dict = compile_to_dict(CompanyData.Owners.Owner)
+    capital_to_dict = compile_to_dict(CompanyData.Capital)
@@ -2,6 +2,8 @@
 
 import os
 import json
+import hashlib
+from functools import cached_property
 import dotenv
 from app.auto_logging import AutoLogger
 
@@ -41,24 +43,179 @@ configLogger.info(f"""OpenAI available: {CLIENTS.openai.available}
 configLogger.info(f"""OpenRegister available: {CLIENTS.openregister.available}
                       Message: {CLIENTS.openregister.message}""")
 
-class CREDENTIALS: # Load credentials if available
+class SERVER:  # Settings of the HTTP server and its worker processes
+    """Holds the server settings"""
+    host = os.getenv("HOST", "127.0.0.1")
+    port = int(os.getenv("PORT", "80"))
+    workers = int(os.getenv("WEB_WORKERS", "1")) or os.cpu_count() or 1    # 0 starts one per CPU
+    max_requests = int(os.getenv("WEB_MAX_REQUESTS", "0"))     # Recycle a worker after this many, 0 never
+    max_requests_jitter = int(os.getenv("WEB_MAX_REQUESTS_JITTER", "100"))  # So workers don't recycle together
+    graceful_timeout = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "30"))  # Time to finish requests on shutdown
+    preload = os.getenv("WEB_PRELOAD", "1") != "0"    # Build the clients once before forking the workers
+
+# Several workers share their cached results through this file unless the SQLite paths are set
+SHARED_STATE = "cache.sqlite3" if SERVER.workers > 1 else ""
+
+class LIMITS:  # Concurrency limits for the upstream providers
+    """Holds the maximum number of concurrent blocking calls per provider"""
+    dnb = int(os.getenv("DNB_MAX_CONCURRENCY", "4"))
+    google = int(os.getenv("GOOGLE_MAX_CONCURRENCY", "4"))
+    openai = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+    openregister = int(os.getenv("OPENREGISTER_MAX_CONCURRENCY", "16"))
+    pdf_processes = int(os.getenv("PDF_MAX_PROCESSES",     # The CPUs are split between the workers
+                                  str(max(1, (os.cpu_count() or 1) // SERVER.workers))))
+    pipeline_in_flight = int(os.getenv("PIPELINE_MAX_IN_FLIGHT", "32"))
+    batch_files = int(os.getenv("BATCH_MAX_FILES", "500"))
+    batch_names = int(os.getenv("BATCH_MAX_NAMES", "1000"))
+    name_batch_concurrency = int(os.getenv("NAME_BATCH_MAX_CONCURRENCY", "8"))  # Leaves threads for single lookups
+
+configLogger.info(f"""Concurrency limits: D&B {LIMITS.dnb}, Google {LIMITS.google}, """
+                  f"""OpenAI {LIMITS.openai}, OpenRegister {LIMITS.openregister}, """
+                  f"""PDF processes {LIMITS.pdf_processes}""")
+
+class OPENREGISTER:  # Connection settings for the openregister API
+    """Holds the HTTP session settings of the openregister client"""
+    pool_size = int(os.getenv("OPENREGISTER_POOL_SIZE", "16"))
+    timeout = float(os.getenv("OPENREGISTER_TIMEOUT", "10"))
+    retries = int(os.getenv("OPENREGISTER_RETRIES", "3"))
+    backoff_factor = float(os.getenv("OPENREGISTER_BACKOFF_FACTOR", "0.5"))
+    backoff_jitter = float(os.getenv("OPENREGISTER_BACKOFF_JITTER", "0.5"))
+    retry_after_max = float(os.getenv("OPENREGISTER_RETRY_AFTER_MAX", "10"))   # Longest wait a Retry-After gets
+    pool_timeout = float(os.getenv("OPENREGISTER_POOL_TIMEOUT", "10"))     # Longest wait for a free connection
+    enrich_deadline = float(os.getenv("OPENREGISTER_ENRICH_DEADLINE", "15"))
+    credit_cooldown = float(os.getenv("OPENREGISTER_CREDIT_COOLDOWN", "300"))
+    match_cutoff = float(os.getenv("OPENREGISTER_MATCH_CUTOFF", "75"))    # Least name similarity of a match
+    match_limit = int(os.getenv("OPENREGISTER_MATCH_LIMIT", "5"))       # Ranked candidates per search
+
+class GOOGLE:  # Settings of the google credential refresh, the Drive cleanup and uploads
+    """Holds the google credential settings"""
+    refresh_margin = float(os.getenv("GOOGLE_REFRESH_MARGIN", "600"))    # Refresh this long before expiry
+    refresh_retry = float(os.getenv("GOOGLE_REFRESH_RETRY", "30"))      # Wait after a failed refresh
+    cleanup_batch_size = min(100, int(os.getenv("GOOGLE_CLEANUP_BATCH_SIZE", "50")))  # Deletes per batch request
+    cleanup_delay = float(os.getenv("GOOGLE_CLEANUP_DELAY", "2"))       # Collect deletes this long into a batch
+    sweep_interval = float(os.getenv("GOOGLE_SWEEP_INTERVAL", "600"))
+    orphan_age = float(os.getenv("GOOGLE_ORPHAN_AGE", "1800"))    # The sweeper deletes uploads older than this
+    upload_chunk_size = int(os.getenv("GOOGLE_UPLOAD_CHUNK_SIZE", str(5 * 1024 * 1024)))  # Multiple of 256 KiB
+    upload_retries = int(os.getenv("GOOGLE_UPLOAD_RETRIES", "3"))     # Per chunk of a resumable upload
+
+class CACHE:  # Settings of the result caches, an empty SQLite path disables the on-disk tier
+    """Holds the cache settings"""
+    pdf_ttl = float(os.getenv("PDF_CACHE_TTL", "86400"))
+    pdf_max_entries = int(os.getenv("PDF_CACHE_MAX_ENTRIES", "256"))
+    pdf_sqlite_path = os.getenv("PDF_CACHE_SQLITE_PATH", SHARED_STATE)
+    pdf_sqlite_max_entries = int(os.getenv("PDF_CACHE_SQLITE_MAX_ENTRIES", "10000"))
+    openregister_ttl = float(os.getenv("OPENREGISTER_CACHE_TTL", "86400"))
+    openregister_negative_ttl = float(os.getenv("OPENREGISTER_CACHE_NEGATIVE_TTL", "3600"))
+    openregister_max_entries = int(os.getenv("OPENREGISTER_CACHE_MAX_ENTRIES", "4096"))
+    openregister_sqlite_path = os.getenv("OPENREGISTER_CACHE_SQLITE_PATH", SHARED_STATE)
+    openregister_sqlite_max_entries = int(os.getenv("OPENREGISTER_CACHE_SQLITE_MAX_ENTRIES", "100000"))
+
+class REGISTER_INDEX:  # Local index of company register records, an empty path disables it
+    """Holds the register index settings"""
+    path = os.getenv("REGISTER_INDEX_PATH", "")
+    max_age = float(os.getenv("REGISTER_INDEX_MAX_AGE", str(30 * 86400)))  # Older records count as a miss
+    candidates = int(os.getenv("REGISTER_INDEX_CANDIDATES", "100"))         # Records ranked per search
+    min_score = float(os.getenv("REGISTER_INDEX_MIN_SCORE", "98"))  # Weaker name matches ask the API instead
+
+class PDF:  # Settings of the PDF text extraction
+    """Holds the PDF extraction settings"""
+    pages_per_task = max(1, int(os.getenv("PDF_PAGES_PER_TASK", "8")))    # Pages per worker process task
+    max_pages = int(os.getenv("PDF_MAX_PAGES", "0")) or None               # 0 extracts all pages
+    ocr_min_chars = int(os.getenv("PDF_OCR_MIN_CHARS", "20"))     # Image pages with less text get OCR
+    ocr_pages_per_group = max(1, int(os.getenv("PDF_OCR_PAGES_PER_GROUP", "10")))
+
+class PROMPT:  # Settings of the prompt preparation for ChatGPT
+    """Holds the prompt settings"""
+    model = os.getenv("OPENAI_MODEL", "gpt-4.1")
+    token_budget = int(os.getenv("PROMPT_TOKEN_BUDGET", "12000"))   # Tokens of document text per request
+
+class OPENAI_LIMITS:  # Client-side rate limits of the OpenAI API, set to (a bit below) the account's tier
+    """Holds the OpenAI rate limit settings"""
+    requests_per_minute = int(os.getenv("OPENAI_RPM", "500"))
+    tokens_per_minute = int(os.getenv("OPENAI_TPM", "200000"))
+    state_path = os.getenv("OPENAI_RATE_LIMIT_PATH",    # Shared by all workers, empty keeps it in memory
+                           "openai-rate-limit.json" if SHARED_STATE else "")
+    output_tokens = int(os.getenv("OPENAI_OUTPUT_TOKENS", "1000"))     # Reserved per request for the answer
+    admission_timeout = float(os.getenv("OPENAI_ADMISSION_TIMEOUT", "60"))   # Longest wait for capacity
+    request_timeout = float(os.getenv("OPENAI_REQUEST_TIMEOUT", "60"))
+    retries = int(os.getenv("OPENAI_RETRIES", "4"))
+    backoff_factor = float(os.getenv("OPENAI_BACKOFF_FACTOR", "1"))
+    backoff_max = float(os.getenv("OPENAI_BACKOFF_MAX", "30"))
+
+class BULK:  # Settings of the offline bulk extraction (python -m app.bulk)
+    """Holds the bulk extraction settings"""
+    base_url = os.getenv("OPENAI_BATCH_BASE_URL", "")     # Empty uses OpenAI, set it to test against a fake server
+    completion_window = os.getenv("OPENAI_BATCH_COMPLETION_WINDOW", "24h")
+    max_requests = int(os.getenv("OPENAI_BATCH_MAX_REQUESTS", "50000"))     # Requests per batch file
+    poll_interval = float(os.getenv("OPENAI_BATCH_POLL_INTERVAL", "60"))
+    max_wait = float(os.getenv("OPENAI_BATCH_MAX_WAIT", str(26 * 3600)))  # Give up polling after this
+    work_dir = os.getenv("BULK_WORK_DIR", "bulk")    # Batch input files are written here
+
+class UPLOADS:  # Limits of uploaded files, sizes in bytes
+    """Holds the upload settings"""
+    max_size = int(os.getenv("UPLOAD_MAX_SIZE", str(50 * 1024 * 1024)))            # Per file
+    max_request_size = int(os.getenv("UPLOAD_MAX_REQUEST_SIZE", str(500 * 1024 * 1024)))
+    memory_limit = int(os.getenv("UPLOAD_MEMORY_LIMIT", str(1024 * 1024)))  # Larger files are spooled to disk
+    chunk_size = int(os.getenv("UPLOAD_CHUNK_SIZE", str(256 * 1024)))
+
+class JOBS:  # Settings of the asynchronous job API
+    """Holds the job queue settings"""
+    enabled = bool(os.getenv("JOBS_ENABLED"))
+    sqlite_path = os.getenv("JOBS_SQLITE_PATH", "jobs.sqlite3")
+    workers = int(os.getenv("JOBS_WORKERS", "2"))               # 0 only queues, run python -m app.jobs
+    max_queued = int(os.getenv("JOBS_MAX_QUEUED", "100"))
+    poll_interval = float(os.getenv("JOBS_POLL_INTERVAL", "0.5"))
+    max_wait = float(os.getenv("JOBS_MAX_WAIT", "30"))          # Longest long-poll of the status route
+    lease = float(os.getenv("JOBS_LEASE", "600"))               # Running jobs not renewed within this are requeued
+    result_ttl = float(os.getenv("JOBS_RESULT_TTL", "86400"))
+
+class STARTUP:  # Settings of the process startup
+    """Holds the startup settings"""
+    warm_up = os.getenv("STARTUP_WARM_UP", "1") != "0"  # Build the clients in the background once serving
+
+class TIMING:  # Settings of the per-request stage timing
+    """Holds the timing settings"""
+    header = os.getenv("TIMING_HEADER", "1") != "0"     # Send the stages' spans as a Server-Timing header
+    in_body = os.getenv("TIMING_IN_BODY", "0") != "0"   # Add them to the JSON body, also per request with ?timing=1
+
+class PROFILER:  # Settings of the sampling profiler behind /admin/profile
+    """Holds the profiler settings"""
+    max_seconds = float(os.getenv("PROFILER_MAX_SECONDS", "60"))
+    interval = float(os.getenv("PROFILER_INTERVAL", "0.01"))  # Seconds between two samples of all threads
+
+class Credentials: # Load credentials on first access, so only the clients in use need them
     """Class to hold the client credentials"""
-    dnb_token, google_credentials, google_token, openai_token, openregister = (
-        None, None, None, None, None
-    )
+    @cached_property
+    def dnb_token(self) -> str | None:
+        """Token of the D&B API"""
+        return os.getenv("DNB_TOKEN") if CLIENTS.dnb.available else None
+
+    @cached_property
+    def google_credentials(self) -> dict | None:
+        """Client secrets of the google app"""
+        return json.loads(os.getenv("GOOGLE_CREDENTIALS")) if CLIENTS.google.available else None
 
-    if CLIENTS.dnb.available:
-        dnb_token = os.getenv("DNB_TOKEN")
+    @cached_property
+    def google_token(self) -> dict | str | None:
+        """Authorized user info of the google account, replaced by the refreshed credentials' JSON"""
+        return json.loads(os.getenv("GOOGLE_TOKEN")) if CLIENTS.google.available else None
 
-    if CLIENTS.google.available:
-        google_credentials = json.loads(os.getenv("GOOGLE_CREDENTIALS"))
-        google_token = json.loads(os.getenv("GOOGLE_TOKEN"))
+    @cached_property
+    def openai_token(self) -> str | None:
+        """Token of the OpenAI API"""
+        return os.getenv("OPENAI_TOKEN") if CLIENTS.openai.available else None
 
-    if CLIENTS.openai.available:
-        openai_token = os.getenv("OPENAI_TOKEN")
+    @cached_property
+    def openregister(self) -> str | None:
+        """Token of the openregister API"""
+        return os.getenv("OPENREGISTER_TOKEN") if CLIENTS.openregister.available else None
 
-    if CLIENTS.openregister.available:
-        openregister = os.getenv("OPENREGISTER_TOKEN")
+    @cached_property
+    def admin_token(self) -> str | None:
+        """Token of the admin routes, which are unavailable without one"""
+        return os.getenv("ADMIN_TOKEN") or None
+
+CREDENTIALS = Credentials()
 
 try:    # Load the response format for ChatGPT
     with open("app/openai_response_format.json", mode="r", encoding="utf-8") as f:
@@ -69,3 +226,7 @@ except ExceptionGroup("", [FileNotFoundError, json.JSONDecodeError]):
     #    f.write("{}")
     configLogger.warn("Couldn't load ChatGPT response format, did not create placeholder")
     OPENAI_RESPONSE_FORMAT = {}
+
+# Changes whenever the response format changes, so results of an older format aren't reused
+OPENAI_RESPONSE_FORMAT_VERSION = hashlib.sha256(
+    json.dumps(OPENAI_RESPONSE_FORMAT, sort_keys=True).encode("utf-8")).hexdigest()[:12]
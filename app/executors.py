@@ -0,0 +1,104 @@
+"""Bounded executors for running blocking client calls off the event loop"""
+
+import asyncio
+import contextvars
+import functools
+import multiprocessing
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from app.config import LIMITS
+from app.auto_logging import AutoLogger
+
+
+class ProviderExecutor:
+    """Bounded thread pool for the blocking calls of a single provider"""
+    def __init__(self, name: str, max_workers: int) -> None:
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.pool = ThreadPoolExecutor(max_workers=self.max_workers,
+                                       thread_name_prefix=f"{name}-worker")
+
+    async def run(self, func, *args, **kwargs):
+        """Run a blocking function in the pool and await its result"""
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()    # Keep request-scoped context in the worker thread
+        call = functools.partial(context.run, func, *args, **kwargs)
+        return await loop.run_in_executor(self.pool, call)
+
+    def submit(self, func, *args, **kwargs) -> Future:
+        """Start a blocking function in the pool from synchronous code, returns its future"""
+        context = contextvars.copy_context()    # A copy per call, a context can't be entered twice at once
+        return self.pool.submit(context.run, func, *args, **kwargs)
+
+    def call(self, func, *args, **kwargs):
+        """Run a blocking function in the pool from synchronous code and wait for it"""
+        return self.submit(func, *args, **kwargs).result()
+
+    def shutdown(self) -> None:
+        """Shut down the pool without waiting for running calls"""
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class ProcessExecutor:
+    """Bounded process pool for CPU-bound work, created on first use"""
+    def __init__(self, name: str, max_workers: int) -> None:
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.lock = threading.Lock()
+        self.pool = None
+        self.context = "fork"   # Fast to start and shares the imports, while no other threads run yet
+
+    def get_pool(self) -> ProcessPoolExecutor:
+        """Get the pool, starting it if necessary"""
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                mp_context=multiprocessing.get_context(self.context))
+            return self.pool
+
+    def start(self) -> None:
+        """Fork all workers now, before the process starts running other threads"""
+        self.get_pool().submit(abs, 0).result()
+
+    def replace_pool(self, broken: ProcessPoolExecutor) -> ProcessPoolExecutor:
+        """Replace a broken pool (unless another call already did), returns the new one"""
+        with self.lock:
+            if self.pool is broken:
+                AutoLogger("Executors").warn(f"A {self.name} worker process died, restarting the pool")
+                broken.shutdown(wait=False, cancel_futures=True)
+                self.pool = None
+                self.context = "spawn"  # Threads run by now, forking could copy a lock one of them holds
+        return self.get_pool()
+
+    async def run(self, func, *args):
+        """Run a picklable function in the pool and await its result, retrying once in a new pool if
+        a worker process died"""
+        loop = asyncio.get_running_loop()
+        pool = self.get_pool()
+        try:
+            return await loop.run_in_executor(pool, func, *args)
+        except BrokenProcessPool:   # The pool can't be used anymore, e.g. after a crash on a malformed PDF
+            return await loop.run_in_executor(self.replace_pool(pool), func, *args)
+
+    def shutdown(self) -> None:
+        """Shut down the pool without waiting for running calls"""
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False, cancel_futures=True)
+                self.pool = None
+
+
+class EXECUTORS:
+    """Holds one bounded executor per provider and the PDF parsing process pool"""
+    dnb = ProviderExecutor("dnb", LIMITS.dnb)
+    google = ProviderExecutor("google", LIMITS.google)
+    openai = ProviderExecutor("openai", LIMITS.openai)
+    openregister = ProviderExecutor("openregister", LIMITS.openregister)
+    pdf = ProcessExecutor("pdf", LIMITS.pdf_processes)
+
+    @classmethod
+    def shutdown(cls) -> None:
+        """Shut down all provider executors"""
+        for executor in (cls.dnb, cls.google, cls.openai, cls.openregister, cls.pdf):
+            executor.shutdown()
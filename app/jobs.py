@@ -0,0 +1,236 @@
+"""Asynchronous jobs for long-running document extraction"""
+
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+from contextlib import contextmanager
+from app.config import JOBS, UPLOADS
+from app.responses import ClientResponse
+from app.uploads import SpooledUpload
+from app.auto_logging import AutoLogger
+
+
+class JobStore:
+    """Persists jobs in a SQLite database, so they survive restarts and can be shared
+    between processes"""
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                    id TEXT PRIMARY KEY,
+                                    kind TEXT NOT NULL,
+                                    status TEXT NOT NULL,
+                                    payload BLOB,
+                                    result TEXT,
+                                    created REAL NOT NULL,
+                                    updated REAL NOT NULL)""")
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+
+    @contextmanager
+    def connect(self):
+        """Open a connection for a single transaction"""
+        connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def create(self, kind: str, upload: SpooledUpload) -> str:
+        """Queue a new job, returns its id"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.connect() as connection, upload.open() as payload:
+            connection.execute("BEGIN")
+            rowid = connection.execute("INSERT INTO jobs VALUES (?, ?, 'queued', zeroblob(?), NULL, ?, ?)",
+                                       (job_id, kind, upload.size, now, now)).lastrowid
+            with connection.blobopen("jobs", "payload", rowid) as blob:    # Stream the upload into the row
+                while chunk := payload.read(UPLOADS.chunk_size):
+                    blob.write(chunk)
+            connection.execute("COMMIT")
+        return job_id
+
+    def read_payload(self, job_id: str) -> SpooledUpload:
+        """Stream a job's payload back into a SpooledUpload"""
+        upload = SpooledUpload()
+        with self.connect() as connection:
+            rowid = connection.execute("SELECT rowid FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+            with connection.blobopen("jobs", "payload", rowid, readonly=True) as blob:
+                while chunk := blob.read(UPLOADS.chunk_size):
+                    upload.write(chunk)
+        return upload.finish()
+
+    def claim(self) -> tuple[str, str] | None:
+        """Atomically take the oldest queued job, returns its id and kind"""
+        with self.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")   # Lock out other workers between select and update
+            row = connection.execute("""SELECT id, kind FROM jobs WHERE status = 'queued'
+                                        ORDER BY created LIMIT 1""").fetchone()
+            if row is not None:
+                connection.execute("UPDATE jobs SET status = 'running', updated = ? WHERE id = ?",
+                                   (time.time(), row[0]))
+            connection.execute("COMMIT")
+        return row
+
+    def renew(self, job_id: str) -> None:
+        """Extend the lease of a running job, so it isn't requeued while its worker is alive"""
+        with self.connect() as connection:
+            connection.execute("UPDATE jobs SET updated = ? WHERE id = ? AND status = 'running'",
+                               (time.time(), job_id))
+
+    def finish(self, job_id: str, result: dict, status: str = "done") -> None:
+        """Store the result of a job and drop its payload"""
+        with self.connect() as connection:
+            connection.execute("""UPDATE jobs SET status = ?, result = ?, payload = NULL, updated = ?
+                                  WHERE id = ?""", (status, json.dumps(result), time.time(), job_id))
+
+    def get(self, job_id: str) -> dict | None:
+        """Get the state of a job"""
+        with self.connect() as connection:
+            row = connection.execute("SELECT id, status, result, created, updated FROM jobs WHERE id = ?",
+                                     (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {"job_id": row[0], "status": row[1], "result": json.loads(row[2]) if row[2] else None,
+                "created": row[3], "updated": row[4]}
+
+    def count(self, status: str) -> int:
+        """Count the jobs with the given status"""
+        with self.connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+    def requeue_stale(self, lease: float) -> int:
+        """Queue running jobs again whose lease expired, their worker died without finishing them"""
+        with self.connect() as connection:
+            return connection.execute("""UPDATE jobs SET status = 'queued', updated = ?
+                                         WHERE status = 'running' AND updated < ?""",
+                                      (time.time(), time.time() - lease)).rowcount
+
+    def purge(self, max_age: float) -> int:
+        """Delete finished jobs older than max_age seconds"""
+        with self.connect() as connection:
+            return connection.execute("""DELETE FROM jobs WHERE status IN ('done', 'failed')
+                                         AND updated < ?""", (time.time() - max_age,)).rowcount
+
+
+class JobQueue:
+    """Bounded queue of PDF extraction jobs processed by a pool of in-process workers"""
+    def __init__(self, store: JobStore, pdf_pipeline, workers: int = JOBS.workers,
+                 max_queued: int = JOBS.max_queued) -> None:
+        self.store = store
+        self.pdf_pipeline = pdf_pipeline
+        self.workers = workers
+        self.max_queued = max_queued
+        self.tasks = []
+        self.wakeup = None
+        self.finished = {}  # job_id -> Event, set when a job of this process finishes
+        self.logger = AutoLogger("JobQueue")
+
+    async def submit(self, upload: SpooledUpload) -> str | None:
+        """Queue a PDF for extraction, returns the job id or None if the queue is full"""
+        if await asyncio.to_thread(self.store.count, "queued") >= self.max_queued:
+            return None
+        job_id = await asyncio.to_thread(self.store.create, "dataFromPDF", upload)
+        if self.wakeup is not None:
+            self.wakeup.set()
+        self.logger.debug(f"Queued job {job_id}")
+        return job_id
+
+    async def wait(self, job_id: str, timeout: float = 0) -> dict | None:
+        """Get a job's state, waiting up to timeout seconds for it to finish (long-poll)"""
+        deadline = time.monotonic() + min(timeout, JOBS.max_wait)
+        try:
+            while True:
+                job = await asyncio.to_thread(self.store.get, job_id)
+                remaining = deadline - time.monotonic()
+                if job is None or job["status"] in ("done", "failed") or remaining <= 0:
+                    return job
+                event = self.finished.setdefault(job_id, asyncio.Event())
+                try:    # Also poll, the job may be processed by a worker in another process
+                    await asyncio.wait_for(event.wait(), timeout=min(remaining, JOBS.poll_interval))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.finished.pop(job_id, None)     # Don't keep events of jobs nobody waits for anymore
+
+    async def start(self) -> None:
+        """Requeue jobs interrupted by a restart and start the workers"""
+        self.wakeup = asyncio.Event()
+        requeued = await asyncio.to_thread(self.store.requeue_stale, JOBS.lease)
+        if requeued:
+            self.logger.info(f"Requeued {requeued} interrupted jobs")
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+        self.tasks.append(asyncio.create_task(self.maintain()))
+        self.logger.info(f"Started {self.workers} job workers")
+
+    async def stop(self) -> None:
+        """Stop the workers, running jobs are requeued on the next start"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def work(self) -> None:
+        """Process queued jobs until cancelled"""
+        while True:
+            job = await asyncio.to_thread(self.store.claim)
+            if job is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=JOBS.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job_id = job[0]
+            self.logger.debug(f"Processing job {job_id}")
+            heartbeat = asyncio.create_task(self.heartbeat(job_id))
+            try:
+                with await asyncio.to_thread(self.store.read_payload, job_id) as upload:
+                    response = await self.pdf_pipeline.process(upload)
+                result, status = response.to_dict(), "done"
+            except Exception as e:
+                self.logger.warn(f"Job {job_id} failed: {e}")
+                result, status = ClientResponse(status_code=400, message=str(e)).to_APIResponse().to_dict(), "failed"
+            finally:
+                heartbeat.cancel()
+            await asyncio.to_thread(self.store.finish, job_id, result, status)
+            event = self.finished.pop(job_id, None)
+            if event is not None:
+                event.set()
+
+    async def heartbeat(self, job_id: str) -> None:
+        """Renew the lease of a job while it is processed, until cancelled"""
+        while True:
+            await asyncio.sleep(JOBS.lease / 3)     # Renew well before the lease expires
+            try:
+                await asyncio.to_thread(self.store.renew, job_id)
+            except sqlite3.Error as e:
+                self.logger.warn(f"Could not renew the lease of job {job_id}: {e}")
+
+    async def maintain(self) -> None:
+        """Periodically requeue jobs of dead workers and purge old results"""
+        while True:
+            await asyncio.sleep(JOBS.lease)
+            requeued = await asyncio.to_thread(self.store.requeue_stale, JOBS.lease)
+            if requeued:
+                self.logger.info(f"Requeued {requeued} jobs with an expired lease")
+            purged = await asyncio.to_thread(self.store.purge, JOBS.result_ttl)
+            if purged:
+                self.logger.debug(f"Purged {purged} old jobs")
+
+
+if __name__ == "__main__":   # Run job workers without serving HTTP: python -m app.jobs
+    from app.api import API
+
+    async def run_workers() -> None:
+        """Run the job workers of a fresh API instance until interrupted"""
+        if not JOBS.enabled:
+            raise SystemExit("The job API is disabled, set JOBS_ENABLED=1 to run job workers")
+        api = API()
+        await api.job_queue.start()
+        await asyncio.gather(*api.job_queue.tasks)
+
+    asyncio.run(run_workers())
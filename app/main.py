@@ -3,6 +3,7 @@
 from app.api import API
 
 api = API() # Initialize the API instance
+app = api.app   # The ASGI app, for servers and workers importing app.main:app
 
 if __name__ == "__main__":
     api.run()   # Run the API
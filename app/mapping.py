@@ -0,0 +1,57 @@
+"""Generation of mapping, merge and serialization functions from declarative field tables"""
+
+import json
+from dataclasses import fields
+
+try:    # Faster JSON encoding if orjson is installed
+    import orjson
+except ImportError:
+    orjson = None
+
+ENCODES_DATACLASSES = orjson is not None
+
+
+def source_expression(path: str | tuple) -> str:
+    """Turn a source path into a Python expression on `data`: keys are separated by dots, keys ending
+    with "?" may be missing (giving None) and a (path, default) tuple replaces empty values by default"""
+    path, default = path if isinstance(path, tuple) else (path, None)
+    expression = "data"
+    for key in path.split("."):
+        if key.endswith("?"):
+            expression = f"({expression} or {{}}).get({key[:-1]!r})"
+        else:
+            expression = f"{expression}[{key!r}]"
+    return expression if default is None else f"({expression} or {default!r})"
+
+
+def compile_function(name: str, source: str, namespace: dict = None):
+    """Compile the source of a single function"""
+    namespace = dict(namespace or {})
+    exec(compile(source, f"<generated {name}>", "exec"), namespace)   # Like dataclasses generates __init__
+    return namespace[name]
+
+
+def compile_mapping(cls, table: dict, name: str):
+    """Generate a function building a cls instance from a source dict, table maps fields to source paths"""
+    lines = [f"    obj.{field} = {source_expression(path)}" for field, path in table.items()]   # Faster than
+    source = f"def {name}(data):\n    obj = cls()\n" + "\n".join(lines) + "\n    return obj\n"  # keywords
+    return compile_function(name, source, {"cls": cls})
+
+
+def compile_merge(field_names: tuple, name: str):
+    """Generate a function copying the given fields from new to known where new has a value"""
+    lines = [f"    if new.{field}: known.{field} = new.{field}" for field in field_names]
+    return compile_function(name, f"def {name}(known, new):\n" + "\n".join(lines) + "\n")
+
+
+def compile_to_dict(cls):
+    """Generate a function turning a dataclass instance into a new dict of its fields"""
+    items = ", ".join(f"{field.name!r}: obj.{field.name}" for field in fields(cls))
+    return compile_function("to_dict", f"def to_dict(obj):\n    return {{{items}}}\n")
+
+
+def encode_json(data) -> bytes:
+    """Encode JSON-like data to UTF-8 JSON bytes, orjson also encodes dataclass instances"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
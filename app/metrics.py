@@ -0,0 +1,212 @@
+"""In-process metrics in the Prometheus text format, served by /metrics"""
+
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from app.timing import span
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)   # Seconds
+
+
+def escape(value) -> str:
+    """Escape a label value"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    """Format a label set like {route="/",method="GET"}"""
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """Base class of the metrics, holds one value per label set"""
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}    # Label values -> value
+        self.lock = threading.Lock()
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        """Get the samples as (name, labels, value)"""
+        with self.lock:
+            values = list(self.values.items())
+        return [(self.name, format_labels(self.labels, labels), value) for labels, value in values]
+
+    def render(self) -> list[str]:
+        """Render the metric in the Prometheus text format"""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {value}" for name, labels, value in self.samples())
+        return lines
+
+
+class Counter(Metric):
+    """Value that only goes up"""
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        """Add amount to the value of the label set"""
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that goes up and down"""
+    kind = "gauge"
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        """Add amount to the value of the label set"""
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1) -> None:
+        """Subtract amount from the value of the label set"""
+        self.inc(*labels, amount=-amount)
+
+    @contextmanager
+    def track(self, *labels):
+        """Count the label set up while the block runs"""
+        self.inc(*labels)
+        try:
+            yield
+        finally:
+            self.dec(*labels)
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets, with their sum and count"""
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels) -> None:
+        """Record a value for the label set"""
+        index = bisect_left(self.buckets, value)    # Only the first matching bucket, summed up when rendered
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]  # Buckets, +Inf, sum
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """Observe the duration of the block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        with self.lock:
+            values = [(labels, list(counts)) for labels, counts in self.values.items()]
+        samples = []
+        for labels, counts in values:
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                total += count
+                samples.append((f"{self.name}_bucket", format_labels(self.labels, labels, f'le="{bound}"'), total))
+            samples.append((f"{self.name}_sum", format_labels(self.labels, labels), counts[-1]))
+            samples.append((f"{self.name}_count", format_labels(self.labels, labels), total))
+        return samples
+
+
+class CollectedMetric(Metric):
+    """Metric whose values are read from func when scraped, func returns label values -> value"""
+    def __init__(self, name: str, help: str, labels: tuple, func, kind: str = "gauge") -> None:
+        super().__init__(name, help, labels)
+        self.func = func
+        self.kind = kind
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        return [(self.name, format_labels(self.labels, labels), value) for labels, value in self.func().items()]
+
+
+class METRICS:
+    """Holds the metrics of the API"""
+    http_requests = Counter("http_requests_total", "HTTP requests by route, method and status code",
+                            ("route", "method", "status"))
+    http_duration = Histogram("http_request_duration_seconds", "Time until the response started by route",
+                              ("route", "method"))
+    http_in_flight = Gauge("http_requests_in_flight", "HTTP requests being handled")
+    upstream_requests = Counter("upstream_requests_total", "Calls of upstream APIs by outcome",
+                                ("upstream", "operation", "outcome"))
+    upstream_duration = Histogram("upstream_request_duration_seconds", "Duration of upstream API calls",
+                                  ("upstream", "operation"))
+    upstream_in_flight = Gauge("upstream_requests_in_flight", "Running upstream API calls", ("upstream",))
+    stage_duration = Histogram("pipeline_stage_duration_seconds", "Duration of the PDF pipeline stages",
+                               ("stage",))
+    stage_in_flight = Gauge("pipeline_stage_in_flight", "Documents in each PDF pipeline stage", ("stage",))
+    openai_tokens = Counter("openai_tokens_total", "OpenAI tokens used by type", ("type",))
+    caches = {}     # Name -> cache with stats, see watch_cache
+    cache_lookups = CollectedMetric("cache_lookups_total", "Lookups of the result caches by result",
+                                    ("cache", "result"), lambda: {(name, result): getattr(cache.stats, result)
+                                                                  for name, cache in METRICS.caches.items()
+                                                                  for result in ("hits", "misses")}, "counter")
+    cache_hit_ratio = CollectedMetric("cache_hit_ratio", "Share of the cache lookups that were hits", ("cache",),
+                                      lambda: {(name,): cache.stats.hit_ratio()
+                                               for name, cache in METRICS.caches.items()})
+    prompt_stats = None     # PromptStats of the OpenAI client, see watch_prompts
+    prompt_tokens = CollectedMetric("openai_prompt_tokens_total", "Tokens of the extracted texts and of the "
+                                    "prompts sent for them", ("text",),
+                                    lambda: {("extracted",): METRICS.prompt_stats.tokens_in,
+                                             ("sent",): METRICS.prompt_stats.tokens_sent}
+                                    if METRICS.prompt_stats else {}, "counter")
+    prompt_documents = CollectedMetric("openai_prompts_total", "Prompts prepared, all or only those cut down to "
+                                       "the token budget", ("prompts",),
+                                       lambda: {("all",): METRICS.prompt_stats.documents,
+                                                ("truncated",): METRICS.prompt_stats.truncated}
+                                       if METRICS.prompt_stats else {}, "counter")
+    all = (http_requests, http_duration, http_in_flight, upstream_requests, upstream_duration, upstream_in_flight,
+           stage_duration, stage_in_flight, openai_tokens, prompt_tokens, prompt_documents, cache_lookups,
+           cache_hit_ratio)
+
+    @classmethod
+    def watch_cache(cls, name: str, cache) -> None:
+        """Export the hit and miss counters of a cache (anything with a CacheStats as stats)"""
+        cls.caches[name] = cache
+
+    @classmethod
+    def watch_prompts(cls, stats) -> None:
+        """Export the token counters of the prompt preparation (a PromptStats)"""
+        cls.prompt_stats = stats
+
+    @staticmethod
+    @contextmanager
+    def stage(name: str):
+        """Time a pipeline stage and count the documents in it, also as a span of the current request"""
+        with METRICS.stage_in_flight.track(name), METRICS.stage_duration.time(name), span(name):
+            yield
+
+    @staticmethod
+    @contextmanager
+    def upstream(upstream: str, operation: str):
+        """Time an upstream call and count it by outcome, "ok", the exception's name or what the block
+        set as the yielded dict's outcome (like a status code), also as a span of the current request"""
+        started = time.perf_counter()
+        call = {"outcome": "ok"}
+        METRICS.upstream_in_flight.inc(upstream)
+        try:
+            with span(f"{upstream}.{operation}"):
+                yield call
+        except BaseException as e:
+            call["outcome"] = type(e).__name__
+            raise
+        finally:
+            METRICS.upstream_in_flight.dec(upstream)
+            METRICS.upstream_duration.observe(time.perf_counter() - started, upstream, operation)
+            METRICS.upstream_requests.inc(upstream, operation, call["outcome"])
+
+    @classmethod
+    def render(cls) -> str:
+        """Render all metrics in the Prometheus text format"""
+        return "\n".join(line for metric in cls.all for line in metric.render()) + "\n"
@@ -0,0 +1,71 @@
+"""PDF text layer extraction, kept free of app imports so it can run in worker processes,
+PyPDF2 is imported on first use to keep it out of the API's startup"""
+
+import io
+import re
+
+INLINE_IMAGE = re.compile(rb"(?:^|\s)BI\s")     # Begins an image embedded in the content stream
+
+
+def open_pdf(source: io.BytesIO | bytes | str):
+    """Open a PDF from a stream, bytes or a path"""
+    from PyPDF2 import PdfReader
+    if isinstance(source, (bytes, bytearray, memoryview)):     # Bytes are passed into worker processes
+        source = io.BytesIO(source)
+    return PdfReader(source)
+
+
+def has_images(page) -> bool:
+    """Check if a page shows images, as image resources or inline in its content stream"""
+    resources = page.get("/Resources")
+    if resources is not None and "/XObject" in resources.get_object():
+        return True
+    contents = page.get_contents()
+    return contents is not None and INLINE_IMAGE.search(contents.get_data()) is not None
+
+
+def is_scanned(page, text: str, min_chars: int) -> bool:
+    """Check if a page needs OCR: it has no text layer at all, or next to none but images"""
+    text = text.strip()
+    if len(text) >= min_chars:
+        return False
+    return not text or has_images(page)
+
+
+def extract_pages(source: io.BytesIO | bytes | str, start: int = 0, stop: int = None,
+                  min_chars: int = 1) -> tuple[int, list[str], list[bool]] | None:
+    """Extract the embedded text of the pages [start, stop) (only with typed PDFs), returns the
+    PDF's page count, the text of each page and which pages are scanned or None if it can't be read"""
+    try:
+        reader = open_pdf(source)
+        page_count = len(reader.pages)
+        stop = page_count if stop is None else min(stop, page_count)
+        texts, scanned = [], []
+        for i in range(start, stop):
+            page = reader.pages[i]
+            texts.append(page.extract_text() or '')
+            scanned.append(is_scanned(page, texts[-1], min_chars))
+        return page_count, texts, scanned
+    except Exception:
+        return None
+
+
+def extract_page_pdf(source: io.BytesIO | bytes | str, pages: list[int]) -> bytes:
+    """Copy the given pages into a new, smaller PDF"""
+    from PyPDF2 import PdfWriter
+    reader = open_pdf(source)
+    writer = PdfWriter()
+    for i in pages:
+        writer.add_page(reader.pages[i])
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+def extract_text_layer(source: io.BytesIO | bytes | str, max_pages: int = None) -> str | None:
+    """Extract the embedded text of a PDF (only with typed PDFs) from a stream, bytes or a path,
+    returns None if it can't be read"""
+    result = extract_pages(source, 0, max_pages)
+    if result is None:
+        return None
+    return ''.join(result[1]).strip()  # Join once instead of copying the text for every page
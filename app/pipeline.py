@@ -0,0 +1,68 @@
+"""Pipelined extraction of company data from PDFs"""
+
+import asyncio
+from app.executors import EXECUTORS
+from app.util import extract_text_with_ocr
+from app.responses import ClientResponse, APIResponse
+from app.company_data import CompanyData
+from app.uploads import SpooledUpload
+from app.config import LIMITS, OPENAI_RESPONSE_FORMAT_VERSION
+from app.metrics import METRICS
+from app.auto_logging import AutoLogger
+
+
+class PDFPipeline:
+    """Runs text extraction -> OCR -> ChatGPT -> enrichment with each stage on its own bounded pool,
+    so different documents occupy different stages at the same time"""
+    def __init__(self, openai_client, google_client=None, openregister_client=None, cache=None) -> None:
+        self.openai_client = openai_client
+        self.google_client = google_client
+        self.openregister_client = openregister_client
+        self.cache = cache
+        self.in_flight = asyncio.Semaphore(LIMITS.pipeline_in_flight)  # Bounds the documents held in memory
+        self.logger = AutoLogger("PDFPipeline")
+
+    @staticmethod
+    def cache_key(sha256: str) -> str:
+        """Key results by the file's content hash and the version of the response format"""
+        return f"{sha256}:{OPENAI_RESPONSE_FORMAT_VERSION}"
+
+    async def extract_text(self, upload: SpooledUpload) -> str:
+        """Parse the text layer in worker processes, sending only scanned pages to the google client's OCR"""
+        return await extract_text_with_ocr(upload.source(), self.google_client)
+
+    async def process(self, upload: SpooledUpload) -> APIResponse:
+        """Run a single PDF through all stages"""
+        async with self.in_flight:
+            cache_key = self.cache_key(upload.sha256)
+            if self.cache is not None:
+                cached = await asyncio.to_thread(self.cache.get, cache_key)
+                if cached is not None:
+                    return APIResponse(200, "Data processed successfully", CompanyData.from_dict(data=cached))
+
+            file_text = await self.extract_text(upload)
+            if not file_text:   # May happen if google client is unavailable and a scanned PDF is passed
+                return ClientResponse(status_code=400, message="Failed to extract text from PDF").to_APIResponse()
+
+            with METRICS.stage("llm"):
+                response = await EXECUTORS.openai.run(lambda: self.openai_client.process_text(file_text))
+            if response.status_code != 200:
+                return response
+
+            if self.openregister_client:
+                with METRICS.stage("enrichment"):
+                    await EXECUTORS.openregister.run(lambda: self.openregister_client.enrich_data(response.data))
+            if self.cache is not None:    # Only cache successful extractions
+                await asyncio.to_thread(self.cache.set, cache_key, response.data.to_dict())
+            return response
+
+    async def process_many(self, uploads: list[SpooledUpload]) -> list[APIResponse]:
+        """Run many PDFs through the pipeline concurrently, returns the responses in input order"""
+        self.logger.debug(f"Processing a batch of {len(uploads)} PDFs")
+        results = await asyncio.gather(*(self.process(upload) for upload in uploads),
+                                       return_exceptions=True)
+        for i, result in enumerate(results):   # One failing document must not fail the whole batch
+            if isinstance(result, Exception):
+                self.logger.warn(f"Processing PDF {i} of the batch failed: {result}")
+                results[i] = ClientResponse(status_code=400, message=str(result)).to_APIResponse()
+        return results
@@ -0,0 +1,56 @@
+"""Sampling profiler of the running process, served by /admin/profile as collapsed stacks for flamegraphs"""
+
+import os
+import sys
+import time
+import threading
+from collections import Counter
+
+IDLE_FILES = ("/threading.py", "/selectors.py", "/queue.py",    # Innermost frame of a thread waiting for work
+              "/concurrent/futures/thread.py", "/multiprocessing/connection.py")
+PROFILE_LOCK = threading.Lock()     # One profile at a time, samples of two would slow down each other
+
+
+def short_path(filename: str) -> str:
+    """Shorten a code file's path to the part below site-packages or the working directory"""
+    if "site-packages" + os.sep in filename:
+        return filename.rsplit("site-packages" + os.sep, 1)[1]
+    if filename.startswith(os.getcwd() + os.sep):
+        return os.path.relpath(filename)
+    return os.path.basename(filename)
+
+
+def frame_name(frame) -> str:
+    """Name a frame's function like func (app/util.py:33)"""
+    code = frame.f_code
+    return f"{code.co_name} ({short_path(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+
+def sample(counts: Counter, thread_names: dict, include_idle: bool) -> None:
+    """Add the current stack of every other thread to counts, keyed by thread;outermost;...;innermost"""
+    own = threading.get_ident()
+    for ident, frame in sys._current_frames().items():
+        if ident == own or (not include_idle and frame.f_code.co_filename.endswith(IDLE_FILES)):
+            continue
+        stack = []
+        while frame is not None:
+            stack.append(frame_name(frame))
+            frame = frame.f_back
+        stack.append(thread_names.get(ident, f"thread-{ident}"))
+        counts[";".join(reversed(stack))] += 1
+
+
+def profile(seconds: float, interval: float, include_idle: bool = False) -> Counter:
+    """Sample the stacks of all threads every interval for the given seconds, returns the count per stack"""
+    counts = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        sample(counts, thread_names, include_idle)
+        time.sleep(interval)
+    return counts
+
+
+def collapsed(counts: Counter) -> str:
+    """Format stack counts in the collapsed format of flamegraph.pl, speedscope and inferno"""
+    return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
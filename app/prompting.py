@@ -0,0 +1,132 @@
+"""Preparation of extracted document text for ChatGPT within a token budget"""
+
+import re
+import threading
+from app.auto_logging import AutoLogger
+
+try:    # Exact token counts if tiktoken is installed, an estimate otherwise
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+promptLogger = AutoLogger("prompting")
+
+SECTION_KEYWORDS = {   # Patterns hinting at the fields of OPENAI_RESPONSE_FORMAT and their weight
+    r"handelsregister|registergericht|amtsgericht|hr\s?[ab]\b|register": 5,
+    r"gmbh|\bag\b|\bug\b|\bkg\b|\bohg\b|\bgbr\b|\bse\b|firma|company|gesellschaft\b": 3,
+    r"gesch[äa]ftsf[üu]hr|vorstand|prokur|vertret|managing director|representative": 4,
+    r"gesellschafter|shareholder|anteil|beteiligung|owner": 4,
+    r"stammkapital|grundkapital|kapital|capital|\beur\b|€|nennbetrag": 4,
+    r"\bsitz\b|anschrift|stra(ß|ss)e|str\.|\b\d{5}\b|address": 2,
+    r"gegenstand|unternehmensgegenstand|zweck|purpose": 2,
+    r"geboren|geb\.|\b\d{1,2}\.\d{1,2}\.\d{4}\b|date of birth": 2,
+    r"tel\.?|telefon|phone|e-?mail|@": 1,
+    r"unterschrift|signature|datum|\bort\b": 1
+}
+SECTION_PATTERNS = [(re.compile(pattern, re.IGNORECASE), weight) for pattern, weight in SECTION_KEYWORDS.items()]
+NOISE_LINE = re.compile(r"^[\W_]{3,}$")    # Lines of only dots, dashes, underscores etc.
+
+
+class PromptStats:
+    """Counts the tokens of the extracted texts and of the prompts actually sent"""
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.documents = 0
+        self.truncated = 0
+        self.tokens_in = 0
+        self.tokens_sent = 0
+
+    def record(self, tokens_in: int, tokens_sent: int) -> None:
+        """Record a prepared prompt"""
+        with self.lock:
+            self.documents += 1
+            self.truncated += tokens_sent < tokens_in
+            self.tokens_in += tokens_in
+            self.tokens_sent += tokens_sent
+
+    def to_dict(self) -> dict:
+        """Turn the counters into a dict"""
+        return {"documents": self.documents, "truncated": self.truncated, "tokens_in": self.tokens_in,
+                "tokens_sent": self.tokens_sent, "tokens_saved": self.tokens_in - self.tokens_sent}
+
+
+class TokenCounter:
+    """Counts tokens locally, with tiktoken if available and about 4 characters per token otherwise"""
+    def __init__(self, model: str) -> None:
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                self.encoding = tiktoken.encoding_for_model(model)
+            except Exception as e:      # Unknown model or the encoding can't be loaded
+                promptLogger.warn(f"Estimating token counts, tiktoken failed: {e}")
+
+    def __call__(self, text: str) -> int:
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        return -(-len(text) // 4)
+
+    def truncate(self, text: str, tokens: int) -> str:
+        """Cut text down to its first tokens"""
+        if self.encoding is not None:
+            return self.encoding.decode(self.encoding.encode(text, disallowed_special=())[:tokens])
+        return text[:tokens * 4]
+
+
+def normalize_text(text: str) -> str:
+    """Remove OCR and layout noise: hyphenated line breaks, repeated whitespace and filler lines"""
+    text = text.replace("\r\n", "\n").replace("\r", "\n").replace("\u00ad", "")  # Soft hyphens
+    text = re.sub(r"(\w)-\n(\w)", r"\1\2", text)       # Words hyphenated at the end of a line
+    text = re.sub(r"[^\S\n]+", " ", text)               # Runs of spaces and tabs
+    lines = [line.strip() for line in text.split("\n")]
+    lines = [line for line in lines if not NOISE_LINE.match(line)]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+def split_sections(text: str, max_chars: int = 2000) -> list[str]:
+    """Split text into paragraphs, cutting overly long ones at line breaks"""
+    sections = []
+    for paragraph in text.split("\n\n"):
+        current = ""
+        lines = [line[i:i + max_chars] for line in paragraph.split("\n")    # Cut lines without breaks
+                 for i in range(0, max(len(line), 1), max_chars)]
+        for line in lines:
+            if current and len(current) + len(line) > max_chars:
+                sections.append(current)
+                current = ""
+            current = f"{current}\n{line}" if current else line
+        if current:
+            sections.append(current)
+    return sections
+
+
+def score_section(section: str, index: int, count: int) -> float:
+    """Score how likely a section holds wanted fields, headers and signature blocks score extra"""
+    score = sum(weight * len(pattern.findall(section)) for pattern, weight in SECTION_PATTERNS)
+    if index < 2 or index >= count - 2:     # Header and signature blocks
+        score += 10
+    return score / (1 + len(section) / 500)     # Prefer dense sections
+
+
+def prepare_prompt(text: str, budget: int, count_tokens: TokenCounter) -> tuple[str, int, int]:
+    """Normalize the text and keep the most relevant sections within the token budget,
+    returns the prompt and the token counts of the text before and after"""
+    tokens_in = count_tokens(text)
+    text = normalize_text(text)
+    tokens = count_tokens(text)
+    if tokens <= budget:
+        return text, tokens_in, tokens
+
+    sections = split_sections(text)
+    costs = [count_tokens(section) for section in sections]
+    ranked = sorted(range(len(sections)), key=lambda i: score_section(sections[i], i, len(sections)),
+                    reverse=True)
+    selected, used = set(), 0
+    for i in ranked:   # Greedily take the best sections that still fit
+        if used + costs[i] <= budget:
+            selected.add(i)
+            used += costs[i]
+    if not selected:    # Not even a single section fits, send the start of the best one
+        prompt = count_tokens.truncate(sections[ranked[0]], budget)
+        return prompt, tokens_in, count_tokens(prompt)
+    prompt = "\n\n".join(sections[i] for i in sorted(selected))     # Keep the document order
+    return prompt, tokens_in, used
@@ -0,0 +1,121 @@
+"""Client-side rate limiting of upstream calls"""
+
+import os
+import json
+import time
+import fcntl
+import threading
+from collections import deque
+
+
+class AdmissionTimeout(Exception):
+    """Raised when no capacity becomes available before the admission deadline"""
+
+
+class MemoryBucketStore:
+    """Keeps the token bucket state in this process"""
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.state = {}
+
+    def update(self, func):
+        """Atomically replace the state with func(state), returns func's second result"""
+        with self.lock:
+            self.state, result = func(self.state)
+            return result
+
+
+class FileBucketStore:
+    """Keeps the token bucket state in a local file, so all worker processes share it"""
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()    # flock only excludes other processes, not other threads
+
+    def update(self, func):
+        """Atomically replace the state with func(state), returns func's second result"""
+        with self.lock, open(self.path, "a+", encoding="utf-8") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                file.seek(0)
+                content = file.read()
+                state, result = func(json.loads(content) if content else {})
+                file.seek(0)
+                file.truncate()
+                file.write(json.dumps(state))
+                file.flush()
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+        return result
+
+
+class RateLimiter:
+    """Token buckets for requests and tokens per minute with first come, first served admission"""
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int, store=None) -> None:
+        self.limits = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.store = store if store is not None else MemoryBucketStore()
+        self.condition = threading.Condition()
+        self.queue = deque()    # Tickets of the waiting callers, in arrival order
+
+    def refill(self, state: dict, now: float) -> dict:
+        """Add the tokens accumulated since the last update to both buckets"""
+        buckets = {}
+        for name, limit in self.limits.items():
+            level, updated = state.get(name, (limit, now))
+            buckets[name] = (min(limit, level + (now - updated) * limit / 60), now)
+        return buckets
+
+    def try_acquire(self, tokens: int) -> float:
+        """Take a request and tokens if both buckets hold enough, returns 0 on success or the
+        seconds until they will"""
+        def take(state: dict):
+            now = time.time()
+            buckets = self.refill(state, now)
+            needed = {"requests": 1, "tokens": min(tokens, self.limits["tokens"])}
+            wait = max((needed[name] - buckets[name][0]) * 60 / self.limits[name] for name in needed)
+            if wait <= 0:
+                buckets = {name: (buckets[name][0] - needed[name], now) for name in needed}
+            return buckets, max(wait, 0)
+        return self.store.update(take)
+
+    def adjust(self, tokens: int) -> None:
+        """Correct the token bucket once the actual usage is known (negative values refund tokens)"""
+        def correct(state: dict):
+            buckets = self.refill(state, time.time())
+            level, updated = buckets["tokens"]
+            buckets["tokens"] = (min(self.limits["tokens"], level - tokens), updated)  # May go into debt
+            return buckets, None
+        self.store.update(correct)
+
+    def pause(self, seconds: float) -> None:
+        """Hold back all callers for the given seconds, e.g. as asked by a Retry-After header"""
+        def drain(state: dict):
+            buckets = self.refill(state, time.time())
+            level, updated = buckets["requests"]
+            buckets["requests"] = (min(level, 1 - seconds * self.limits["requests"] / 60), updated)
+            return buckets, None
+        self.store.update(drain)
+
+    def acquire(self, tokens: int, timeout: float) -> bool:
+        """Wait in line for a request and tokens, returns False if they aren't available within timeout"""
+        deadline = time.monotonic() + timeout
+        ticket = object()
+        with self.condition:
+            self.queue.append(ticket)
+            try:
+                while True:
+                    wait = self.try_acquire(tokens) if self.queue[0] is ticket else timeout
+                    if wait == 0:
+                        return True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or (self.queue[0] is ticket and wait > remaining):
+                        return False    # Fail fast instead of waiting past the deadline
+                    self.condition.wait(min(wait, remaining))
+            finally:
+                self.queue.remove(ticket)
+                self.condition.notify_all()
+
+
+def create_rate_limiter(requests_per_minute: int, tokens_per_minute: int, state_path: str = "") -> RateLimiter:
+    """Create a rate limiter, shared between processes through state_path if one is given"""
+    store = FileBucketStore(os.path.abspath(state_path)) if state_path else MemoryBucketStore()
+    return RateLimiter(requests_per_minute, tokens_per_minute, store)
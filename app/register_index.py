@@ -0,0 +1,142 @@
+"""Local index of german company register records, answering searches without calling openregister"""
+
+import csv
+import json
+import time
+import sqlite3
+import argparse
+from itertools import islice
+from contextlib import contextmanager
+from app.util import strip_legal_form
+from app.auto_logging import AutoLogger
+
+INDEXED_FIELDS = ("company_id", "name", "register_court", "register_number", "register_type")
+
+
+class RegisterIndex:
+    """Company records in a SQLite database, names searchable by FTS5 with the trigram tokenizer,
+    records findable by company_id and register court/number"""
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.logger = AutoLogger("RegisterIndex")
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS companies (
+                    id INTEGER PRIMARY KEY,     -- Stable rowid for the external content table
+                    company_id TEXT NOT NULL UNIQUE,
+                    name TEXT NOT NULL,
+                    register_court TEXT,
+                    register_number TEXT,
+                    register_type TEXT,
+                    record TEXT NOT NULL,
+                    updated REAL NOT NULL);
+                CREATE INDEX IF NOT EXISTS companies_register ON companies (register_court, register_number);
+                CREATE VIRTUAL TABLE IF NOT EXISTS company_names USING fts5(
+                    name, content='companies', content_rowid='id', tokenize='trigram');
+                CREATE TRIGGER IF NOT EXISTS companies_insert AFTER INSERT ON companies BEGIN
+                    INSERT INTO company_names (rowid, name) VALUES (new.id, new.name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS companies_delete AFTER DELETE ON companies BEGIN
+                    INSERT INTO company_names (company_names, rowid, name) VALUES ('delete', old.id, old.name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS companies_update AFTER UPDATE OF name ON companies BEGIN
+                    INSERT INTO company_names (company_names, rowid, name) VALUES ('delete', old.id, old.name);
+                    INSERT INTO company_names (rowid, name) VALUES (new.id, new.name);
+                END;""")
+
+    @contextmanager
+    def connect(self):
+        """Open a connection for a single transaction"""
+        connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def load(self, records, batch_size: int = 10000) -> int:
+        """Insert or refresh company records (dicts with at least company_id and name), returns how many"""
+        loaded = 0
+        records = iter(records)
+        with self.connect() as connection:
+            while batch := list(islice(records, batch_size)):   # One transaction per batch
+                now = time.time()
+                rows = [(*(str(record.get(field) or "") for field in INDEXED_FIELDS),
+                         json.dumps(record), now)
+                        for record in batch if record.get("company_id") and record.get("name")]
+                connection.execute("BEGIN")
+                connection.executemany("""INSERT INTO companies (company_id, name, register_court, register_number,
+                                                                 register_type, record, updated)
+                                          VALUES (?, ?, ?, ?, ?, ?, ?)
+                                          ON CONFLICT (company_id) DO UPDATE SET name = excluded.name,
+                                              register_court = excluded.register_court,
+                                              register_number = excluded.register_number,
+                                              register_type = excluded.register_type,
+                                              record = excluded.record, updated = excluded.updated""", rows)
+                connection.execute("COMMIT")
+                loaded += len(rows)
+        return loaded
+
+    def search(self, company_name: str, max_age: float, limit: int = 100) -> list[dict]:
+        """Find the records whose name has all words of company_name (legal forms aside), or any word if none
+        has all, best first, ignoring records older than max_age seconds"""
+        words = [word for word in strip_legal_form(company_name).split() if len(word) >= 3]  # Trigram minimum
+        if not words:
+            return []
+        phrases = ['"' + word.replace('"', '""') + '"' for word in words]
+        with self.connect() as connection:
+            for operator in (" AND ", " OR "):  # Names with all words are cheap to find, any word as a fallback
+                rows = connection.execute("""SELECT companies.record FROM company_names
+                                             JOIN companies ON companies.id = company_names.rowid
+                                             WHERE company_names MATCH ? AND companies.updated >= ?
+                                             ORDER BY company_names.rank LIMIT ?""",
+                                          (operator.join(phrases), time.time() - max_age, limit)).fetchall()
+                if rows or len(phrases) == 1:
+                    break
+        return [json.loads(row[0]) for row in rows]
+
+    def get(self, company_id: str, max_age: float) -> dict | None:
+        """Get the record of a company, None if unknown or older than max_age seconds"""
+        with self.connect() as connection:
+            row = connection.execute("SELECT record FROM companies WHERE company_id = ? AND updated >= ?",
+                                     (company_id, time.time() - max_age)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def find_by_register(self, register_court: str, register_number: str, max_age: float) -> list[dict]:
+        """Get the records registered under a court and number, ignoring records older than max_age seconds"""
+        with self.connect() as connection:
+            rows = connection.execute("""SELECT record FROM companies WHERE register_court = ?
+                                         AND register_number = ? AND updated >= ?""",
+                                      (register_court, str(register_number), time.time() - max_age)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def count(self) -> int:
+        """Count the indexed companies"""
+        with self.connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM companies").fetchone()[0]
+
+
+def read_records(path: str):
+    """Read company records from a JSONL or CSV register dump"""
+    with open(path, encoding="utf-8", newline="") as file:
+        if path.lower().endswith(".csv"):
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+if __name__ == "__main__":   # Bulk load register dumps: python -m app.register_index <file>...
+    from app.config import REGISTER_INDEX
+
+    parser = argparse.ArgumentParser(description="Load company records from JSONL or CSV files into the index")
+    parser.add_argument("files", nargs="+", help="JSONL or CSV files with company_id, name, register_court, ...")
+    parser.add_argument("--path", default=REGISTER_INDEX.path or "register-index.sqlite3",
+                        help="SQLite file of the index")
+    args = parser.parse_args()
+
+    index = RegisterIndex(args.path)
+    for path in args.files:
+        index.logger.info(f"Loaded {index.load(read_records(path))} companies from {path}")
+    index.logger.info(f"{index.count()} companies are indexed in {args.path}")
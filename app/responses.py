@@ -1,6 +1,8 @@
 """Response types for clients and API"""
 
+from fastapi.responses import Response
 from app.company_data import CompanyData
+from app.mapping import encode_json
 
 class ClientResponse:
     """Base class for Client responses."""
@@ -30,3 +32,20 @@ class APIResponse:
             "message": self.message,
             "data": self.data.to_dict()
         }
+
+    def to_encodable(self) -> dict:
+        """Convert the response to data encode_json takes, without intermediate dicts where possible"""
+        return {
+            "status_code": self.status_code,
+            "message": self.message,
+            "data": self.data.to_encodable()
+        }
+
+    def to_json(self) -> bytes:
+        """Convert the response to JSON bytes"""
+        return encode_json(self.to_encodable())
+
+
+class EncodedJSONResponse(Response):
+    """Response of already encoded JSON bytes, skipping FastAPI's jsonable_encoder and re-encoding"""
+    media_type = "application/json"
@@ -0,0 +1,62 @@
+"""Serving the API in one or more worker processes: python -m app.server"""
+
+from importlib.util import find_spec
+from app.config import SERVER, STARTUP
+from app.auto_logging import AutoLogger
+
+logger = AutoLogger("Server")
+APP_PATH = "app.main:app"   # Imported by each worker if gunicorn isn't installed
+
+
+def load_app(api=None):
+    """Get the ASGI app of the API (creating the API if none is given), with its clients built
+    before the workers are forked if SERVER.preload is set"""
+    if api is None:
+        from app.main import api
+    if SERVER.preload and STARTUP.warm_up:
+        api.load_clients()  # Forked workers share the imports and authenticated clients
+    return api.app
+
+
+def serve_gunicorn(api=None) -> None:
+    """Serve the app with gunicorn in SERVER.workers uvicorn workers, forked from the loaded app if SERVER.preload
+    is set"""
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+        """Gunicorn application configured from SERVER"""
+        def load_config(self) -> None:
+            for key, value in {"bind": f"{SERVER.host}:{SERVER.port}", "workers": SERVER.workers,
+                               "worker_class": "uvicorn_worker.UvicornWorker", "preload_app": SERVER.preload,
+                               "max_requests": SERVER.max_requests,
+                               "max_requests_jitter": SERVER.max_requests_jitter,
+                               "graceful_timeout": SERVER.graceful_timeout}.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return load_app(api)
+
+    Application().run()
+
+
+def serve(api=None) -> None:
+    """Serve the API, in SERVER.workers worker processes if there are more than one"""
+    import uvicorn
+    if SERVER.workers <= 1:    # Clients are built by the warm-up once serving
+        if api is None:
+            from app.main import api
+        uvicorn.run(api.app, host=SERVER.host, port=SERVER.port,
+                    timeout_graceful_shutdown=SERVER.graceful_timeout)
+        return
+
+    if find_spec("gunicorn") is not None:
+        serve_gunicorn(api)
+    else:   # Workers without preloading, each imports the app and builds its clients
+        logger.warn("gunicorn isn't installed, serving with uvicorn's workers (without preloading)")
+        uvicorn.run(APP_PATH, host=SERVER.host, port=SERVER.port, workers=SERVER.workers,
+                    limit_max_requests=SERVER.max_requests or None,    # Recycled workers are restarted
+                    timeout_graceful_shutdown=SERVER.graceful_timeout)
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,38 @@
+"""Timing of the startup phases, imported first so the imports are timed as well"""
+
+import os
+import time
+from app.auto_logging import AutoLogger
+
+
+class StartupTimer:
+    """Records how long each phase of the startup took"""
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.last = self.started
+        self.phases = {}    # Phase -> seconds
+        self.logger = AutoLogger("Startup")
+        os.register_at_fork(after_in_child=self.restart)   # Workers forked from a preloaded app
+
+    def restart(self) -> None:
+        """Start timing again, the phases before were done by the parent process"""
+        self.started = self.last = time.perf_counter()
+        self.phases = {}
+
+    def mark(self, phase: str) -> None:
+        """End a phase, which began where the previous one ended"""
+        now = time.perf_counter()
+        self.phases[phase] = now - self.last
+        self.last = now
+
+    def elapsed(self) -> float:
+        """Seconds since the timer was created"""
+        return time.perf_counter() - self.started
+
+    def report(self) -> None:
+        """Log the time until ready and the time of each phase"""
+        phases = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.phases.items())
+        self.logger.info(f"Ready after {self.elapsed():.2f}s ({phases})")
+
+
+STARTUP_TIMER = StartupTimer()
@@ -0,0 +1,131 @@
+"""Tests of the bulk extraction against a local fake of the OpenAI Batch API, run with
+python -m pytest app/test_files/test_bulk.py"""
+
+import os
+import json
+import time
+import shutil
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from app.bulk import BulkExtractor, OpenAIBatchBackend, hash_file
+from app.cache import create_cache
+from app.clients.openai_client import OpenAIClient
+from app.config import BULK
+from app.executors import EXECUTORS
+
+PDFS = os.path.join(os.path.dirname(__file__), "pdfs")
+ANSWER = {"success": True, "data": {
+    "company": {"name": "Muster GmbH", "address": "", "city": "Berlin", "postal_code": "", "street": "",
+                "legal_form": "GmbH", "purpose": "", "german_company_registration_number": "", "register_court": "",
+                "register_number": "", "country": "DE", "register_type": "", "support_phone": "",
+                "support_email": "", "status": "", "industry_codes": []},
+    "representatives": [], "owners": [], "capital": {"total_amount": 25000, "total_shares": 0, "currency": "EUR"}}}
+
+
+class FakeBatchAPI(BaseHTTPRequestHandler):
+    """Speaks just enough of the files and batches endpoints for OpenAIBatchBackend"""
+    files, batches, failing = {}, {}, set()     # Reset by the fixture
+
+    def reply(self, data: dict, body: bytes = None) -> None:
+        body = body if body is not None else json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        content = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.path == "/v1/files":    # Multipart upload, keep the request lines of the JSONL file
+            lines = [line for line in content.decode().splitlines() if line.startswith('{"custom_id"')]
+            file_id = f"file-{len(self.files)}"
+            self.files[file_id] = "\n".join(lines)
+            self.reply({"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                        "filename": "batch.jsonl", "purpose": "batch", "status": "processed"})
+        elif self.path == "/v1/batches":
+            batch_id = f"batch-{len(self.batches)}"
+            self.batches[batch_id] = {"input_file_id": json.loads(content)["input_file_id"], "polls": 0}
+            self.reply(self.batch(batch_id))
+
+    def do_GET(self) -> None:
+        if self.path.startswith("/v1/batches/"):
+            batch_id = self.path.rsplit("/", 1)[1]
+            self.batches[batch_id]["polls"] += 1
+            self.reply(self.batch(batch_id))
+        elif self.path.startswith("/v1/files/") and self.path.endswith("/content"):
+            self.reply({}, self.files[self.path.split("/")[3]].encode())
+
+    def batch(self, batch_id: str) -> dict:
+        """The batch object, completed with output and error files from its second poll on"""
+        batch = self.batches[batch_id]
+        data = {"id": batch_id, "object": "batch", "endpoint": "/v1/chat/completions", "completion_window": "24h",
+                "input_file_id": batch["input_file_id"], "created_at": int(time.time()), "status": "in_progress"}
+        if batch["polls"] >= 2:
+            if "output_file_id" not in batch:
+                self.run_batch(batch)
+            data.update(status="completed", output_file_id=batch["output_file_id"],
+                        error_file_id=batch["error_file_id"])
+        return data
+
+    def run_batch(self, batch: dict) -> None:
+        """Answer every request line, failing those of the custom_ids in failing"""
+        outputs, errors = [], []
+        for line in self.files[batch["input_file_id"]].splitlines():
+            custom_id = json.loads(line)["custom_id"]
+            if custom_id in self.failing:
+                errors.append({"custom_id": custom_id, "response": None,
+                               "error": {"code": "server_error", "message": "The model failed"}})
+            else:
+                outputs.append({"custom_id": custom_id, "error": None, "response": {"status_code": 200, "body": {
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": json.dumps(ANSWER)}}]}}})
+        for key, lines in (("output_file_id", outputs), ("error_file_id", errors)):
+            batch[key] = f"file-{len(self.files)}"
+            self.files[batch[key]] = "\n".join(json.dumps(line) for line in lines)
+
+    def log_message(self, *args) -> None:
+        return
+
+
+@pytest.fixture
+def server(monkeypatch):
+    FakeBatchAPI.files, FakeBatchAPI.batches, FakeBatchAPI.failing = {}, {}, set()
+    monkeypatch.setattr(BULK, "poll_interval", 0.01)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeBatchAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1"
+    server.shutdown()
+    EXECUTORS.pdf.shutdown()
+
+
+@pytest.fixture
+def pdfs(tmp_path):
+    """A typed PDF, a copy of it, another typed PDF and a scanned one"""
+    directory = tmp_path / "pdfs"
+    directory.mkdir()
+    for source, name in (("muster-gesellschaftsvertrag-gmbh.pdf", "a.pdf"),
+                         ("muster-gesellschaftsvertrag-gmbh.pdf", "b.pdf"), ("Gesellschafterliste.pdf", "c.pdf"),
+                         ("_Gesellschaftsvertrag 1. Seite (eingescannt).pdf", "d.pdf")):
+        shutil.copy(os.path.join(PDFS, source), directory / name)
+    return [str(directory / name) for name in ("a.pdf", "b.pdf", "c.pdf", "d.pdf")]
+
+
+def test_bulk_run_through_the_batch_api(server, pdfs, tmp_path):
+    FakeBatchAPI.failing = {hash_file(pdfs[2])}
+    cache = create_cache("Test", max_entries=16, ttl=60)
+    extractor = BulkExtractor(OpenAIClient("test-token"), OpenAIBatchBackend("test-token", base_url=server),
+                              cache=cache)
+    results = asyncio.run(extractor.run(pdfs, str(tmp_path / "work")))
+
+    assert [result["filename"] for result in results] == ["a.pdf", "b.pdf", "c.pdf", "d.pdf"]
+    assert [result["status_code"] for result in results] == [200, 200, 400, 400]
+    assert results[0]["data"]["company"]["name"] == "Muster GmbH"
+    assert results[0] == {**results[1], "filename": "a.pdf"}   # The copy shares the result
+    assert results[2]["message"] == "The model failed"
+    assert len(FakeBatchAPI.batches) == 1
+    assert len(FakeBatchAPI.files["file-0"].splitlines()) == 2     # The copy and the scan need no request
+
+    results = asyncio.run(extractor.run(pdfs[:2], str(tmp_path / "work")))
+    assert [result["status_code"] for result in results] == [200, 200]
+    assert len(FakeBatchAPI.batches) == 1   # Answered from the result cache
@@ -0,0 +1,103 @@
+"""Tests of the caches and single-flight, run with python -m pytest app/test_files/test_cache.py"""
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from app.cache import MISSING, MemoryCache, SingleFlight, create_cache
+from app.clients.openregister_client import OpenregisterClient
+
+
+@pytest.fixture
+def client():
+    client = OpenregisterClient("token", cache=create_cache("Test", max_entries=16, ttl=60))
+    yield client
+    client.close()
+
+
+def test_memory_cache_evicts_least_recently_used():
+    cache = MemoryCache(max_entries=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b", MISSING) is MISSING
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats.evictions == 1
+
+
+def test_memory_cache_expires_entries():
+    cache = MemoryCache(ttl=60)
+    cache.set("a", 1, ttl=-1)
+    assert cache.get("a", MISSING) is MISSING
+    assert len(cache) == 0
+
+
+def test_tiered_cache_promotes_disk_hits_with_their_expiry(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    create_cache("Test", max_entries=16, ttl=60, sqlite_path=path).set("a", {"b": [1]}, ttl=30)
+    cache = create_cache("Test", max_entries=16, ttl=60, sqlite_path=path)    # Like another worker process
+    assert cache.get("a") == {"b": [1]}
+    expires, value = cache.memory.entries["a"]
+    assert value == {"b": [1]} and expires <= time.time() + 30
+    assert cache.to_dict()["disk"]["hits"] == 1
+    cache.get("a")
+    assert cache.to_dict()["disk"]["hits"] == 1   # Answered by the memory tier
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    single_flight, calls, release = SingleFlight(), [], threading.Event()
+
+    def call():
+        calls.append(1)
+        release.wait(5)
+        return "result"
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        futures = [pool.submit(single_flight.do, "key", call) for _ in range(4)]
+        while single_flight.coalesced < 3:
+            time.sleep(0.01)
+        release.set()
+        assert [future.result() for future in futures] == ["result"] * 4
+    assert len(calls) == 1 and single_flight.calls == {}
+
+
+def test_single_flight_shares_errors():
+    single_flight, release = SingleFlight(), threading.Event()
+
+    def call():
+        release.wait(5)
+        raise ValueError("failed")
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(single_flight.do, "key", call) for _ in range(2)]
+        while single_flight.coalesced < 1:
+            time.sleep(0.01)
+        release.set()
+        for future in futures:
+            with pytest.raises(ValueError):
+                future.result()
+    assert single_flight.calls == {}
+
+
+def test_not_found_is_cached_but_errors_are_not(client, monkeypatch):
+    answers = iter([(404, {}), (500, {}), (200, {"company_id": "DE-1"})])
+    calls = []
+    monkeypatch.setattr(client, "request", lambda *args, **kwargs: calls.append(args) or next(answers))
+    assert client.cached_request("details:DE-0", "https://api.openregister.de/v1/company/DE-0") == {}
+    assert client.cached_request("details:DE-0", "https://api.openregister.de/v1/company/DE-0") == {}
+    assert len(calls) == 1
+    assert client.cached_request("details:DE-1", "https://api.openregister.de/v1/company/DE-1") == {}
+    assert client.cached_request("details:DE-1", "https://api.openregister.de/v1/company/DE-1") == \
+        {"company_id": "DE-1"}
+    assert client.cached_request("details:DE-1", "https://api.openregister.de/v1/company/DE-1") == \
+        {"company_id": "DE-1"}
+    assert len(calls) == 3
+
+
+def test_empty_search_results_are_cached_as_not_found(client, monkeypatch):
+    calls = []
+    monkeypatch.setattr(client, "request", lambda *args, **kwargs: calls.append(args) or (200, {"results": []}))
+    for _ in range(2):
+        assert client.search_companies(company_name="Muster GmbH") == []
+    assert len(calls) == 1
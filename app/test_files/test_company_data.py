@@ -0,0 +1,195 @@
+"""Tests of the generated CompanyData mappers against the former hand-written mapping, run with
+python -m pytest app/test_files/test_company_data.py"""
+
+import json
+import pytest
+from app.company_data import CompanyData
+
+
+# The hand-written mapping CompanyData had before the field tables, building plain dicts in its field order
+def company(**values) -> dict:
+    return {"country": "", "name": "", "address": "", "city": "", "postal_code": "", "street": "",
+            "industry_codes": [], "legal_form": "", "purpose": "", "id": "", "register_court": "",
+            "register_number": "", "register_type": "", "support_phone": "", "support_email": "", "status": None,
+            **values}
+
+
+def person(**values) -> dict:
+    return {"city": "", "country": "", "street": "", "address": "", "name": "", "role": "", "date_of_birth": "",
+            "phone": "", "email": "", **values}
+
+
+def owner(**values) -> dict:
+    return {**person(), "shares_percentage": 0, "shares_nominal": 0, **values}
+
+
+def capital(**values) -> dict:
+    return {"total_amount": 0, "total_shares": 0, "currency": "", **values}
+
+
+def cleaned(data: dict) -> dict:
+    """Drop the people without any filled field, like the former cleanup in to_dict"""
+    return {**data, "representatives": [p for p in data["representatives"] if any(p.values())],
+            "owners": [p for p in data["owners"] if any(p.values())]}
+
+
+def baseline_from_chatgpt(data: dict) -> dict:
+    source = data["company"]
+    return cleaned({
+        "company": company(**{field: source[field] for field in (
+            "name", "address", "city", "postal_code", "street", "legal_form", "purpose", "register_court",
+            "register_number", "country", "register_type", "support_phone", "support_email", "status",
+            "industry_codes")}, id=source["german_company_registration_number"]),
+        "representatives": [person(**{field: p[field] for field in person()}) for p in data["representatives"]],
+        "owners": [owner(**{field: p[field] for field in owner()}) for p in data["owners"]],
+        "capital": capital(**data["capital"])})
+
+
+def baseline_from_openregister_details(data: dict) -> dict:
+    representatives = []
+    for p in data["representation"]:
+        details = p["natural_person"] if p["type"] == "natural_person" else p["legal_person"]
+        representatives.append(person(role=p.get("role"), name=p.get("name"),
+                                      date_of_birth=details.get("date_of_birth"), city=details.get("city"),
+                                      country=details.get("country")))
+    return cleaned({
+        "company": company(name=data["name"]["name"], address=data["address"]["formatted_value"],
+                           city=data["address"]["city"], postal_code=data["address"]["postal_code"],
+                           street=data["address"]["street"], legal_form=data["legal_form"],
+                           purpose=data.get("purpose")["purpose"] if data.get("purpose") else "", id=data["id"],
+                           register_court=data["register"]["register_court"],
+                           register_number=data["register"]["register_number"], country=data["address"]["country"],
+                           register_type=data["register"]["register_type"], status=data["status"]),
+        "representatives": representatives,
+        "owners": [],
+        "capital": capital(total_amount=data["capital"].get("amount"), currency=data["capital"].get("currency"))
+        if data.get("capital") else capital()})
+
+
+def baseline_from_openregister_owners(data: list) -> dict:
+    owners = []
+    for p in data:
+        values = {"role": p.get("relation_type"), "shares_nominal": p.get("nominal_share"),
+                  "shares_percentage": p.get("percentage_share")}
+        if p.get("type") == "natural_person":
+            values.update(city=p["natural_person"].get("city"), country=p["natural_person"].get("country"),
+                          date_of_birth=p["natural_person"].get("date_of_birth"),
+                          name=p["natural_person"].get("full_name"))
+        elif p.get("type") == "legal_person":
+            values.update(city=p["legal_person"].get("city"), country=p["legal_person"].get("country"),
+                          name=p["legal_person"].get("name"))
+        owners.append(owner(**values))
+    return cleaned({"company": company(), "representatives": [], "owners": owners, "capital": capital()})
+
+
+CHATGPT = {
+    "company": {"name": "Muster GmbH", "address": "Musterstr. 1, 10115 Berlin", "city": "Berlin",
+                "postal_code": "10115", "street": "Musterstr. 1", "legal_form": "GmbH", "purpose": "Handel",
+                "german_company_registration_number": "HRB 12345", "register_court": "Berlin (Charlottenburg)",
+                "register_number": "12345", "country": "DE", "register_type": "HRB", "support_phone": "",
+                "support_email": "info@muster.de", "status": "active", "industry_codes": ["46.90"]},
+    "representatives": [person(name="Max Muster", role="Geschäftsführer", date_of_birth="1970-01-01"), person()],
+    "owners": [owner(name="Erika Muster", shares_percentage=60, shares_nominal=15000), owner()],
+    "capital": {"total_amount": 25000, "total_shares": 2, "currency": "EUR"}
+}
+DETAILS = {
+    "id": "DE-HRB-F1103-12345", "name": {"name": "Muster GmbH"}, "legal_form": "gmbh", "status": "active",
+    "address": {"formatted_value": "Musterstr. 1, 10115 Berlin", "city": "Berlin", "postal_code": "10115",
+                "street": "Musterstr. 1", "country": "DE"},
+    "register": {"register_court": "Berlin (Charlottenburg)", "register_number": "12345", "register_type": "HRB"},
+    "purpose": {"purpose": "Handel mit Waren aller Art"},
+    "capital": {"amount": 25000, "currency": "EUR"},
+    "representation": [
+        {"type": "natural_person", "role": "managing_director", "name": "Max Muster",
+         "natural_person": {"date_of_birth": "1970-01-01", "city": "Berlin", "country": "DE"}},
+        {"type": "legal_person", "role": "general_partner", "name": "Muster Verwaltungs GmbH",
+         "legal_person": {"city": "Hamburg"}}]
+}
+OWNERS = [
+    {"type": "natural_person", "relation_type": "shareholder", "nominal_share": 15000, "percentage_share": 60,
+     "natural_person": {"full_name": "Erika Muster", "city": "Berlin", "country": "DE",
+                        "date_of_birth": "1972-02-02"}},
+    {"type": "legal_person", "relation_type": "shareholder", "nominal_share": 10000, "percentage_share": 40,
+     "legal_person": {"name": "Muster Holding AG", "city": "München"}},
+    {"type": "other", "relation_type": "shareholder", "percentage_share": 0}
+]
+
+
+def dumps(data: dict) -> str:
+    return json.dumps(data, ensure_ascii=False)     # Compares the field order as well
+
+
+def test_from_chatgpt_maps_like_before():
+    assert dumps(CompanyData.from_chatgpt(data=CHATGPT).to_dict()) == dumps(baseline_from_chatgpt(CHATGPT))
+
+
+def test_from_chatgpt_fills_an_existing_object():
+    data = CompanyData()
+    assert data.from_chatgpt(CHATGPT) is data
+    assert dumps(data.to_dict()) == dumps(baseline_from_chatgpt(CHATGPT))
+
+
+@pytest.mark.parametrize("details", [
+    DETAILS,
+    {**DETAILS, "purpose": None, "capital": None},
+    {key: value for key, value in DETAILS.items() if key not in ("purpose", "capital")},
+    {**DETAILS, "representation": [{"type": "natural_person", "natural_person": {}}]}
+])
+def test_from_openregister_details_maps_like_before(details):
+    assert dumps(CompanyData.from_openregister_details(data=details).to_dict()) == \
+        dumps(baseline_from_openregister_details(details))
+
+
+def test_from_openregister_owners_maps_like_before():
+    assert dumps(CompanyData.from_openregister_owners(data=OWNERS).to_dict()) == \
+        dumps(baseline_from_openregister_owners(OWNERS))
+
+
+def test_merge_copies_filled_fields_like_before():
+    known = CompanyData.from_chatgpt(data=CHATGPT)
+    known.company.purpose = "Alter Zweck"
+    expected = baseline_from_chatgpt(CHATGPT)
+    details = baseline_from_openregister_details(DETAILS)
+    for field, value in details["company"].items():   # The former merge in enrich_data
+        if value and field not in ("support_phone", "support_email"):
+            expected["company"][field] = value
+    for field, value in details["capital"].items():
+        if value:
+            expected["capital"][field] = value
+    expected["owners"] = baseline_from_openregister_owners(OWNERS)["owners"]
+
+    known.merge(CompanyData.from_openregister_owners(data=OWNERS))
+    known.merge(CompanyData.from_openregister_details(data=DETAILS))
+    assert dumps(known.to_dict()) == dumps(expected)
+
+
+def test_merge_keeps_the_owners_if_none_are_found():
+    known = CompanyData.from_chatgpt(data=CHATGPT)
+    known.merge(CompanyData.from_openregister_owners(data=[]))
+    assert known.to_dict()["owners"] == baseline_from_chatgpt(CHATGPT)["owners"]
+
+
+def test_to_dict_returns_fresh_dicts_and_round_trips():
+    data = CompanyData.from_chatgpt(data=CHATGPT)
+    first = data.to_dict()
+    first["company"]["name"] = "Changed"
+    first["company"]["industry_codes"].append("00.00")
+    assert data.company.name == "Muster GmbH"
+    assert dumps(CompanyData.from_dict(data=data.to_dict()).to_dict()) == dumps(data.to_dict())
+
+
+def test_to_json_encodes_like_to_dict():
+    data = CompanyData.from_openregister_details(data=DETAILS)
+    data.merge(CompanyData.from_openregister_owners(data=OWNERS))
+    assert json.loads(data.to_json()) == data.to_dict()
+
+
+def test_cleanup_runs_again_after_people_are_replaced():
+    data = CompanyData.from_chatgpt(data=CHATGPT)
+    assert len(data.to_dict()["representatives"]) == 1 and data.is_clean()
+    data.representatives.people[0] = CompanyData.Representatives.Representative()   # Replaced in place
+    assert not data.is_clean()
+    assert data.to_dict()["representatives"] == []
+    data.owners.people.append(CompanyData.Owners.Owner())
+    assert not data.is_clean()
+    assert len(data.to_dict()["owners"]) == 1 and data.is_clean()
@@ -0,0 +1,76 @@
+"""Tests of the job store and queue, run with python -m pytest app/test_files/test_jobs.py"""
+
+import asyncio
+import time
+import pytest
+from app.config import JOBS
+from app.jobs import JobStore, JobQueue
+from app.responses import ClientResponse
+from app.uploads import SpooledUpload
+
+
+class SlowPipeline:
+    """PDF pipeline stand-in taking the given seconds per job"""
+    def __init__(self, seconds: float) -> None:
+        self.seconds = seconds
+
+    async def process(self, upload: SpooledUpload):
+        await asyncio.sleep(self.seconds)
+        return ClientResponse(status_code=200, message="Data processed successfully").to_APIResponse()
+
+
+def upload() -> SpooledUpload:
+    spooled = SpooledUpload()
+    spooled.write(b"%PDF-1.7")
+    return spooled.finish()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.sqlite3"))
+
+
+def test_only_expired_leases_are_requeued(store):
+    job_id = store.create("dataFromPDF", upload())
+    assert store.claim()[0] == job_id
+    assert store.requeue_stale(lease=60) == 0
+    time.sleep(0.02)
+    assert store.requeue_stale(lease=0.01) == 1
+    assert store.get(job_id)["status"] == "queued"
+
+
+def test_renewed_lease_isnt_requeued(store):
+    job_id = store.create("dataFromPDF", upload())
+    store.claim()
+    time.sleep(0.02)
+    store.renew(job_id)
+    assert store.requeue_stale(lease=0.01) == 0
+
+
+def test_running_job_keeps_its_lease(store, monkeypatch):
+    monkeypatch.setattr(JOBS, "lease", 0.3)
+    monkeypatch.setattr(JOBS, "poll_interval", 0.05)
+
+    async def run() -> tuple[int, dict]:
+        queue = JobQueue(store, SlowPipeline(1), workers=1)
+        job_id = await queue.submit(upload())
+        await queue.start()
+        await asyncio.sleep(0.7)    # Longer than the lease
+        requeued = store.requeue_stale(JOBS.lease)
+        job = await queue.wait(job_id, timeout=5)
+        await queue.stop()
+        assert queue.finished == {}
+        return requeued, job
+
+    requeued, job = asyncio.run(run())
+    assert requeued == 0 and job["status"] == "done"
+
+
+def test_wait_drops_its_event_when_timing_out(store):
+    async def run() -> JobQueue:
+        queue = JobQueue(store, SlowPipeline(0), workers=0)
+        job_id = await queue.submit(upload())
+        assert (await queue.wait(job_id, timeout=0.1))["status"] == "queued"
+        return queue
+
+    assert asyncio.run(run()).finished == {}
@@ -0,0 +1,96 @@
+"""Tests of the page-wise PDF text extraction and OCR merging, run with
+python -m pytest app/test_files/test_pdf_text.py"""
+
+import asyncio
+import pytest
+from app.config import PDF
+from app.executors import EXECUTORS
+from app.pdf_text import extract_pages, extract_page_pdf
+from app.responses import ClientResponse
+from app.util import extract_pages_parallel, extract_text_with_ocr, group_pages
+
+IMAGE = b"q 10 0 0 10 0 0 cm BI /W 1 /H 1 /CS /G /BPC 8 ID \x80 EI Q"   # An inline image, like a scan
+
+
+def make_pdf(pages: list[str | None]) -> bytes:
+    """Build a PDF with a page per entry, showing the text or (for None) only an image"""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        content = IMAGE if text is None else b"BT /F1 12 Tf 72 720 Td (" + text.encode() + b") Tj ET"
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents %d 0 R "
+                       b"/Resources << /Font << /F1 3 0 R >> >> >>" % len(objects))
+        kids.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(kids), len(kids))
+
+    pdf, offsets = b"%PDF-1.4\n", []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    return pdf + b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+
+
+class FakeOCR:
+    """Google client stand-in answering OCR calls with the page count of the PDF it got"""
+    def __init__(self) -> None:
+        self.page_counts = []
+
+    def __call__(self, file_stream) -> ClientResponse:
+        page_count = extract_pages(file_stream.read())[0]
+        self.page_counts.append(page_count)
+        return ClientResponse(status_code=200, message="OK", data={"text": f"[OCR of {page_count} pages]"})
+
+
+@pytest.fixture(autouse=True)
+def small_tasks(monkeypatch):
+    monkeypatch.setattr(PDF, "pages_per_task", 2)
+    monkeypatch.setattr(PDF, "ocr_pages_per_group", 2)
+    yield
+    EXECUTORS.pdf.shutdown()
+
+
+def test_pages_are_extracted_in_order_across_ranges():
+    texts = [f"Page {i} of the contract" for i in range(7)]
+    result = asyncio.run(extract_pages_parallel(make_pdf(texts), max_pages=None))
+    assert result is not None
+    assert [text.strip() for text in result[0]] == texts
+    assert result[1] == [False] * 7
+
+
+def test_max_pages_limits_the_extracted_pages():
+    texts, scanned = asyncio.run(extract_pages_parallel(make_pdf([f"Page {i} text" for i in range(5)]),
+                                                        max_pages=3))
+    assert len(texts) == len(scanned) == 3
+
+
+def test_unreadable_pdf_gives_none():
+    assert asyncio.run(extract_pages_parallel(b"not a pdf", max_pages=None)) is None
+
+
+def test_image_pages_without_text_are_scanned():
+    _, texts, scanned = extract_pages(make_pdf(["A typed page with enough text", None, "x"]), min_chars=20)
+    assert scanned == [False, True, False]     # Short text without images needs no OCR
+
+
+def test_group_pages_splits_runs():
+    assert group_pages([0, 1, 2, 4, 5, 7], 2) == [[0, 1], [2], [4, 5], [7]]
+
+
+def test_only_scanned_pages_are_ocred_and_merged_in_order():
+    pages = ["Page 0 typed text here", None, None, None, "Page 4 typed text here", None]
+    google = FakeOCR()
+    text = asyncio.run(extract_text_with_ocr(make_pdf(pages), google, max_pages=None))
+    assert sorted(google.page_counts) == [1, 1, 2]     # Pages [1, 2], [3] and [5]
+    assert text.split("[OCR of ")[0].strip() == "Page 0 typed text here"
+    assert text.index("[OCR of 2 pages]") < text.index("Page 4") < text.rindex("[OCR of 1 pages]")
+
+
+def test_extract_page_pdf_keeps_the_given_pages():
+    pdf = extract_page_pdf(make_pdf(["Page 0 text", "Page 1 text", "Page 2 text"]), [0, 2])
+    _, texts, _ = extract_pages(pdf)
+    assert [text.strip() for text in texts] == ["Page 0 text", "Page 2 text"]
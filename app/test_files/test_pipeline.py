@@ -0,0 +1,69 @@
+"""Tests of the PDF result cache, run with python -m pytest app/test_files/test_pipeline.py"""
+
+import asyncio
+import pytest
+from app.cache import create_cache
+from app.company_data import CompanyData
+from app.config import OPENAI_RESPONSE_FORMAT_VERSION
+from app.pipeline import PDFPipeline
+from app.responses import ClientResponse
+from app.uploads import SpooledUpload
+
+
+class FakeOpenAI:
+    """OpenAI client stand-in answering with the first line of the text as the company name"""
+    def __init__(self, status_code: int = 200) -> None:
+        self.status_code = status_code
+        self.texts = []
+
+    def process_text(self, file_text: str):
+        self.texts.append(file_text)
+        data = CompanyData()
+        data.company.name = file_text.splitlines()[0]
+        return ClientResponse(status_code=self.status_code, message="Data processed successfully",
+                              data=data).to_APIResponse()
+
+
+def upload(data: bytes) -> SpooledUpload:
+    spooled = SpooledUpload()
+    spooled.write(data)
+    return spooled.finish()
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    pipeline = PDFPipeline(FakeOpenAI(), cache=create_cache("Test", max_entries=16, ttl=60))
+
+    async def extract_text(spooled: SpooledUpload) -> str:
+        return spooled.source().decode()
+    monkeypatch.setattr(pipeline, "extract_text", extract_text)
+    return pipeline
+
+
+def test_results_are_cached_by_content(pipeline):
+    first = asyncio.run(pipeline.process(upload(b"Muster GmbH\nSitz: Berlin")))
+    again = asyncio.run(pipeline.process(upload(b"Muster GmbH\nSitz: Berlin")))
+    other = asyncio.run(pipeline.process(upload(b"Beispiel AG")))
+    assert first.to_dict() == again.to_dict() and again.data is not first.data
+    assert other.data.company.name == "Beispiel AG"
+    assert len(pipeline.openai_client.texts) == 2
+
+
+def test_cache_key_holds_the_response_format_version():
+    assert PDFPipeline.cache_key("abc") == f"abc:{OPENAI_RESPONSE_FORMAT_VERSION}"
+
+
+def test_failed_extractions_are_not_cached(pipeline):
+    pipeline.openai_client.status_code = 400
+    for _ in range(2):
+        assert asyncio.run(pipeline.process(upload(b"Muster GmbH"))).status_code == 400
+    assert len(pipeline.openai_client.texts) == 2
+    assert asyncio.run(pipeline.process(upload(b""))).status_code == 400    # No text, no ChatGPT call
+    assert len(pipeline.openai_client.texts) == 2
+
+
+def test_cached_results_can_be_changed_safely(pipeline):
+    asyncio.run(pipeline.process(upload(b"Muster GmbH")))
+    cached = asyncio.run(pipeline.process(upload(b"Muster GmbH")))
+    cached.data.company.industry_codes.append("46.90")
+    assert asyncio.run(pipeline.process(upload(b"Muster GmbH"))).data.company.industry_codes == []
@@ -0,0 +1,44 @@
+"""Tests of the prompt preparation, run with python -m pytest app/test_files/test_prompting.py"""
+
+import pytest
+from app.prompting import TokenCounter, normalize_text, split_sections, prepare_prompt
+
+
+@pytest.fixture
+def count_tokens():
+    counter = TokenCounter("gpt-4o")
+    counter.encoding = None     # The estimate of 4 characters per token, independent of tiktoken
+    return counter
+
+
+def test_normalize_text_removes_layout_noise():
+    text = "Geschäfts-\nführer:  Max\tMuster\r\n-----\n\n\n\nSitz: Berlin"
+    assert normalize_text(text) == "Geschäftsführer: Max Muster\n\nSitz: Berlin"
+
+
+def test_split_sections_cuts_long_paragraphs():
+    sections = split_sections("a" * 2500 + "\n\nb", max_chars=1000)
+    assert sections == ["a" * 1000, "a" * 1000, "a" * 500, "b"]
+
+
+def test_text_within_budget_is_sent_whole(count_tokens):
+    prompt, tokens_in, tokens_sent = prepare_prompt("Muster GmbH\n\nSitz: Berlin", 100, count_tokens)
+    assert prompt == "Muster GmbH\n\nSitz: Berlin"
+    assert tokens_in == tokens_sent == count_tokens(prompt)
+
+
+def test_relevant_sections_are_kept_within_budget(count_tokens):
+    filler = [f"Absatz {i}: " + "Lorem ipsum dolor sit amet " * 8 for i in range(10)]
+    relevant = "Handelsregister Amtsgericht Berlin HRB 12345, Geschäftsführer Max Muster, Stammkapital 25.000 EUR"
+    text = "\n\n".join(filler[:5] + [relevant] + filler[5:])
+    prompt, tokens_in, tokens_sent = prepare_prompt(text, 150, count_tokens)
+    assert relevant in prompt
+    assert tokens_sent <= 150 < tokens_in
+    positions = [text.index(section) for section in prompt.split("\n\n")]
+    assert positions == sorted(positions)  # Kept in document order
+
+
+def test_oversized_section_is_truncated_to_the_budget(count_tokens):
+    prompt, tokens_in, tokens_sent = prepare_prompt("Handelsregister " * 200, 50, count_tokens)
+    assert prompt.startswith("Handelsregister")
+    assert tokens_sent == count_tokens(prompt) <= 50 < tokens_in
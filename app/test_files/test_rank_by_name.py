@@ -0,0 +1,28 @@
+"""Tests of the company name matching, run with python -m pytest app/test_files/test_rank_by_name.py"""
+
+from app.util import split_legal_form, rank_by_name
+
+
+def test_only_trailing_legal_forms_are_stripped():
+    assert split_legal_form("AG Bau GmbH") == ("ag bau", "gmbh")
+    assert split_legal_form("Limited Edition Ltd") == ("limited edition", "ltd")
+    assert split_legal_form("Muster GmbH & Co. KG") == ("muster", "gmbh co kg")
+
+
+def test_name_of_only_legal_forms_is_kept():
+    assert split_legal_form("GmbH") == ("gmbh", "")
+    assert rank_by_name("GmbH", ["AG"]) == []
+
+
+def test_leading_legal_form_word_is_part_of_the_name():
+    assert rank_by_name("Co Working GmbH", ["Working GmbH"], score_cutoff=90) == []
+
+
+def test_other_legal_form_scores_below_exact_match():
+    ranked = rank_by_name("Muster GmbH", ["Muster AG", "Muster GmbH", "Muster UG"])
+    assert ranked[0] == (1, 100)
+    assert all(score < 100 for _, score in ranked[1:])
+
+
+def test_spelled_out_legal_form_matches_its_abbreviation():
+    assert rank_by_name("Muster Gesellschaft mit beschränkter Haftung", ["Muster GmbH"]) == [(0, 100)]
@@ -0,0 +1,59 @@
+"""Tests of the OpenAI rate limiter, run with python -m pytest app/test_files/test_rate_limit.py"""
+
+import time
+import threading
+from app.rate_limit import RateLimiter, FileBucketStore, create_rate_limiter, MemoryBucketStore
+
+
+def test_try_acquire_takes_a_request_and_tokens():
+    limiter = RateLimiter(requests_per_minute=2, tokens_per_minute=600)
+    assert limiter.try_acquire(400) == 0
+    assert 19 < limiter.try_acquire(400) <= 20     # 200 tokens left, 200 more come in 20 seconds
+    assert limiter.try_acquire(100) == 0
+    assert 29 < limiter.try_acquire(1) <= 30       # Both requests are used up
+
+
+def test_adjust_charges_and_refunds_tokens():
+    limiter = RateLimiter(requests_per_minute=100, tokens_per_minute=600)
+    limiter.adjust(900)     # The answer used more than reserved, the bucket goes 300 tokens into debt
+    assert 30 < limiter.try_acquire(1) <= 30.1
+    limiter.adjust(-900)
+    assert limiter.try_acquire(1) == 0
+
+
+def test_pause_holds_back_all_callers():
+    limiter = RateLimiter(requests_per_minute=600, tokens_per_minute=600)
+    limiter.pause(5)
+    assert 4.9 < limiter.try_acquire(1) <= 5
+    assert not limiter.acquire(1, timeout=0.1)     # Fails fast instead of waiting past the deadline
+
+
+def test_callers_are_admitted_in_arrival_order():
+    limiter = RateLimiter(requests_per_minute=6000, tokens_per_minute=600)
+    limiter.adjust(600)     # Empty the token bucket, 10 tokens come in per second
+    admitted = []
+
+    def call(name: str, tokens: int) -> None:
+        assert limiter.acquire(tokens, timeout=5)
+        admitted.append(name)
+
+    first = threading.Thread(target=call, args=("first", 3))
+    first.start()
+    while not limiter.queue:
+        time.sleep(0.001)
+    second = threading.Thread(target=call, args=("second", 1))  # Would fit earlier, but waits its turn
+    second.start()
+    first.join()
+    second.join()
+    assert admitted == ["first", "second"]
+
+
+def test_file_store_shares_the_buckets(tmp_path):
+    path = str(tmp_path / "rate-limit.json")
+    limiters = [RateLimiter(1, 600, FileBucketStore(path)) for _ in range(2)]
+    assert limiters[0].try_acquire(1) == 0
+    assert limiters[1].try_acquire(1) > 0
+
+
+def test_empty_state_path_keeps_the_buckets_in_memory():
+    assert isinstance(create_rate_limiter(1, 600, "").store, MemoryBucketStore)
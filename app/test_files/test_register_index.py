@@ -0,0 +1,86 @@
+"""Tests of the local register index, run with python -m pytest app/test_files/test_register_index.py"""
+
+import pytest
+from app.cache import create_cache
+from app.clients.openregister_client import OpenregisterClient
+from app.register_index import RegisterIndex
+
+RECORDS = [
+    {"company_id": "DE-1", "name": "Muster Bau GmbH", "register_court": "Berlin", "register_number": "1"},
+    {"company_id": "DE-2", "name": "Muster Handel AG", "register_court": "Berlin", "register_number": "2"},
+    {"company_id": "DE-3", "name": "Beispiel Bau GmbH", "register_court": "Hamburg", "register_number": "1"},
+]
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = RegisterIndex(str(tmp_path / "index.sqlite3"))
+    index.load(RECORDS)
+    return index
+
+
+@pytest.fixture
+def client(index, monkeypatch):
+    client = OpenregisterClient("token", cache=create_cache("Test", max_entries=16, ttl=60), register_index=index)
+    client.calls = []
+    monkeypatch.setattr(client, "request", lambda url, method="GET", body=None, **kwargs:
+                        client.calls.append(body) or (200, {"results": client.api_results}))
+    client.api_results = []
+    yield client
+    client.close()
+
+
+def ids(companies: list[dict]) -> list[str]:
+    return [company["company_id"] for company in companies]
+
+
+def test_search_finds_names_with_all_words(index):
+    assert ids(index.search("Muster Bau", max_age=60)) == ["DE-1"]
+
+
+def test_search_falls_back_to_any_word(index):
+    assert sorted(ids(index.search("Muster Logistik", max_age=60))) == ["DE-1", "DE-2"]
+
+
+def test_search_ignores_legal_forms_and_short_words(index):
+    assert ids(index.search("Bau GmbH", max_age=60)) == ids(index.search("Bau", max_age=60))
+    assert index.search("AG", max_age=60) == []
+
+
+def test_old_records_are_misses(index):
+    assert index.search("Muster Bau", max_age=-1) == []
+    assert index.get("DE-1", max_age=-1) is None
+    assert index.get("DE-1", max_age=60)["name"] == "Muster Bau GmbH"
+
+
+def test_load_refreshes_records(index):
+    index.load([{"company_id": "DE-1", "name": "Muster Logistik GmbH"}])
+    assert index.count() == 3
+    assert ids(index.search("Logistik", max_age=60)) == ["DE-1"]
+    assert index.get("DE-1", max_age=60)["name"] == "Muster Logistik GmbH"
+
+
+def test_find_by_register(index):
+    assert ids(index.find_by_register("Berlin", 2, max_age=60)) == ["DE-2"]
+
+
+def test_exact_name_is_answered_from_the_index(client):
+    assert ids(client.search_companies(company_name="Muster Bau GmbH")) == ["DE-1"]
+    assert client.calls == []
+
+
+def test_similar_name_is_searched_and_indexed(client):
+    client.api_results = [{"company_id": "DE-4", "name": "Muster Bauten GmbH"}]
+    assert ids(client.search_companies(company_name="Muster Bauten GmbH")) == ["DE-4"]
+    assert len(client.calls) == 1
+    assert client.register_index.get("DE-4", max_age=60) is not None
+    assert ids(client.search_companies(company_name="Muster Bauten GmbH")) == ["DE-4"]
+    assert len(client.calls) == 1     # Now an exact match in the index
+
+
+def test_unknown_company_id_is_validated_by_the_api(client):
+    client.api_results = [{"company_id": "DE-9", "name": "Muster Bau GmbH"}]
+    assert client.validate_existence("Muster Bau GmbH", "DE-1")
+    assert client.calls == []
+    assert client.validate_existence("Muster Bau GmbH", "DE-9")
+    assert len(client.calls) == 1
@@ -0,0 +1,50 @@
+"""Tests of the upload spooling, run with python -m pytest app/test_files/test_uploads.py"""
+
+import io
+import os
+import asyncio
+import hashlib
+import tempfile
+import pytest
+from fastapi import UploadFile
+from app.uploads import SpooledUpload, UploadTooLarge, spool_upload
+
+
+def spool(data: bytes, **kwargs) -> SpooledUpload:
+    """Spool the data like an upload of a route"""
+    return asyncio.run(spool_upload(UploadFile(io.BytesIO(data)), **kwargs))
+
+
+def test_small_upload_stays_in_memory():
+    with spool(b"%PDF-1.7 small") as upload, upload.open() as file:
+        assert upload.path is None and upload.source() == b"%PDF-1.7 small"
+        assert file.read() == b"%PDF-1.7 small"
+        assert upload.size == 14 and upload.sha256 == hashlib.sha256(b"%PDF-1.7 small").hexdigest()
+
+
+def test_large_upload_spills_to_disk():
+    data = os.urandom(3 * 1024 * 1024 + 1)
+    upload = spool(data)
+    path = upload.path
+    with upload, upload.open() as file:
+        assert upload.source() == path and os.path.exists(path)
+        assert file.read() == data and upload.sha256 == hashlib.sha256(data).hexdigest()
+    assert not os.path.exists(path)     # Deleted on close
+
+
+def test_written_chunks_spill_past_the_memory_limit():
+    upload = SpooledUpload(memory_limit=10)
+    upload.write(b"0123456789")
+    assert upload.path is None
+    upload.write(b"a")
+    with upload.finish(), upload.open() as file:
+        assert upload.path is not None and file.read() == b"0123456789a"
+
+
+@pytest.mark.parametrize("size, max_size", [(2000, 1000), (3 * 1024 * 1024, 2 * 1024 * 1024)])
+def test_too_large_upload_is_rejected_and_removed(size, max_size):
+    spooled = lambda: {name for name in os.listdir(tempfile.gettempdir()) if name.startswith("upload-")}
+    before = spooled()
+    with pytest.raises(UploadTooLarge):
+        spool(b"x" * size, max_size=max_size)
+    assert spooled() <= before
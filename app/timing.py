@@ -0,0 +1,47 @@
+"""Request-scoped timing of the pipeline stages and upstream calls, sent as a Server-Timing header"""
+
+import re
+import time
+import contextvars
+from contextlib import contextmanager
+
+SPANS = contextvars.ContextVar("timing_spans", default=None)   # The current request's [(name, seconds)]
+
+
+def start_timing() -> list:
+    """Collect the spans of the current context (a request) from here on, returns the list they go to"""
+    spans = []
+    SPANS.set(spans)    # Copied contexts share the list, so spans of executor threads end up here as well
+    return spans
+
+
+@contextmanager
+def span(name: str):
+    """Time the block as a span of the current request, does nothing outside of a timed request"""
+    spans = SPANS.get()
+    if spans is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans.append((name, time.perf_counter() - started))
+
+
+def metric_name(name: str) -> str:
+    """Turn a span name into a Server-Timing metric name, like company_id_owners for company/{id}/owners"""
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name).strip('_')
+
+
+def server_timing(spans: list, total: float = None) -> str:
+    """Format spans as a Server-Timing header value, durations in milliseconds"""
+    entries = [f"{metric_name(name)};dur={seconds * 1000:.1f}" for name, seconds in spans]
+    if total is not None:
+        entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def timing_data(spans: list) -> list[dict]:
+    """Turn spans into a list for JSON bodies, durations in milliseconds"""
+    return [{"name": name, "ms": round(seconds * 1000, 1)} for name, seconds in spans]
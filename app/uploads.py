@@ -0,0 +1,105 @@
+"""Spooling of uploaded files"""
+
+import io
+import os
+import asyncio
+import hashlib
+import tempfile
+from fastapi import UploadFile
+from app.config import UPLOADS
+
+
+class UploadTooLarge(Exception):
+    """Raised when an upload exceeds the maximum size"""
+
+
+class SpooledUpload:
+    """Uploaded file kept in memory while small and spilled to a temporary file when large,
+    hashed while it is written"""
+    def __init__(self, max_size: int = UPLOADS.max_size, memory_limit: int = UPLOADS.memory_limit) -> None:
+        self.max_size = max_size
+        self.memory_limit = memory_limit
+        self.buffer = io.BytesIO()
+        self.data = None    # Contents of small uploads once finished
+        self.file = None
+        self.path = None    # Path of large uploads
+        self.size = 0
+        self.hasher = hashlib.sha256()
+        self.sha256 = ""
+
+    def write(self, chunk: bytes) -> None:
+        """Append a chunk, raises UploadTooLarge if the upload exceeds the maximum size"""
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise UploadTooLarge(f"Upload exceeds {self.max_size} bytes")
+        self.hasher.update(chunk)
+        if self.file is None and self.size > self.memory_limit:   # Spill to disk
+            self.file = tempfile.NamedTemporaryFile(prefix="upload-", suffix=".pdf", delete=False)
+            self.path = self.file.name
+            self.file.write(self.buffer.getbuffer())
+            self.buffer = None
+        (self.file or self.buffer).write(chunk)
+
+    def finish(self) -> "SpooledUpload":
+        """Finish writing"""
+        if self.file is not None:
+            self.file.close()
+        else:
+            self.data = self.buffer.getvalue()
+            self.buffer = None
+        self.sha256 = self.hasher.hexdigest()
+        return self
+
+    def copy_from(self, file: io.BufferedIOBase) -> "SpooledUpload":
+        """Copy a file chunk by chunk and finish, blocks while writing to disk and hashing"""
+        try:
+            chunk = file.read(self.memory_limit + 1)
+            if len(chunk) <= self.memory_limit and self.size + len(chunk) <= self.max_size:
+                self.size, self.data, self.buffer = len(chunk), chunk, None  # Small, keep it without copying
+                self.hasher.update(chunk)
+                self.sha256 = self.hasher.hexdigest()
+                return self
+            self.write(chunk)
+            while chunk := file.read(UPLOADS.chunk_size):
+                self.write(chunk)
+            return self.finish()
+        except BaseException:
+            self.close()
+            raise
+
+    def open(self) -> io.BufferedIOBase:
+        """Open a new reader on the contents"""
+        return open(self.path, "rb") if self.path else io.BytesIO(self.data)  # BytesIO shares the bytes
+
+    def source(self) -> str | bytes:
+        """The path of large uploads or the contents of small ones, to pass to worker processes"""
+        return self.path or self.data
+
+    def close(self) -> None:
+        """Delete the temporary file"""
+        if self.file is not None and not self.file.closed:
+            self.file.close()
+        if self.path:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+        self.data = None
+
+    def __enter__(self) -> "SpooledUpload":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+async def spool_upload(upload: UploadFile, max_size: int = UPLOADS.max_size) -> SpooledUpload:
+    """Copy an upload into a SpooledUpload in a thread, off the event loop"""
+    spooled = SpooledUpload(max_size=max_size)
+    copy = asyncio.ensure_future(asyncio.to_thread(spooled.copy_from, upload.file))
+    try:
+        return await asyncio.shield(copy)   # The thread can't be stopped, let it finish on cancellation
+    except BaseException:
+        copy.add_done_callback(lambda _: spooled.close())
+        raise
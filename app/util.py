@@ -1,7 +1,13 @@
 """Utilit functions for the API and clients"""
 
 import io
-from PyPDF2 import PdfReader
+import re
+import asyncio
+from itertools import chain
+from app.executors import EXECUTORS
+from app.pdf_text import extract_pages, extract_page_pdf, extract_text_layer
+from app.config import PDF
+from app.metrics import METRICS
 
 
 def format_duns(duns) -> tuple[bool, str]:
@@ -27,20 +33,93 @@ def validate_duns_format(duns: str) -> bool:    # Validate DUNS number format, p
 
 def extract_text_from_pdf(file_stream: io.BytesIO, google_client) -> str:
     """Extract text from a PDF file stream."""
-    try:
-        reader = PdfReader(file_stream)     # Try reading text from the PDF (only with typed PDFs)
-        text = ''
-        for page in reader.pages:
-            text += page.extract_text() or ''
-        text = text.strip()
-    except Exception:
+    with METRICS.stage("pdf_parse"):
+        text = extract_text_layer(file_stream, PDF.max_pages)   # Try reading text from the PDF (only with typed PDFs)
+    if text is None:                        # Not a readable PDF
         return ""
 
     if text or not google_client:           # Successfully extracted text or no fallback
         return text
 
+    return ocr_pdf(file_stream, google_client)
+
+async def extract_pages_parallel(source: bytes | str,
+                                 max_pages: int = PDF.max_pages) -> tuple[list[str], list[bool]] | None:
+    """Extract the text of each page of a PDF with its page ranges spread over the PDF process pool,
+    returns the page texts and which pages are scanned or None if it can't be read"""
+    first_stop = min(PDF.pages_per_task, max_pages) if max_pages else PDF.pages_per_task
+    result = await EXECUTORS.pdf.run(extract_pages, source, 0, first_stop,  # Also gets the page count
+                                     PDF.ocr_min_chars)
+    if result is None:
+        return None
+    page_count, texts, scanned = result
+    page_count = min(page_count, max_pages) if max_pages else page_count
+
+    if page_count > first_stop:     # Extract the remaining pages in one range per worker process
+        range_size = max(PDF.pages_per_task, -(-(page_count - first_stop) // EXECUTORS.pdf.max_workers))
+        results = await asyncio.gather(*(
+            EXECUTORS.pdf.run(extract_pages, source, start, min(start + range_size, page_count),
+                              PDF.ocr_min_chars)
+            for start in range(first_stop, page_count, range_size)))
+        if any(result is None for result in results):
+            return None
+        texts = list(chain(texts, *(result[1] for result in results)))
+        scanned = list(chain(scanned, *(result[2] for result in results)))
+
+    return texts, scanned
+
+async def extract_text_layer_parallel(source: bytes | str, max_pages: int = PDF.max_pages) -> str | None:
+    """Extract the text layer of a PDF with its page ranges spread over the PDF process pool,
+    returns None if it can't be read"""
+    result = await extract_pages_parallel(source, max_pages)
+    return ''.join(result[0]).strip() if result is not None else None
+
+def group_pages(pages: list[int], group_size: int) -> list[list[int]]:
+    """Group page numbers into runs of consecutive pages with at most group_size pages each"""
+    groups = []
+    for page in pages:
+        if groups and groups[-1][-1] == page - 1 and len(groups[-1]) < group_size:
+            groups[-1].append(page)
+        else:
+            groups.append([page])
+    return groups
+
+async def extract_text_with_ocr(source: bytes | str, google_client, max_pages: int = PDF.max_pages) -> str:
+    """Extract the text of a PDF, sending only its scanned pages to the google client's OCR"""
+    with METRICS.stage("pdf_parse"):
+        result = await extract_pages_parallel(source, max_pages)
+    if result is None:          # Not a readable PDF
+        return ""
+    texts, scanned = result
+    scanned_pages = [i for i, page_scanned in enumerate(scanned) if page_scanned]
+    if not scanned_pages or not google_client:
+        return ''.join(texts).strip()
+
+    async def ocr(pdf: bytes | None) -> str:
+        """OCR a PDF given as bytes, or the source file if None"""
+        with open(source, "rb") if pdf is None else io.BytesIO(pdf) as file_stream:
+            response = await EXECUTORS.google.run(google_client, file_stream)
+        return response.data["text"] if response.status_code == 200 else ""
+
+    groups = group_pages(scanned_pages, PDF.ocr_pages_per_group)
+    with METRICS.stage("ocr"):
+        if len(scanned_pages) == len(texts) and len(groups) == 1 and not max_pages:  # Upload the file as is
+            pdfs = [source if isinstance(source, bytes) else None]
+        else:                       # Cut the scanned pages out into smaller PDFs
+            pdfs = await asyncio.gather(*(EXECUTORS.pdf.run(extract_page_pdf, source, group) for group in groups))
+        ocr_texts = await asyncio.gather(*(ocr(pdf) for pdf in pdfs))
+    for group, ocr_text in zip(groups, ocr_texts):  # Merge the OCR text back in page order
+        if ocr_text:
+            texts[group[0]] = ocr_text
+            for page in group[1:]:
+                texts[page] = ''
+    return ''.join(texts).strip()
+
+def ocr_pdf(file_stream: io.BytesIO, google_client) -> str:
+    """Extract text from a scanned PDF file stream using the google client's OCR"""
     file_stream.seek(0)                     # Reset stream position
-    response = google_client(file_stream)   # Use the google client for OCR
+    with METRICS.stage("ocr"):
+        response = EXECUTORS.google.call(google_client, file_stream)   # Use the google client for OCR
 
     return response.data["text"] if response.status_code == 200 else ""
 
@@ -57,13 +136,64 @@ def validate_german_company_id_format(company_id) -> bool:
         return False
     return True
 
+def normalize_company_name(company_name: str) -> str:
+    """Normalize a company name for use in lookup keys (case and whitespace insensitive)"""
+    return " ".join(company_name.casefold().split()) if company_name else ""
+
+LEGAL_FORM = (r"(?:gesellschaft mit beschr[aä]nkter haftung|aktiengesellschaft|unternehmergesellschaft|"
+              r"kommanditgesellschaft|haftungsbeschr[aä]nkt|gmbh|mbh|ag|ug|kgaa|kg|ohg|gbr|se|partg|e k|e v|"
+              r"co|ltd|limited|inc|llc)")
+LEGAL_FORM_SUFFIX = re.compile(     # Trailing legal forms like "gmbh co kg", matched after removing punctuation
+    rf"(?:^|\s){LEGAL_FORM}(?:\s{LEGAL_FORM})*$")
+LEGAL_FORM_ALIASES = {"gesellschaft mit beschränkter haftung": "gmbh", "gesellschaft mit beschrankter haftung": "gmbh",
+                      "aktiengesellschaft": "ag", "unternehmergesellschaft": "ug", "kommanditgesellschaft": "kg",
+                      "limited": "ltd", "haftungsbeschränkt": "", "haftungsbeschrankt": ""}
+LEGAL_FORM_PENALTY = 10     # Same name with another legal form is another entity, so it scores below an exact match
+
+def split_legal_form(company_name: str) -> tuple[str, str]:
+    """Split a company name into its casefolded name without punctuation and its trailing legal form,
+    the name is kept whole if it is nothing but legal forms"""
+    name = " ".join(re.sub(r"[^\w\s]", " ", company_name.casefold()).split())
+    match = LEGAL_FORM_SUFFIX.search(name)
+    if match is None or match.start() == 0:
+        return name, ""
+    forms = (LEGAL_FORM_ALIASES.get(form, form) for form in re.findall(LEGAL_FORM, match.group()))
+    return name[:match.start()], " ".join(form for form in forms if form)
+
+def strip_legal_form(company_name: str) -> str:
+    """Normalize a company name for fuzzy matching: casefolded, without punctuation and trailing legal forms"""
+    return split_legal_form(company_name)[0]
+
+def rank_by_name(company_name: str, names: list[str], limit: int = 5,
+                 score_cutoff: float = 75) -> list[tuple[int, float]]:
+    """Rank names by their similarity to company_name, returns the indices and scores of the best
+    (at most limit) names scoring at least score_cutoff, best first"""
+    from rapidfuzz import process     # Only needed by the openregister client, which is built lazily
+    from rapidfuzz.fuzz import ratio    # Used to determine similarity in strings
+    query_name, query_form = split_legal_form(company_name)
+    if not query_name:
+        return []
+    matches = process.extract(company_name, names, scorer=ratio, processor=strip_legal_form,
+                              limit=limit, score_cutoff=score_cutoff)
+    query = normalize_company_name(company_name)
+    ranked = []
+    for name, score, index in matches:  # Only the best few, the scoring itself stays in rapidfuzz
+        candidate_form = split_legal_form(name)[1]
+        if query_form and candidate_form and query_form != candidate_form:
+            score -= LEGAL_FORM_PENALTY
+        if score >= score_cutoff:   # Ties go to the closer full name, then keep the API's order
+            ranked.append((score, ratio(query, normalize_company_name(name)), -index))
+    ranked.sort(reverse=True)
+    return [(-index, score) for score, _, index in ranked]
+
 def calculate_completion_percentage(obj) -> float:
     """Calculate the completion percentage of an object"""
+    names = getattr(obj, "__slots__", None) or obj.__dict__.keys()    # Slotted objects have no __dict__
     total, filled = 0, 0
-    for key, value in obj.__dict__.items():
+    for key in names:
         if isinstance(key, str):
             total += 1
-            if bool(value):
+            if bool(getattr(obj, key)):
                 filled += 1
 
     return round(filled/total, 2)